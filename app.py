@@ -3,28 +3,42 @@ import pandas as pd
 import numpy as np
 import time
 import datetime
+import decimal
 import hashlib
 import json
 import os
+import contextlib
 import shutil
 import zipfile
+import tempfile
+import concurrent.futures
 from PIL import Image
 import fpdf as FPDF
 import io
+import html
 import base64
 import uuid
 import serial
 import serial.tools.list_ports
 import subprocess
+import socket
 import threading
 import platform
+import itertools
+import collections
+import logging
+import sys
 import pytz
 from datetime import timedelta
 
+logger = logging.getLogger(__name__)
+
 # Constants
 DATA_DIR = "data"
 BACKUP_DIR = "backups"
 TEMPLATE_DIR = "templates"
+REPORTS_DIR = "reports"
+REPORT_JOBS_FILE = os.path.join(REPORTS_DIR, "jobs.json")
 USERS_FILE = os.path.join(DATA_DIR, "users.json")
 PRODUCTS_FILE = os.path.join(DATA_DIR, "products.json")
 INVENTORY_FILE = os.path.join(DATA_DIR, "inventory.json")
@@ -38,10 +52,27 @@ SUPPLIERS_FILE = os.path.join(DATA_DIR, "suppliers.json")
 SHIFTS_FILE = os.path.join(DATA_DIR, "shifts.json")
 CASH_DRAWER_FILE = os.path.join(DATA_DIR, "cash_drawer.json")
 RETURNS_FILE = os.path.join(DATA_DIR, "returns.json")
-PURCHASE_ORDERS_FILE = os.path.join(DATA_DIR, "purchase_orders.json")
+PURCHASE_ORDERS_FILE = os.path.join(DATA_DIR, "purchase_orders.json")  # before schema 4, migrated to the PO store
+PURCHASE_ORDERS_DIR = os.path.join(DATA_DIR, "purchase_orders")
+PO_INDEX_FILE = os.path.join(DATA_DIR, "purchase_orders_index.jsonl")
+PO_RECEIPTS_FILE = os.path.join(DATA_DIR, "po_receipts.jsonl")
 # Add these constants at the top with other constants
 BRANDS_FILE = os.path.join(DATA_DIR, "brands.json")
 OUTDOOR_ORDERS_FILE = os.path.join(DATA_DIR, "outdoor_orders.json")
+SALES_CONFLICTS_FILE = os.path.join(DATA_DIR, "sales_conflicts.json")
+SALES_ROLLUPS_FILE = os.path.join(DATA_DIR, "sales_rollups.json")
+SALES_VELOCITY_FILE = os.path.join(DATA_DIR, "sales_velocity.json")
+CUSTOMER_STATS_FILE = os.path.join(DATA_DIR, "customer_stats.json")
+CUSTOMER_SEGMENTS_FILE = os.path.join(DATA_DIR, "customer_segments.json")
+CUSTOMER_RFM_FILE = os.path.join(DATA_DIR, "customer_rfm.json")
+CUSTOM_REPORTS_FILE = os.path.join(DATA_DIR, "custom_reports.json")
+DASHBOARD_COUNTERS_FILE = os.path.join(DATA_DIR, "dashboard_counters.json")
+STOCK_LEDGER_FILE = os.path.join(DATA_DIR, "stock_ledger.jsonl")
+DATA_LOCK_FILE = os.path.join(DATA_DIR, ".merge.lock")
+# Lane spool lives on the terminal itself, not in the shared data directory
+SPOOL_DIR = "spool"
+SPOOL_OFFSETS_FILE = os.path.join(SPOOL_DIR, "offsets.json")
+MERGE_JOURNAL_FILE = os.path.join(SPOOL_DIR, "merge_journal.json")
 # Authentication functions
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
@@ -69,8 +100,11 @@ def is_cashier():
 
 # Ensure data and template directories exist
 os.makedirs(DATA_DIR, exist_ok=True)
+os.makedirs(PURCHASE_ORDERS_DIR, exist_ok=True)
 os.makedirs(BACKUP_DIR, exist_ok=True)
 os.makedirs(TEMPLATE_DIR, exist_ok=True)
+os.makedirs(SPOOL_DIR, exist_ok=True)
+os.makedirs(REPORTS_DIR, exist_ok=True)
 
 # Data loading and saving functions
 def load_data(file):
@@ -81,8 +115,11 @@ def load_data(file):
         return {}
 
 def save_data(data, file):
-    with open(file, 'w') as f:
+    # Write to a temp file and swap it in so other lanes never read a partial file
+    tmp_file = f"{file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_file, 'w') as f:
         json.dump(data, f, indent=4)
+    os.replace(tmp_file, file)
 
 # Initialize empty data files if they don't exist
 def ensure_default_user():
@@ -154,6 +191,12 @@ def initialize_empty_data():
             "theme": "Light",
             "session_timeout": 30,
             "printer_name": "Browser Printer",
+            "printer_backend": "browser",
+            "escpos_target": "serial",
+            "escpos_address": "",
+            "escpos_baudrate": 9600,
+            "escpos_cut": True,
+            "escpos_drawer_pin": 0,
             "barcode_scanner": "keyboard",
             "timezone": "UTC",
             "currency_symbol": "$",
@@ -173,10 +216,8 @@ def initialize_empty_data():
             "transactions": []
         },
         RETURNS_FILE: {},
-        PURCHASE_ORDERS_FILE: {},
         BRANDS_FILE: {
-            "brands": [],
-            "brand_products": {}
+            "brands": []
         },
         OUTDOOR_ORDERS_FILE: {
             "orders": {},
@@ -229,9 +270,17 @@ def get_available_com_ports():
     ports = serial.tools.list_ports.comports()
     return [port.device for port in ports] + ["auto"]
 
-def print_receipt(receipt_text):
+def print_receipt(receipt_text, kick_drawer=False, template=None, context=None):
     settings = load_data(SETTINGS_FILE)
     
+    # 0. ESC/POS printer, one buffered write including the drawer kick
+    if settings.get('printer_backend') == 'escpos':
+        if template:
+            payload = render_receipt_escpos(get_receipt_template(template), context, kick_drawer, settings)
+        else:
+            payload = escpos_from_text(receipt_text, kick_drawer, settings)
+        return send_escpos_job(payload, settings)
+    
     # 1. Browser-based printing
     try:
         js = f"""
@@ -253,24 +302,7 @@ def print_receipt(receipt_text):
     
     # 2. PDF fallback
     try:
-        pdf = FPDF.FPDF()
-        pdf.add_page()
-        pdf.set_font("Arial", size=12)
-        
-        # Add store header if enabled
-        if settings.get('receipt_print_logo', False) and 'store_logo' in settings and os.path.exists(settings['store_logo']):
-            try:
-                pdf.image(settings['store_logo'], x=10, y=8, w=30)
-                pdf.ln(20)  # Move down after logo
-            except:
-                pass
-        
-        # Add receipt content
-        for line in receipt_text.split('\n'):
-            pdf.cell(0, 10, line, ln=1)
-        
-        pdf_path = "receipt.pdf"
-        pdf.output(pdf_path)
+        pdf_path = write_pdf_tempfile(render_text_pdf(receipt_text, settings), "receipt")
         
         # Open PDF for printing
         if platform.system() == "Windows":
@@ -290,6 +322,10 @@ def open_cash_drawer():
     if not settings.get('cash_drawer_enabled', False):
         return False
     
+    # Drawers wired to an ESC/POS printer open with a kick pulse
+    if settings.get('printer_backend') == 'escpos':
+        return send_escpos_job(finish_escpos_job(bytearray(ESCPOS_INIT), True, settings, cut=False), settings)
+    
     command = settings.get('cash_drawer_command', '')
     if not command:
         return False
@@ -301,6 +337,107 @@ def open_cash_drawer():
         st.error(f"Failed to open cash drawer: {str(e)}")
         return False
 
+# ESC/POS printer backend
+ESCPOS_INIT = b"\x1b@"
+ESCPOS_ALIGN_LEFT = b"\x1ba\x00"
+ESCPOS_ALIGN_CENTER = b"\x1ba\x01"
+ESCPOS_BOLD_ON = b"\x1bE\x01"
+ESCPOS_BOLD_OFF = b"\x1bE\x00"
+ESCPOS_FEED = b"\x1bd\x04"
+ESCPOS_CUT = b"\x1dV\x01"
+ESCPOS_CODEPAGE = 'cp437'
+
+def escpos_encode(text):
+    return text.encode(ESCPOS_CODEPAGE, 'replace')
+
+def finish_escpos_job(buffer, kick_drawer, settings, cut=True):
+    if cut:
+        buffer += ESCPOS_FEED
+        if settings.get('escpos_cut', True):
+            buffer += ESCPOS_CUT
+    if kick_drawer:
+        # ESC p m t1 t2: pulse drawer pin m for t1*2ms on, t2*2ms off
+        buffer += b"\x1bp" + bytes([int(settings.get('escpos_drawer_pin', 0)), 25, 250])
+    return bytes(buffer)
+
+def escpos_from_text(receipt_text, kick_drawer=False, settings=None):
+    settings = settings if settings is not None else load_settings_cached()
+    buffer = bytearray(ESCPOS_INIT)
+    buffer += escpos_encode(receipt_text.rstrip("\n")) + b"\n"
+    return finish_escpos_job(buffer, kick_drawer, settings)
+
+class EscPosPrinter:
+    """Keeps one open connection to a printer and writes whole jobs at once.
+    target is 'serial', 'tcp' ("host:port") or 'device'; a device path may be
+    a plain file, which serves as a fake printer for testing."""
+    def __init__(self, target, address, baudrate=9600, timeout=5):
+        self.target = target
+        self.address = address
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.connection = None
+        self.lock = threading.Lock()
+    
+    def connect(self):
+        if self.target == 'serial':
+            self.connection = serial.Serial(
+                port=self.address,
+                baudrate=self.baudrate,
+                timeout=self.timeout,
+                write_timeout=self.timeout
+            )
+        elif self.target == 'tcp':
+            host, _, port = self.address.rpartition(':')
+            if not host:
+                host, port = self.address, 9100
+            self.connection = socket.create_connection((host, int(port)), timeout=self.timeout)
+        else:
+            self.connection = open(self.address, 'ab', buffering=0)
+    
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+    
+    def write(self, payload):
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.connection is None:
+                        self.connect()
+                    if self.target == 'tcp':
+                        self.connection.sendall(payload)
+                    else:
+                        self.connection.write(payload)
+                        self.connection.flush()
+                    return True
+                except (OSError, serial.SerialException):
+                    # The cached connection may have gone stale; reconnect once
+                    self.close()
+                    if attempt:
+                        raise
+
+# One open connection per printer, shared by every session on this server
+@st.cache_resource(show_spinner=False)
+def get_escpos_printer(target, address, baudrate=9600):
+    return EscPosPrinter(target, address, baudrate)
+
+def send_escpos_job(payload, settings):
+    address = settings.get('escpos_address', '')
+    if not address:
+        st.error("ESC/POS printer address is not configured")
+        return False
+    try:
+        printer = get_escpos_printer(settings.get('escpos_target', 'serial'), address,
+                                     int(settings.get('escpos_baudrate', 9600)))
+        return printer.write(payload)
+    except Exception as e:
+        st.error(f"Printing failed: {str(e)}")
+        return False
+
 # Improved Barcode Scanner
 class BarcodeScanner:
     def __init__(self):
@@ -412,228 +549,3364 @@ def generate_short_id():
     return str(uuid.uuid4())[:8]
 
 def format_currency(amount):
-    settings = load_data(SETTINGS_FILE)
-    symbol = settings.get('currency_symbol', '$')
-    decimals = settings.get('decimal_places', 2)
-    return f"{symbol}{amount:.{decimals}f}"
+    return get_currency_formatter()(amount)
 
 def get_current_datetime():
+    return datetime.datetime.now(get_store_timezone())
+
+# Timestamps
+# Dated records keep their local "%Y-%m-%d %H:%M:%S" strings for display and
+# also carry integer epoch seconds ('ts', or '<name>_ts' for secondary times)
+# plus the store timezone ('tz') they were written in. Filters compare the
+# epoch values instead of re-parsing strings.
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+DATA_SCHEMA_VERSION = 4
+
+# file -> (key holding the records or None for top level, [(string field, epoch field)])
+TIMESTAMP_FIELDS = {
+    TRANSACTIONS_FILE: (None, [('date', 'ts')]),
+    RETURNS_FILE: (None, [('return_date', 'ts')]),
+    SHIFTS_FILE: (None, [('start_time', 'ts'), ('end_time', 'end_ts')]),
+    PURCHASE_ORDERS_FILE: (None, [('date_created', 'ts'), ('date_received', 'received_ts')]),
+    OUTDOOR_ORDERS_FILE: ('orders', [('created_date', 'ts'), ('delivery_date', 'delivery_ts')])
+}
+
+def get_store_timezone():
+    return pytz.timezone(load_settings_cached().get('timezone', 'UTC'))
+
+def timestamp_fields(field='date', ts_field='ts', when=None):
+    """{field: local time string, ts_field: epoch seconds, 'tz': timezone name} for a record"""
+    when = when or get_current_datetime()
+    return {field: when.strftime(DATETIME_FORMAT), ts_field: int(when.timestamp()), 'tz': when.tzinfo.zone}
+
+def record_ts(record, field='date', ts_field='ts'):
+    """Epoch seconds of a record, parsing the string only for records written before 'ts' existed"""
+    ts = record.get(ts_field)
+    if ts is not None:
+        return ts
+    try:
+        local = datetime.datetime.strptime(record.get(field) or '', DATETIME_FORMAT)
+    except ValueError:
+        return None
+    tz = pytz.timezone(record['tz']) if record.get('tz') else get_store_timezone()
+    return int(tz.localize(local).timestamp())
+
+def day_bounds(start_date, end_date=None):
+    """Epoch range [start of start_date, start of the day after end_date) in store time"""
+    tz = get_store_timezone()
+    end_date = end_date or start_date
+    start = tz.localize(datetime.datetime.combine(start_date, datetime.time.min))
+    end = tz.localize(datetime.datetime.combine(end_date + timedelta(days=1), datetime.time.min))
+    return int(start.timestamp()), int(end.timestamp())
+
+def in_ts_range(record, start_ts, end_ts=None, field='date', ts_field='ts'):
+    ts = record_ts(record, field, ts_field)
+    return ts is not None and ts >= start_ts and (end_ts is None or ts < end_ts)
+
+def epoch_seconds(texts, tz):
+    """Local time strings to epoch seconds in one pass; None where unparseable"""
+    stamps = pd.to_datetime(pd.Series(texts, dtype=object), format=DATETIME_FORMAT, errors='coerce')
+    # Ambiguous fall-back hours resolve to standard time
+    stamps = stamps.dt.tz_localize(tz, ambiguous=np.zeros(len(stamps), dtype=bool), nonexistent='shift_forward')
+    seconds = (stamps - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+    return [None if pd.isna(v) else int(v) for v in seconds]
+
+def migrate_epoch_timestamps():
+    """Backfill epoch fields on records written before they existed"""
+    tz = get_store_timezone()
+    for file, (container, fields) in TIMESTAMP_FIELDS.items():
+        data = load_data(file)
+        records = data.get(container, {}) if container else data
+        changed = False
+        for field, ts_field in fields:
+            pending = [r for r in records.values()
+                       if isinstance(r, dict) and r.get(field) and r.get(ts_field) is None]
+            if not pending:
+                continue
+            for record, ts in zip(pending, epoch_seconds([r[field] for r in pending], tz)):
+                if ts is not None:
+                    record[ts_field] = ts
+                    record.setdefault('tz', tz.zone)
+            changed = True
+        if changed:
+            save_data(data, file)
+
+def migrate_data():
     settings = load_data(SETTINGS_FILE)
-    tz = pytz.timezone(settings.get('timezone', 'UTC'))
-    return datetime.datetime.now(tz)
+    version = settings.get('schema_version', 1)
+    if version >= DATA_SCHEMA_VERSION:
+        return
+    if version < 2:
+        migrate_epoch_timestamps()
+    if version < 3:
+        migrate_stock_ledger()
+    if version < 4:
+        migrate_purchase_orders()
+    settings['schema_version'] = DATA_SCHEMA_VERSION
+    save_data(settings, SETTINGS_FILE)
 
-# Purchase Order functions
-def generate_purchase_order(supplier_id, items):
-    suppliers = load_data(SUPPLIERS_FILE)
-    products = load_data(PRODUCTS_FILE)
+# Purchase orders
+# Each purchase order is its own JSON file in PURCHASE_ORDERS_DIR, so receiving
+# or editing an order rewrites only that order. Every save also appends a short
+# summary line for the order to PO_INDEX_FILE (the newest line per PO wins); the
+# index is read incrementally and the status and supplier lookups are built
+# from it. Receipts are appended to PO_RECEIPTS_FILE as JSON lines instead of
+# being kept on the order. Statuses: draft, pending, partially_received, received.
+PO_STATUSES = ('draft', 'pending', 'partially_received', 'received')
+PO_SUMMARY_FIELDS = ('po_id', 'supplier_id', 'supplier_name', 'date_created', 'ts', 'tz', 'created_by',
+                     'total_cost', 'status', 'date_received', 'received_by')
+PO_PAGE_SIZE = 25
+
+def po_file(po_id):
+    return os.path.join(PURCHASE_ORDERS_DIR, f"{po_id}.json")
+
+def po_summary(po):
+    summary = {field: po.get(field) for field in PO_SUMMARY_FIELDS}
+    summary['item_count'] = len(po.get('items', []))
+    return summary
+
+def append_json_lines(file, records):
+    """Append records as JSON lines with a single append write"""
+    data = "".join(json.dumps(record) + "\n" for record in records).encode('utf-8')
+    fd = os.open(file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class PurchaseOrderStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+    
+    def reset(self):
+        with self.lock:
+            self.clear()
+    
+    def clear(self):
+        self.offset = 0
+        self.inode = None
+        self.summaries = {}
+        self.by_status = {}
+        self.by_supplier = {}
+    
+    def _index(self):
+        # Lookups hold PO ids newest first
+        self.by_status = collections.defaultdict(list)
+        self.by_supplier = collections.defaultdict(list)
+        for summary in sorted(self.summaries.values(), key=lambda s: s.get('ts') or 0, reverse=True):
+            self.by_status[summary['status']].append(summary['po_id'])
+            self.by_supplier[summary['supplier_name']].append(summary['po_id'])
+    
+    def _refresh(self):
+        # Picks up lines appended by any process. A replaced or truncated index is
+        # read again from the start; restore_backup also resets the store itself.
+        try:
+            stat = os.stat(PO_INDEX_FILE)
+        except OSError:
+            if self.offset:
+                self.clear()
+            return
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self.clear()
+            self.inode = stat.st_ino
+        if stat.st_size == self.offset:
+            return
+        with open(PO_INDEX_FILE, 'rb') as f:
+            f.seek(self.offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break  # summary still being written
+                self.offset += len(raw)
+                try:
+                    summary = json.loads(raw)
+                except ValueError:
+                    continue
+                if summary.get('deleted'):
+                    self.summaries.pop(summary['po_id'], None)
+                else:
+                    self.summaries[summary['po_id']] = summary
+        self._index()
+    
+    def get(self, po_id):
+        return load_data(po_file(po_id)) or None
+    
+    def save(self, *purchase_orders):
+        """Write each order's own file, then their summaries in one append"""
+        for po in purchase_orders:
+            save_data(po, po_file(po['po_id']))
+        append_json_lines(PO_INDEX_FILE, [po_summary(po) for po in purchase_orders])
+    
+    def delete(self, po_id):
+        append_json_lines(PO_INDEX_FILE, [{'po_id': po_id, 'deleted': True}])
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(po_file(po_id))
+    
+    def list(self, statuses=None, supplier=None, start_ts=None, end_ts=None):
+        """Summaries newest first, narrowed through the status and supplier lookups"""
+        with self.lock:
+            self._refresh()
+            if statuses is None:
+                po_ids = self.by_supplier.get(supplier, []) if supplier else self.summaries
+            else:
+                po_ids = itertools.chain(*(self.by_status.get(status, []) for status in statuses))
+                if supplier:
+                    po_ids = set(po_ids).intersection(self.by_supplier.get(supplier, []))
+            summaries = [self.summaries[po_id] for po_id in po_ids]
+        if start_ts is not None:
+            summaries = [s for s in summaries if in_ts_range(s, start_ts, end_ts, field='date_created')]
+        return sorted(summaries, key=lambda s: s.get('ts') or 0, reverse=True)
+    
+    def supplier_names(self):
+        with self.lock:
+            self._refresh()
+            return sorted(self.by_supplier)
+
+# One store per server process, shared by every session
+@st.cache_resource(show_spinner=False)
+def get_po_store():
+    return PurchaseOrderStore()
+
+def record_po_receipt(receipt):
+    append_json_lines(PO_RECEIPTS_FILE, [receipt])
+
+def po_receipts(po_id):
+    """Receipts recorded against a PO, oldest first"""
+    receipts = []
+    try:
+        with open(PO_RECEIPTS_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                if po_id in line:
+                    receipt = json.loads(line)
+                    if receipt['po_id'] == po_id:
+                        receipts.append(receipt)
+    except FileNotFoundError:
+        pass
+    return receipts
+
+def migrate_purchase_orders():
+    """Split PURCHASE_ORDERS_FILE into one file per order plus the index, and move
+    each order's 'receipts' list into PO_RECEIPTS_FILE"""
     purchase_orders = load_data(PURCHASE_ORDERS_FILE)
-    
-    if supplier_id not in suppliers:
-        return None
-    
-    supplier = suppliers[supplier_id]
-    po_id = generate_short_id()
-    
-    # Calculate totals
-    total_cost = 0
-    for item in items:
-        product = products.get(item['barcode'], {})
-        total_cost += item['quantity'] * product.get('cost', 0)
-    
-    # Create PO
-    purchase_orders[po_id] = {
-        'po_id': po_id,
+    if not purchase_orders:
+        return
+    tz = get_store_timezone()
+    receipts = []
+    for po in purchase_orders.values():
+        po_receipt_list = po.pop('receipts', None) or []
+        for receipt, ts in zip(po_receipt_list, epoch_seconds([r.get('date') for r in po_receipt_list], tz)):
+            receipts.append({'receipt_id': generate_short_id(), 'po_id': po['po_id'], **receipt, 'ts': ts, 'tz': tz.zone})
+    if receipts:
+        append_json_lines(PO_RECEIPTS_FILE, receipts)
+    get_po_store().save(*purchase_orders.values())
+    os.replace(PURCHASE_ORDERS_FILE, f"{PURCHASE_ORDERS_FILE}.migrated")
+
+def new_purchase_order(supplier_id, supplier_name, items, user, status='pending', **fields):
+    """A PO record; items carry barcode, name, quantity and unit cost"""
+    return {
+        'po_id': generate_short_id(),
         'supplier_id': supplier_id,
-        'supplier_name': supplier['name'],
-        'date_created': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
-        'created_by': st.session_state.user_info['username'],
+        'supplier_name': supplier_name,
+        **timestamp_fields('date_created'),
+        'created_by': user,
         'items': items,
-        'total_cost': total_cost,
-        'status': 'pending',
+        'total_cost': from_minor(sum(to_minor(item.get('cost', 0)) * item['quantity'] for item in items)),
+        'status': status,
         'date_received': None,
-        'received_by': None
+        'received_by': None,
+        **fields
     }
-    
-    save_data(purchase_orders, PURCHASE_ORDERS_FILE)
-    return po_id
 
-def generate_po_report(po_id):
-    purchase_orders = load_data(PURCHASE_ORDERS_FILE)
-    products = load_data(PRODUCTS_FILE)
-    settings = load_data(SETTINGS_FILE)
-    
-    if po_id not in purchase_orders:
+def generate_purchase_order(supplier_id, items):
+    suppliers = load_data(SUPPLIERS_FILE)
+    if supplier_id not in suppliers:
         return None
     
-    po = purchase_orders[po_id]
-    
-    report = f"PURCHASE ORDER #{po_id}\n"
-    report += f"{settings.get('store_name', 'Supermarket POS')}\n"
-    report += f"Date: {po['date_created']}\n"
-    report += "=" * 50 + "\n"
-    report += f"Supplier: {po['supplier_name']}\n"
-    report += f"Created by: {po['created_by']}\n"
-    report += "=" * 50 + "\n"
-    report += "ITEMS:\n"
-    report += "Barcode\tProduct\tQty\tUnit Cost\tTotal\n"
-    
-    for item in po['items']:
-        product = products.get(item['barcode'], {'name': 'Unknown', 'cost': 0})
-        report += f"{item['barcode']}\t{product['name']}\t{item['quantity']}\t"
-        report += f"{format_currency(product.get('cost', 0))}\t"
-        report += f"{format_currency(item['quantity'] * product.get('cost', 0))}\n"
-    
-    report += "=" * 50 + "\n"
-    report += f"TOTAL COST: {format_currency(po['total_cost'])}\n"
-    report += f"STATUS: {po['status'].upper()}\n"
-    
-    if po['status'] == 'received':
-        report += f"Received on: {po['date_received']} by {po['received_by']}\n"
-    
-    return report
+    po = new_purchase_order(supplier_id, suppliers[supplier_id]['name'], items,
+                            st.session_state.user_info['username'])
+    get_po_store().save(po)
+    return po['po_id']
 
-def process_received_po(po_id):
-    purchase_orders = load_data(PURCHASE_ORDERS_FILE)
-    inventory = load_data(INVENTORY_FILE)
+def generate_po_report(po_id, output='text'):
+    po = get_po_store().get(po_id)
+    if po is None:
+        return None
     
-    if po_id not in purchase_orders:
+    compiled = get_receipt_template('purchase_order')
+    context = po_report_context(po, load_data(PRODUCTS_FILE))
+    if output == 'pdf':
+        return render_receipt_pdf(compiled, context)
+    return render_receipt_text(compiled, context)
+
+def process_received_po(po_id, received_items, notes, mark_as_complete=False):
+    store = get_po_store()
+    po = store.get(po_id)
+    if po is None:
         return False
     
-    po = purchase_orders[po_id]
-    
     if po['status'] == 'received':
-        return True  # Already processed
+        return True  # Already fully processed
     
-    # Update inventory
+    products = load_data(PRODUCTS_FILE)
+    user = st.session_state.user_info['username']
+    
+    # Update inventory only for received items
+    movements = []
+    with locked_inventory() as inventory:
+        for item in received_items:
+            if item['received_quantity'] > 0:
+                barcode = item['barcode']
+            
+                if barcode in inventory:
+                    inventory[barcode]['quantity'] += item['received_quantity']
+                else:
+                    # Initialize inventory with default values if product doesn't exist in inventory
+                    inventory[barcode] = {
+                        'quantity': item['received_quantity'],
+                        'reorder_point': 10,  # Default reorder point
+                        'cost': products.get(barcode, {}).get('cost', 0)  # Get cost from products if available
+                    }
+            
+                inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                inventory[barcode]['updated_by'] = user
+                movements.append(stock_movement(barcode, item['received_quantity'], inventory[barcode]['quantity'],
+                                                'receipt', po_id, user))
+    
+    # Keep a running received count per item for the open-order index
+    received_by_barcode = {item['barcode']: item['received_quantity'] for item in received_items}
     for item in po['items']:
-        barcode = item['barcode']
-        quantity = item['quantity']
-        
-        if barcode in inventory:
-            inventory[barcode]['quantity'] += quantity
-        else:
-            inventory[barcode] = {'quantity': quantity, 'reorder_point': 10}
-        
-        inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-        inventory[barcode]['updated_by'] = st.session_state.user_info['username']
+        item['received'] = item.get('received', 0) + received_by_barcode.get(item['barcode'], 0)
     
     # Update PO status
-    po['status'] = 'received'
-    po['date_received'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-    po['received_by'] = st.session_state.user_info['username']
+    if all(item['received_quantity'] == item['ordered_quantity'] for item in received_items):
+        po['status'] = 'received'
+    elif mark_as_complete:
+        po['status'] = 'partially_received'
+    else:
+        po['status'] = 'pending'  # Still waiting for more items
     
-    save_data(purchase_orders, PURCHASE_ORDERS_FILE)
-    save_data(inventory, INVENTORY_FILE)
+    # Update the PO items if partially received and marked as complete
+    if mark_as_complete and po['status'] == 'partially_received':
+        # Adjust PO items to only include remaining quantities
+        po['items'] = [
+            {
+                'barcode': item['barcode'],
+                'name': item['name'],
+                'quantity': item['ordered_quantity'] - item['received_quantity'],
+                'cost': item['cost']
+            }
+            for item in received_items
+            if item['received_quantity'] < item['ordered_quantity']
+        ]
+    
+    # Update completion info if fully or partially completed
+    if po['status'] in ['received', 'partially_received']:
+        po.update(timestamp_fields('date_received', 'received_ts'))
+        po['received_by'] = user
+    
+    store.save(po)
+    record_po_receipt({
+        'receipt_id': generate_short_id(),
+        'po_id': po_id,
+        **timestamp_fields('date'),
+        'received_by': user,
+        'items': received_items,
+        'notes': notes
+    })
+    record_stock_movements(movements)
     return True
 
-# Session state initialization
-if 'user_info' not in st.session_state:
-    st.session_state.user_info = None
-if 'cart' not in st.session_state:
-    st.session_state.cart = {}
-if 'current_page' not in st.session_state:
-    st.session_state.current_page = "Login"
-if 'shift_started' not in st.session_state:
-    st.session_state.shift_started = False
-if 'shift_id' not in st.session_state:
-    st.session_state.shift_id = None
-if 'last_activity' not in st.session_state:
-    st.session_state.last_activity = time.time()
-if 'barcode_scanner_setup' not in st.session_state:
-    st.session_state.barcode_scanner_setup = False
-if 'scanned_barcode' not in st.session_state:
-    st.session_state.scanned_barcode = None
-if 'scanner_status' not in st.session_state:
-    st.session_state.scanner_status = "Not Connected"
-if 'pos_mode' not in st.session_state:
-    st.session_state.pos_mode = 'scan'
-if 'selected_category' not in st.session_state:
-    st.session_state.selected_category = None
-if 'selected_subcategory' not in st.session_state:
-    st.session_state.selected_subcategory = None
-if 'return_reason' not in st.session_state:
-    st.session_state.return_reason = ""
-if 'po_supplier' not in st.session_state:
-    st.session_state.po_supplier = None
-if 'po_items' not in st.session_state:
-    st.session_state.po_items = []
+# Money
+# Amounts are priced and aggregated as integers in minor units (cents for two
+# decimal places), so totals are exact and columnar sums run on int64. JSON
+# keeps plain decimal amounts, always rounded to the store's decimal_places,
+# which convert back to minor units without loss.
+def get_money_places(settings=None):
+    settings = settings if settings is not None else load_settings_cached()
+    return int(settings.get('decimal_places', 2))
 
-# Setup barcode scanner if not already done
-if not st.session_state.barcode_scanner_setup:
-    setup_barcode_scanner()
+def to_minor(amount, places=None):
+    places = get_money_places() if places is None else places
+    return int(decimal.Decimal(str(amount or 0)).scaleb(places).quantize(decimal.Decimal(1), rounding=decimal.ROUND_HALF_UP))
 
-# Login Page
-def login_page():
-    st.title("Supermarket POS - Login")
-    
-    with st.form("login_form"):
-        username = st.text_input("Username")
-        password = st.text_input("Password", type="password")
-        submit_button = st.form_submit_button("Login")
-        
-        if submit_button:
-            user = verify_user(username, password)
-            if user:
-                if not user.get('active', True):
-                    st.error("This account is inactive. Please contact administrator.")
-                else:
-                    st.session_state.user_info = user
-                    st.session_state.current_page = "Dashboard"
-                    st.session_state.last_activity = time.time()
-                    st.rerun()
-            else:
-                st.error("Invalid username or password")
+def from_minor(minor, places=None):
+    places = get_money_places() if places is None else places
+    return round(minor / 10 ** places, places)
 
-# Shift Management
-def start_shift():
-    shifts = load_data(SHIFTS_FILE)
-    shift_id = generate_short_id()
-    current_time = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-    
-    shifts[shift_id] = {
-        'shift_id': shift_id,
-        'user_id': st.session_state.user_info['username'],
-        'start_time': current_time,
-        'end_time': None,
-        'starting_cash': 0.0,
-        'ending_cash': 0.0,
-        'transactions': [],
-        'status': 'active'
-    }
-    
-    save_data(shifts, SHIFTS_FILE)
-    st.session_state.shift_started = True
-    st.session_state.shift_id = shift_id
-    return shift_id
+def scale_minor(minor, rate):
+    """minor * rate, rounded half up to a whole minor unit"""
+    return int((decimal.Decimal(minor) * decimal.Decimal(str(rate))).quantize(decimal.Decimal(1), rounding=decimal.ROUND_HALF_UP))
 
-def end_shift():
-    if not st.session_state.shift_started:
-        return False
-    
-    shifts = load_data(SHIFTS_FILE)
-    shift_id = st.session_state.shift_id
-    
-    if shift_id in shifts:
-        current_time = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-        shifts[shift_id]['end_time'] = current_time
-        shifts[shift_id]['status'] = 'completed'
+def to_minor_array(values, places=None):
+    places = get_money_places() if places is None else places
+    return np.rint(np.asarray(values, dtype=float) * 10 ** places).astype(np.int64)
+
+def format_money(minor):
+    return format_currency(from_minor(minor))
+
+# Cart model
+# Transaction line formats:
+#   1 - legacy, full product dict (name, price, description, brand) per line
+#   2 - compact, quantity/price snapshot and applied promotions only;
+#       descriptive fields are resolved from the catalog when rendering
+TRANSACTION_LINE_FORMAT = 2
+
+class CartLine:
+    __slots__ = ('barcode', 'quantity', 'price', 'promotions')
+
+    def __init__(self, barcode, quantity, price, promotions=()):
+        self.barcode = barcode
+        self.quantity = quantity
+        self.price = price
+        self.promotions = tuple(promotions)
+
+    @property
+    def price_minor(self):
+        return to_minor(self.price)
+
+    @property
+    def line_total_minor(self):
+        return self.price_minor * self.quantity
+
+    @property
+    def line_total(self):
+        return from_minor(self.line_total_minor)
+
+    def to_record(self):
+        record = {'quantity': self.quantity, 'price': from_minor(self.price_minor)}
+        if self.promotions:
+            record['promotions'] = list(self.promotions)
+        return record
+
+def add_to_cart(barcode, product, quantity=1):
+    line = st.session_state.cart.get(barcode)
+    if line is None:
+        st.session_state.cart[barcode] = CartLine(barcode, quantity, product['price'])
+    else:
+        line.quantity += quantity
+
+def cart_to_transaction_items(cart):
+    return {barcode: line.to_record() for barcode, line in cart.items()}
+
+def resolve_line_name(barcode, item, products):
+    """Name of a cart/transaction line, from the catalog for compact lines"""
+    if item.get('name'):
+        return item['name']
+    return products.get(barcode, {}).get('name', 'Unknown Product')
+
+# Offer pricing
+# Offers are priced over line arrays, so the same rules serve a single cart at
+# checkout and every historical basket in a what-if replay. Lines carry the
+# basket number they belong to; a cart is basket 0. Each barcode appears once
+# per basket. Amounts are minor units.
+def price_offers(offers, baskets, basket_count, barcodes, quantity, price):
+    """[(offer, discount per basket, mask of lines it applied to)] for each offer that
+    applied to at least one line. barcodes is a pd.Categorical; no side effects."""
+    results = []
+    quantity = np.asarray(quantity)
+    price = np.asarray(price, dtype=np.int64)
+    for offer in offers:
+        if offer['type'] == 'bogo':
+            # Buy One Get One Free offer
+            lines = barcodes.isin(offer.get('products', [])) & (quantity >= offer['buy_quantity'])
+            free_qty = (quantity // offer['buy_quantity']) * offer['get_quantity']
+            line_discount = np.where(lines, free_qty * price, 0)
+            discount = np.bincount(baskets, weights=line_discount, minlength=basket_count)
         
-        transactions = load_data(TRANSACTIONS_FILE)
-        shift_transactions = [t for t in transactions.values() 
-                            if t.get('shift_id') == shift_id and t['payment_method'] == 'Cash']
-        total_cash = sum(t['total'] for t in shift_transactions)
+        elif offer['type'] == 'bundle':
+            # Bundle offer - every bundle product must be in the basket
+            bundle_products = set(offer.get('products', []))
+            lines = barcodes.isin(list(bundle_products))
+            present = np.bincount(baskets[lines], minlength=basket_count)
+            complete = (present == len(bundle_products)) & (len(bundle_products) > 0)
+            lines &= complete[baskets]
+            original_price = np.bincount(baskets[lines], weights=(quantity * price)[lines], minlength=basket_count)
+            discount = np.where(complete, original_price - to_minor(offer.get('bundle_price', 0)), 0)
         
-        shifts[shift_id]['ending_cash'] = total_cash
+        elif offer['type'] == 'special_price':
+            # Special price offer
+            lines = np.asarray(barcodes == offer.get('product'))
+            line_discount = np.where(lines, (price - to_minor(offer.get('special_price', 0))) * quantity, 0)
+            discount = np.bincount(baskets, weights=line_discount, minlength=basket_count)
         
-        save_data(shifts, SHIFTS_FILE)
-        st.session_state.shift_started = False
-        st.session_state.shift_id = None
-        return True
-    return False
+        else:
+            continue
+        
+        if lines.any():
+            results.append((offer, np.rint(discount).astype(np.int64), lines))
+    return results
 
-# Dashboard
-def dashboard():
-    settings = load_data(SETTINGS_FILE)
+def simulate_offers(offers, start_date, end_date):
+    """Replay the sales baskets in [start_date, end_date] through offers, as if they
+    had been active. Returns (summary per offer, daily discount per offer) with
+    money in minor units, or (None, None) without sales in the range."""
+    _, line_items = get_sales_frames()
+    line_items = filter_by_date(line_items, start_date, end_date)
+    if line_items.empty:
+        return None, None
+    baskets, _ = pd.factorize(line_items['transaction_id'])
+    basket_count = int(baskets.max()) + 1
+    revenue = np.bincount(baskets, weights=line_items['revenue'].to_numpy(), minlength=basket_count)
+    basket_day = np.empty(basket_count, dtype='datetime64[D]')
+    basket_day[baskets] = line_items['date'].to_numpy().astype('datetime64[D]')
+    
+    results = price_offers(offers, baskets, basket_count, line_items['barcode'].array,
+                           line_items['quantity'].to_numpy(), line_items['price'].to_numpy())
+    summary = []
+    daily = {}
+    combined = np.zeros(basket_count, dtype=np.int64)
+    for offer, discount, lines in results:
+        affected = discount != 0
+        combined += discount
+        summary.append({
+            'offer': offer['name'],
+            'type': offer['type'],
+            'affected_baskets': int(affected.sum()),
+            'basket_share': affected.mean() * 100,
+            'units': int(line_items['quantity'].to_numpy()[lines].sum()),
+            'discount': int(discount.sum()),
+            'avg_discount': int(discount[affected].mean()) if affected.any() else 0,
+            'affected_revenue': int(revenue[affected].sum())
+        })
+        daily[offer['name']] = pd.Series(discount).groupby(basket_day).sum()
+    
+    summary_df = pd.DataFrame(summary, columns=['offer', 'type', 'affected_baskets', 'basket_share', 'units',
+                                                'discount', 'avg_discount', 'affected_revenue'])
+    if len(results) > 1:
+        affected = combined != 0
+        summary_df.loc[len(summary_df)] = {
+            'offer': "All selected", 'type': '', 'affected_baskets': int(affected.sum()),
+            'basket_share': affected.mean() * 100,
+            'units': int(summary_df['units'].sum()), 'discount': int(combined.sum()),
+            'avg_discount': int(combined[affected].mean()) if affected.any() else 0,
+            'affected_revenue': int(revenue[affected].sum())
+        }
+    daily_df = pd.DataFrame(daily).fillna(0).astype(np.int64) if daily else pd.DataFrame()
+    return summary_df, daily_df
+
+# Receipt templates
+# Each receipt kind is described once as a list of rows. Rows are compiled
+# per store (names, header/footer, currency format) the first time they are
+# needed and recompiled only when SETTINGS_FILE changes; the compiled rows
+# then render to text, HTML or PDF in a single pass.
+#   ('text', fmt, align)            - line of text, fmt may reference fields
+#   ('rule', char)                  - full-width separator
+#   ('pair', label, field, sign, strong) - label with a money amount
+#   ('item_header',)                - column titles for the item table
+#   ('items',)                      - one line per item
+# Any row may end with {'when': field}; it is skipped when that field
+# (a store setting or a receipt field) is empty or zero. Item columns are
+# (title, field, width, max length[, align]); the first column is left
+# aligned and the rest right aligned unless given.
+RECEIPT_MONEY_FIELDS = ('amount', 'unit_cost')
+RECEIPT_TEMPLATES = {
+    'sale': {
+        'title': "Receipt #{transaction_id}",
+        'width': 40,
+        'pair_columns': None,
+        'item_line': "{name} x{quantity}: {amount}",
+        'rows': [
+            ('text', "{store_name}", 'left'),
+            ('text', "{store_address}", 'left'),
+            ('text', "{store_phone}", 'left'),
+            ('rule', '='),
+            ('text', "{receipt_header}", 'left', {'when': 'receipt_header'}),
+            ('rule', '=', {'when': 'receipt_header'}),
+            ('text', "Date: {date}", 'left'),
+            ('text', "Cashier: {cashier}", 'left'),
+            ('text', "Transaction ID: {transaction_id}", 'left'),
+            ('rule', '='),
+            ('items',),
+            ('rule', '='),
+            ('pair', "Subtotal:", 'subtotal', '', False),
+            ('pair', "Tax:", 'tax', '', False),
+            ('pair', "Discount:", 'discount_amount', '-', False, {'when': 'discount_amount'}),
+            ('pair', "Total:", 'total', '', True),
+            ('pair', "Payment Fee ({payment_charge_percent}%):", 'payment_charge_amount', '', False, {'when': 'payment_charge_amount'}),
+            ('pair', "Amount Due:", 'amount_due', '', True, {'when': 'payment_charge_amount'}),
+            ('text', "Payment Method: {payment_method}", 'left'),
+            ('pair', "Amount Tendered:", 'amount_tendered', '', False),
+            ('pair', "Change:", 'change', '', False),
+            ('rule', '='),
+            ('text', "{receipt_footer}", 'left', {'when': 'receipt_footer'}),
+            ('rule', '=', {'when': 'receipt_footer'}),
+            ('text', "Thank you for shopping with us!", 'left'),
+        ]
+    },
+    'outdoor': {
+        'title': "Receipt #{order_id}",
+        'width': 40,
+        'pair_columns': (25, 15),
+        'item_columns': [('ITEM', 'name', 20, 18), ('QTY', 'quantity', 5, None), ('AMOUNT', 'amount', 15, None)],
+        'rows': [
+            ('rule', '='),
+            ('text', "{store_name}", 'center'),
+            ('text', "{store_address}", 'center'),
+            ('text', "Tel: {store_phone}", 'center'),
+            ('rule', '='),
+            ('text', "OUTDOOR ORDER RECEIPT", 'center'),
+            ('rule', '='),
+            ('text', "Order #: {order_id}", 'left'),
+            ('text', "Date: {created_date}", 'left'),
+            ('rule', '-'),
+            ('text', "Customer: {customer_name}", 'left'),
+            ('text', "Phone: {customer_phone}", 'left'),
+            ('text', "Delivery: {delivery_type}", 'left'),
+            ('rule', '-'),
+            ('item_header',),
+            ('rule', '-'),
+            ('items',),
+            ('rule', '-'),
+            ('pair', "Subtotal:", 'subtotal', '', False),
+            ('pair', "Delivery:", 'delivery_charge', '', False),
+            ('pair', "Fee ({payment_charge_percent}%):", 'payment_charge_amount', '', False, {'when': 'payment_charge_amount'}),
+            ('rule', '='),
+            ('pair', "TOTAL:", 'total', '', True),
+            ('rule', '='),
+            ('text', "Payment: {payment_method}", 'left'),
+            ('text', "Status: {status_label}", 'left'),
+            ('rule', '-'),
+            ('text', "DELIVERY ADDRESS:", 'left'),
+            ('text', "{delivery_address}", 'left'),
+            ('rule', '-', {'when': 'notes'}),
+            ('text', "NOTES: {notes}", 'left', {'when': 'notes'}),
+            ('rule', '='),
+            ('text', "Thank you for your order!", 'center'),
+            ('text', "{printed_at}", 'center'),
+            ('text', "Printed by: {created_by}", 'center'),
+            ('rule', '='),
+        ]
+    },
+    'purchase_order': {
+        'title': "Purchase Order #{po_id}",
+        'width': 64,
+        'page_format': 'A4',
+        'pair_columns': (44, 20),
+        'item_columns': [('BARCODE', 'barcode', 14, 12), ('PRODUCT', 'name', 22, 19, 'left'),
+                         ('QTY', 'quantity', 6, None), ('UNIT COST', 'unit_cost', 11, None), ('TOTAL', 'amount', 11, None)],
+        'rows': [
+            ('text', "PURCHASE ORDER #{po_id}", 'left'),
+            ('text', "{store_name}", 'left'),
+            ('text', "Date: {date_created}", 'left'),
+            ('rule', '='),
+            ('text', "Supplier: {supplier_name}", 'left'),
+            ('text', "Created by: {created_by}", 'left'),
+            ('rule', '='),
+            ('text', "ITEMS:", 'left'),
+            ('item_header',),
+            ('items',),
+            ('rule', '='),
+            ('pair', "TOTAL COST:", 'total_cost', '', True),
+            ('text', "STATUS: {status_label}", 'left'),
+            ('text', "Received on: {date_received} by {received_by}", 'left', {'when': 'date_received'}),
+        ]
+    },
+    'return': {
+        'title': "Return Receipt #{return_id}",
+        'width': 50,
+        'pair_columns': (35, 15),
+        'item_columns': [('ITEM', 'name', 30, 28), ('QTY', 'quantity', 5, None), ('AMOUNT', 'amount', 15, None)],
+        'rows': [
+            ('rule', '='),
+            ('text', "{store_name}", 'center'),
+            ('text', "{store_address}", 'center'),
+            ('text', "Tel: {store_phone}", 'center'),
+            ('rule', '='),
+            ('text', "RETURN RECEIPT", 'center'),
+            ('rule', '='),
+            ('text', "Return ID: {return_id}", 'left'),
+            ('text', "Original Transaction: {transaction_id}", 'left'),
+            ('text', "Date: {return_date}", 'left'),
+            ('text', "Processed by: {processed_by}", 'left'),
+            ('text', "Reason: {reason}", 'left'),
+            ('rule', '-'),
+            ('text', "RETURNED ITEMS:", 'left'),
+            ('rule', '-'),
+            ('item_header',),
+            ('rule', '-'),
+            ('items',),
+            ('rule', '-'),
+            ('pair', "Subtotal Refund:", 'subtotal_refund', '', False),
+            ('pair', "Tax Refund:", 'tax_refund', '', False),
+            ('rule', '='),
+            ('pair', "TOTAL REFUND:", 'total_refund', '', True),
+            ('rule', '='),
+            ('text', "Refund Method: {refund_method}", 'left'),
+            ('text', "Status: {status}", 'left'),
+            ('rule', '-'),
+            ('text', "{receipt_footer}", 'left', {'when': 'receipt_footer'}),
+            ('text', "Thank you for your business!", 'center'),
+            ('rule', '='),
+        ]
+    }
+}
+
+# Parsed settings, reused until the file changes on disk
+_settings_cache = {}
+
+def load_settings_cached():
+    try:
+        stat = os.stat(SETTINGS_FILE)
+        version = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        version = None
+    if 'settings' not in _settings_cache or _settings_cache['version'] != version:
+        _settings_cache['settings'] = load_data(SETTINGS_FILE)
+        _settings_cache['version'] = version
+    return _settings_cache['settings']
+
+def get_currency_formatter(settings=None):
+    settings = settings if settings is not None else load_settings_cached()
+    symbol = settings.get('currency_symbol', '$').replace('{', '{{').replace('}', '}}')
+    decimals = settings.get('decimal_places', 2)
+    return f"{symbol}{{:.{decimals}f}}".format
+
+class _KeepField(dict):
+    # Leaves receipt fields in place while store fields are filled in
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+class CompiledReceipt:
+    __slots__ = ('name', 'title', 'width', 'rows', 'money', 'pair_columns', 'item_line', 'item_columns',
+                 'page_format', 'pdf_layout')
+
+    def __init__(self, name, template, settings):
+        store = {
+            'store_name': settings.get('store_name', 'Supermarket POS'),
+            'store_address': settings.get('store_address', ''),
+            'store_phone': settings.get('store_phone', ''),
+            'receipt_header': settings.get('receipt_header', ''),
+            'receipt_footer': settings.get('receipt_footer', '')
+        }
+        fill = _KeepField({k: v.replace('{', '{{').replace('}', '}}') for k, v in store.items()})
+        
+        self.name = name
+        self.title = template['title']
+        self.width = template['width']
+        self.money = get_currency_formatter(settings)
+        self.pair_columns = template.get('pair_columns')
+        self.item_line = template.get('item_line')
+        self.item_columns = [
+            tuple(column) if len(column) == 5 else tuple(column) + ('left' if i == 0 else 'right',)
+            for i, column in enumerate(template.get('item_columns') or [])
+        ]
+        self.page_format = template.get('page_format', (80, 200))  # POS receipt size
+        self.pdf_layout = None
+        self.rows = []
+        
+        for row in template['rows']:
+            options = row[-1] if isinstance(row[-1], dict) else {}
+            if options:
+                row = row[:-1]
+            when = options.get('when')
+            if when in store:
+                # Store settings are known now, so decide these rows once
+                if not store[when]:
+                    continue
+                when = None
+            
+            kind = row[0]
+            if kind == 'text':
+                fmt = row[1].format_map(fill)
+                if '{' not in fmt.replace('{{', ''):
+                    text = fmt.format()
+                    self.rows.append(('static', when, text, row[2]))
+                else:
+                    self.rows.append(('text', when, fmt, row[2]))
+            elif kind == 'rule':
+                self.rows.append(('rule', when, row[1] * self.width))
+            elif kind == 'pair':
+                self.rows.append(('pair', when, row[1], row[2], row[3], row[4]))
+            else:
+                self.rows.append((kind, when))
+
+_compiled_receipts = {}
+
+def get_receipt_template(name):
+    settings = load_settings_cached()
+    key = (name, _settings_cache.get('version'))
+    compiled = _compiled_receipts.get(key)
+    if compiled is None:
+        compiled = CompiledReceipt(name, RECEIPT_TEMPLATES[name], settings)
+        _compiled_receipts[key] = compiled
+    return compiled
+
+def _receipt_lines(compiled, context):
+    """Yield (kind, text parts, strong) for each visible row"""
+    money = compiled.money
+    for row in compiled.rows:
+        kind, when = row[0], row[1]
+        if when and not context.get(when):
+            continue
+        if kind == 'static':
+            yield 'text', (row[2], row[3]), False
+        elif kind == 'text':
+            yield 'text', (row[2].format_map(context), row[3]), False
+        elif kind == 'rule':
+            yield 'rule', (row[2],), False
+        elif kind == 'pair':
+            yield 'pair', (row[2].format_map(context), row[4] + money(context.get(row[3], 0))), row[5]
+        elif kind == 'item_header':
+            yield 'columns', tuple(column[0] for column in compiled.item_columns), True
+        elif kind == 'items':
+            for line in context['lines']:
+                if compiled.item_columns:
+                    cells = []
+                    for _, field, _, max_len, _ in compiled.item_columns:
+                        value = money(line[field]) if field in RECEIPT_MONEY_FIELDS else str(line[field])
+                        if max_len and len(value) > max_len:
+                            value = value[:max_len] + '..'
+                        cells.append(value)
+                    yield 'columns', tuple(cells), False
+                else:
+                    yield 'text', (compiled.item_line.format(
+                        name=line['name'], quantity=line['quantity'], amount=money(line['amount'])), 'left'), False
+
+def _format_receipt_line(compiled, kind, parts):
+    if kind == 'text':
+        return parts[0].center(compiled.width) if parts[1] == 'center' else parts[0]
+    if kind == 'rule':
+        return parts[0]
+    if kind == 'pair':
+        if compiled.pair_columns:
+            return parts[0].ljust(compiled.pair_columns[0]) + parts[1].rjust(compiled.pair_columns[1])
+        return f"{parts[0]} {parts[1]}"
+    return "".join(value.ljust(column[2]) if column[4] == 'left' else value.rjust(column[2])
+                   for value, column in zip(parts, compiled.item_columns))
+
+def render_receipt_text(compiled, context):
+    return "\n".join(_format_receipt_line(compiled, kind, parts)
+                     for kind, parts, strong in _receipt_lines(compiled, context))
+
+def render_receipt_escpos(compiled, context, kick_drawer=False, settings=None):
+    settings = settings if settings is not None else load_settings_cached()
+    buffer = bytearray(ESCPOS_INIT)
+    for kind, parts, strong in _receipt_lines(compiled, context):
+        if kind == 'text' and parts[1] == 'center':
+            # Let the printer centre instead of padding with spaces
+            buffer += ESCPOS_ALIGN_CENTER + escpos_encode(parts[0]) + b"\n" + ESCPOS_ALIGN_LEFT
+        elif strong:
+            buffer += ESCPOS_BOLD_ON + escpos_encode(_format_receipt_line(compiled, kind, parts)) + b"\n" + ESCPOS_BOLD_OFF
+        else:
+            buffer += escpos_encode(_format_receipt_line(compiled, kind, parts)) + b"\n"
+    return finish_escpos_job(buffer, kick_drawer, settings)
+
+def render_receipt_html(compiled, context):
+    def esc(text):
+        return html.escape(str(text)).replace('`', '&#96;')
+    
+    body = []
+    for kind, parts, strong in _receipt_lines(compiled, context):
+        if kind == 'text':
+            body.append(f'<div class="{parts[1]}">{esc(parts[0])}</div>')
+        elif kind == 'rule':
+            body.append('<div class="divider"></div>')
+        else:
+            css = "row total-row" if strong else "row"
+            cells = "".join(f"<div>{esc(value)}</div>" for value in parts)
+            body.append(f'<div class="{css}">{cells}</div>')
+    
+    return f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>{esc(compiled.title.format_map(context))}</title>
+        <style>
+            body {{
+                font-family: 'Courier New', monospace;
+                font-size: 11px;
+                width: 80mm;
+                margin: 0;
+                padding: 5mm;
+                line-height: 1.2;
+            }}
+            .center {{ text-align: center; }}
+            .row {{ display: flex; justify-content: space-between; margin: 2px 0; }}
+            .divider {{ border-top: 1px dashed #000; margin: 8px 0; }}
+            .total-row {{ font-weight: bold; }}
+        </style>
+    </head>
+    <body>
+        {"".join(body)}
+    </body>
+    </html>
+    """
+
+# PDF rendering
+# Page geometry and column widths are worked out once per compiled template;
+# documents are rendered into memory, and bulk jobs run on a shared pool.
+PDF_WORKERS = 4
+
+def get_pdf_layout(compiled):
+    if compiled.pdf_layout is None:
+        receipt = compiled.page_format != 'A4'
+        layout = {
+            'format': compiled.page_format,
+            'margin': 5 if receipt else 15,
+            'font_size': 8 if receipt else 9,
+            'line_height': 4 if receipt else 5
+        }
+        page_width = compiled.page_format[0] if receipt else 210
+        char_width = (page_width - 2 * layout['margin']) / compiled.width
+        layout['label_width'] = (compiled.pair_columns[0] if compiled.pair_columns else compiled.width // 2) * char_width
+        layout['columns'] = [(column[2] * char_width, 'L' if column[4] == 'left' else 'R')
+                             for column in compiled.item_columns]
+        compiled.pdf_layout = layout
+    return compiled.pdf_layout
+
+def pdf_text(text):
+    # Core PDF fonts only cover latin-1
+    return str(text).encode('latin-1', 'replace').decode('latin-1')
+
+def render_receipt_pdf(compiled, context):
+    layout = get_pdf_layout(compiled)
+    height = layout['line_height']
+    pdf = FPDF.FPDF(format=layout['format'])
+    pdf.set_margins(layout['margin'], layout['margin'], layout['margin'])
+    pdf.add_page()
+    
+    for kind, parts, strong in _receipt_lines(compiled, context):
+        pdf.set_font("Courier", 'B' if strong else '', layout['font_size'])
+        if kind == 'text':
+            if parts[1] == 'center':
+                pdf.cell(0, height, pdf_text(parts[0]), 0, 1, 'C')
+            else:
+                pdf.multi_cell(0, height, pdf_text(parts[0]), new_x="LMARGIN", new_y="NEXT")
+        elif kind == 'rule':
+            pdf.line(pdf.l_margin, pdf.get_y() + 1, pdf.w - pdf.r_margin, pdf.get_y() + 1)
+            pdf.ln(2)
+        elif kind == 'pair':
+            pdf.cell(layout['label_width'], height, pdf_text(parts[0]), 0, 0)
+            pdf.cell(0, height, pdf_text(parts[1]), 0, 1, 'R')
+        else:
+            last = len(layout['columns']) - 1
+            for i, (value, (width, align)) in enumerate(zip(parts, layout['columns'])):
+                pdf.cell(width, height, pdf_text(value), 0, 1 if i == last else 0, align)
+    
+    return bytes(pdf.output())
+
+def render_text_pdf(text, settings):
+    """Plain text document, used when a receipt has to go through the OS print queue"""
+    pdf = FPDF.FPDF()
+    pdf.add_page()
+    pdf.set_font("Courier", size=10)
+    
+    if settings.get('receipt_print_logo', False) and settings.get('store_logo') and os.path.exists(settings['store_logo']):
+        try:
+            pdf.image(settings['store_logo'], x=10, y=8, w=30)
+            pdf.ln(20)  # Move down after logo
+        except Exception:
+            pass
+    
+    for line in text.split('\n'):
+        pdf.cell(0, 5, pdf_text(line), 0, 1)
+    return bytes(pdf.output())
+
+def write_pdf_tempfile(pdf_data, prefix):
+    # Unique per call, so concurrent sessions never print each other's file
+    fd, path = tempfile.mkstemp(prefix=f"{prefix}_", suffix=".pdf")
+    with os.fdopen(fd, 'wb') as f:
+        f.write(pdf_data)
+    return path
+
+@st.cache_resource(show_spinner=False)
+def get_pdf_pool():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=PDF_WORKERS, thread_name_prefix="pdf")
+
+def render_pdfs(jobs):
+    """Render (file_name, template, context) jobs on the PDF pool, keeping their order"""
+    pool = get_pdf_pool()
+    futures = [(file_name, pool.submit(render_receipt_pdf, get_receipt_template(template), context))
+               for file_name, template, context in jobs]
+    return [(file_name, future.result()) for file_name, future in futures]
+
+def render_table_pdf(title, df):
+    """A4 landscape table, one column per DataFrame column"""
+    pdf = FPDF.FPDF(orientation='L', format='A4')
+    pdf.set_margins(10, 10, 10)
+    pdf.add_page()
+    pdf.set_font("Courier", 'B', 11)
+    pdf.cell(0, 6, pdf_text(title), 0, 1)
+    
+    table = df.reset_index() if df.index.name else df
+    column_width = (pdf.w - 20) / max(len(table.columns), 1)
+    max_chars = max(int(column_width / 1.6), 4)  # Courier 7pt is about 1.5mm per character
+    
+    pdf.set_font("Courier", 'B', 7)
+    for column in table.columns:
+        pdf.cell(column_width, 4, pdf_text(str(column)[:max_chars]), 1, 0)
+    pdf.ln()
+    pdf.set_font("Courier", size=7)
+    for row in table.itertuples(index=False):
+        for value in row:
+            text = f"{value:.2f}" if isinstance(value, float) else str(value)
+            pdf.cell(column_width, 4, pdf_text(text[:max_chars]), 1, 0)
+        pdf.ln()
+    return bytes(pdf.output())
+
+def zip_pdfs(rendered):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for file_name, pdf_data in rendered:
+            zf.writestr(file_name, pdf_data)
+    return buffer.getvalue()
+
+def sale_receipt_context(transaction, products=None):
+    products = products if products is not None else load_data(PRODUCTS_FILE)
+    context = dict(transaction)
+    context['lines'] = [
+        {'name': resolve_line_name(barcode, item, products), 'quantity': item['quantity'],
+         'amount': item['price'] * item['quantity']}
+        for barcode, item in transaction['items'].items()
+    ]
+    context['discount_amount'] = abs(transaction.get('discount', 0))
+    context['amount_due'] = transaction['total'] + transaction.get('payment_charge_amount', 0)
+    return context
+
+def outdoor_receipt_context(order_data):
+    context = dict(order_data)
+    context['lines'] = [
+        {'name': item['name'], 'quantity': item['quantity'], 'amount': item['price'] * item['quantity']}
+        for item in order_data['items'].values()
+    ]
+    context.setdefault('customer_phone', 'N/A')
+    context['status_label'] = order_data['status'].replace('_', ' ').title()
+    context['printed_at'] = get_current_datetime().strftime('%Y-%m-%d %H:%M:%S')
+    return context
+
+def return_receipt_context(return_data):
+    context = dict(return_data)
+    context['lines'] = [
+        {'name': item['name'], 'quantity': item['quantity'], 'amount': item['subtotal']}
+        for item in return_data['items'].values()
+    ]
+    context['subtotal_refund'] = return_data['total_refund'] - return_data['tax_refund']
+    return context
+
+def po_report_context(po, products):
+    context = dict(po)
+    context['lines'] = []
+    for item in po['items']:
+        product = products.get(item['barcode'], {'name': 'Unknown', 'cost': 0})
+        context['lines'].append({
+            'barcode': item['barcode'],
+            'name': product['name'],
+            'quantity': item['quantity'],
+            'unit_cost': product.get('cost', 0),
+            'amount': item['quantity'] * product.get('cost', 0)
+        })
+    context['status_label'] = po['status'].upper()
+    if po['status'] != 'received':
+        context['date_received'] = None
+    return context
+
+# Lane spool and reconciliation
+# Completed sales are appended to a local per-lane spool and merged into the
+# shared TRANSACTIONS_FILE/INVENTORY_FILE by a background reconciler, so a slow
+# or locked data directory never holds up checkout. Each batch of new sales is
+# noted in MERGE_JOURNAL_FILE before any shared file is written, and every store
+# it touches can take the batch again without counting a sale twice, so a pass
+# that dies part way finishes the batch on the next pass.
+SPOOL_BATCH_SIZE = 500
+SPOOL_RECONCILE_INTERVAL = 5  # seconds
+DATA_LOCK_STALE_SECONDS = 60  # a holder refreshes the lock well inside this
+INVENTORY_LOCK_TIMEOUT = 30  # seconds; a merge pass holds the lock for all pending batches
+
+def get_lane_id():
+    lane_id = os.environ.get('POS_LANE_ID') or platform.node() or 'lane'
+    return "".join(c if c.isalnum() or c in '-_' else '_' for c in lane_id)
+
+def get_spool_file(day=None):
+    day = day or get_current_datetime().date()
+    return os.path.join(SPOOL_DIR, f"lane_{get_lane_id()}_{day.strftime('%Y%m%d')}.jsonl")
+
+def spool_sale(transaction):
+    """Append a completed sale to this lane's spool with a single append write"""
+    line = (json.dumps(transaction) + "\n").encode('utf-8')
+    fd = os.open(get_spool_file(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def owns_lock_file(token):
+    try:
+        with open(DATA_LOCK_FILE, 'r') as f:
+            return f.read() == token
+    except OSError:
+        return False
+
+def refresh_lock_file(token, released):
+    """Touch the lock while it is held, so a long merge or report job is not taken
+    for a dead lane and broken"""
+    while not released.wait(DATA_LOCK_STALE_SECONDS / 4):
+        if owns_lock_file(token):
+            with contextlib.suppress(OSError):
+                os.utime(DATA_LOCK_FILE)
+
+@contextlib.contextmanager
+def data_dir_lock(timeout=2.0):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fd = os.open(DATA_LOCK_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                # A lane that died mid-merge must not block the others forever
+                if time.time() - os.path.getmtime(DATA_LOCK_FILE) > DATA_LOCK_STALE_SECONDS:
+                    os.remove(DATA_LOCK_FILE)
+                    continue
+            except OSError:
+                pass
+            if time.time() >= deadline:
+                raise TimeoutError("Shared data directory is locked")
+            time.sleep(0.05)
+    token = f"{get_lane_id()} {os.getpid()} {uuid.uuid4().hex}"
+    released = threading.Event()
+    heartbeat = threading.Thread(target=refresh_lock_file, args=(token, released), daemon=True)
+    try:
+        os.write(fd, token.encode('utf-8'))
+        os.close(fd)
+        heartbeat.start()
+        yield
+    finally:
+        released.set()
+        if heartbeat.is_alive():
+            heartbeat.join()
+        # Never remove a lock another lane took over
+        if owns_lock_file(token):
+            with contextlib.suppress(OSError):
+                os.remove(DATA_LOCK_FILE)
+
+@contextlib.contextmanager
+def locked_inventory(timeout=INVENTORY_LOCK_TIMEOUT):
+    """INVENTORY_FILE loaded under the data directory lock and saved when the block
+    completes, so an edit cannot overwrite sales the reconciler merged between the
+    load and the save. The lock is not reentrant; do not take it inside the block."""
+    with data_dir_lock(timeout):
+        inventory = load_data(INVENTORY_FILE)
+        yield inventory
+        save_data(inventory, INVENTORY_FILE)
+
+def decode_spool_line(raw):
+    """Decode one spooled sale. Returns (sale or None, torn).
+    A crash mid-write leaves a partial sale that the next write on that lane
+    continues on the same line; the complete sale at the tail is recovered."""
+    try:
+        return json.loads(raw), False
+    except ValueError:
+        pass
+    text = raw.decode('utf-8', errors='replace').rstrip()
+    decoder = json.JSONDecoder()
+    pos = text.find('{', 1)
+    while pos != -1:
+        try:
+            sale, end = decoder.raw_decode(text, pos)
+            if end == len(text) and isinstance(sale, dict) and 'transaction_id' in sale:
+                return sale, True
+        except ValueError:
+            pass
+        pos = text.find('{', pos + 1)
+    return None, True
+
+def read_spool_batch(spool_file, offset, limit=SPOOL_BATCH_SIZE, end=None):
+    """Returns (sales, new offset, conflicts for torn lines); end stops a re-read
+    of a journaled batch where that batch ended"""
+    sales = []
+    conflicts = []
+    with open(spool_file, 'rb') as f:
+        f.seek(offset)
+        for raw in f:
+            if not raw.endswith(b"\n") or (end is not None and offset >= end):
+                break  # sale still being written
+            line_offset = offset
+            offset += len(raw)
+            if not raw.strip():
+                continue
+            sale, torn = decode_spool_line(raw)
+            if torn:
+                conflicts.append({
+                    'type': 'torn_sale',
+                    'spool_file': os.path.basename(spool_file),
+                    'offset': line_offset,
+                    'transaction_id': sale['transaction_id'] if sale else None
+                })
+            if sale is not None:
+                sales.append(sale)
+            if len(sales) >= limit:
+                break
+    return sales, offset, conflicts
+
+def new_spooled_sales(sales, transactions):
+    """Spooled sales not merged yet. Returns (new sales, conflicts)"""
+    new_sales = {}
+    conflicts = []
+    for sale in sales:
+        transaction_id = sale['transaction_id']
+        existing = transactions.get(transaction_id) or new_sales.get(transaction_id)
+        if existing is not None:
+            # Replays of an already merged sale are expected after a crash;
+            # a different sale under the same id is not
+            if existing.get('lane_id') != sale.get('lane_id') or existing.get('date') != sale.get('date'):
+                conflicts.append({
+                    'type': 'duplicate_id',
+                    'transaction_id': transaction_id,
+                    'lane_id': sale.get('lane_id'),
+                    'date': sale.get('date')
+                })
+            continue
+        new_sales[transaction_id] = sale
+    return list(new_sales.values()), conflicts
+
+def apply_sales_to_inventory(sales, inventory):
+    """Take sold quantities off loaded stock. Returns (stock movements, conflicts)"""
+    movements = []
+    conflicts = []
+    for sale in sales:
+        transaction_id = sale['transaction_id']
+        stamp = {'date': sale['date'], 'ts': sale['ts'], 'tz': sale.get('tz')}
+        for barcode, item in sale['items'].items():
+            stock = inventory.setdefault(barcode, {'quantity': 0})
+            stock['quantity'] -= item['quantity']
+            movements.append(stock_movement(barcode, -item['quantity'], stock['quantity'], 'sale',
+                                            transaction_id, sale.get('cashier'), stamp=stamp))
+            if stock['quantity'] < 0:
+                conflicts.append({
+                    'type': 'negative_stock',
+                    'transaction_id': transaction_id,
+                    'lane_id': sale.get('lane_id'),
+                    'date': sale.get('date'),
+                    'barcode': barcode,
+                    'quantity': stock['quantity']
+                })
+    return movements, conflicts
+
+def record_sales_conflicts(conflicts):
+    """Conflict ids are derived from the conflict, so recording one again is a no-op"""
+    if not conflicts:
+        return
+    sales_conflicts = load_data(SALES_CONFLICTS_FILE)
+    for conflict in conflicts:
+        conflict_id = hashlib.sha1(json.dumps(conflict, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+        sales_conflicts.setdefault(conflict_id, dict(conflict, conflict_id=conflict_id, resolved=False))
+    save_data(sales_conflicts, SALES_CONFLICTS_FILE)
+
+def batch_posted(store, batch):
+    """True when an aggregate already holds a journaled batch: it was posted under the
+    batch key, or the aggregate was rebuilt from TRANSACTIONS_FILE after the batch was
+    saved there"""
+    if batch is None:
+        return False
+    return (store.get('merged_batches', {}).get(batch['lane_id']) == batch['key']
+            or store.get('rebuilt_ts', 0) > batch['saved_ts'])
+
+def mark_batch_posted(store, batch):
+    if batch is not None:
+        store.setdefault('merged_batches', {})[batch['lane_id']] = batch['key']
+
+def ledger_has_sales(since, transaction_ids):
+    """Whether sale movements for any of transaction_ids were appended past offset since"""
+    try:
+        with open(STOCK_LEDGER_FILE, 'rb') as f:
+            f.seek(since)
+            for raw in f:
+                try:
+                    movement = json.loads(raw)
+                except ValueError:
+                    continue
+                if movement.get('source') == 'sale' and movement.get('source_id') in transaction_ids:
+                    return True
+    except FileNotFoundError:
+        pass
+    return False
+
+def merge_spool_batch(batch, sales, transactions=None):
+    """Write a journaled batch of new sales to every shared store. Any step may have
+    run already: transactions are keyed by id, stock is swapped in from a staged copy
+    the journal tracks, the ledger is checked past its size before the append, and
+    each aggregate skips a batch it has posted."""
+    for sale in sales:
+        if sale.get('ts') is None:
+            # Spooled before lanes stamped epoch times
+            sale['ts'] = record_ts(sale)
+    
+    if transactions is None:
+        transactions = load_data(TRANSACTIONS_FILE)
+    for sale in sales:
+        transactions.setdefault(sale['transaction_id'], sale)
+    save_data(transactions, TRANSACTIONS_FILE)
+    if 'saved_ts' not in batch:
+        batch['saved_ts'] = time.time()
+        save_data(batch, MERGE_JOURNAL_FILE)
+    
+    # A staged copy still on disk after the journal noted it was never swapped in
+    staged_file = f"{INVENTORY_FILE}.{batch['lane_id']}.merging"
+    inventory = load_data(INVENTORY_FILE)
+    if batch.get('inventory') != 'staged' or os.path.exists(staged_file):
+        movements, conflicts = apply_sales_to_inventory(sales, inventory)
+        save_data(inventory, staged_file)
+        batch.update({
+            'inventory': 'staged',
+            'movements': movements,
+            'conflicts': conflicts,
+            'ledger_size': os.path.getsize(STOCK_LEDGER_FILE) if os.path.exists(STOCK_LEDGER_FILE) else 0
+        })
+        save_data(batch, MERGE_JOURNAL_FILE)
+        os.replace(staged_file, INVENTORY_FILE)
+    
+    record_sales_conflicts(batch['conflicts'])
+    if not ledger_has_sales(batch['ledger_size'], set(batch['transaction_ids'])):
+        record_stock_movements(batch['movements'])
+    update_sales_rollups(sales=sales, batch=batch)
+    update_sales_velocity(sales, batch)
+    update_customer_stats(sales, batch)
+    update_dashboard_counters(sales=sales, inventory=inventory, batch=batch)
+
+def prune_spool_files(offsets):
+    """Drop fully merged spools from before yesterday"""
+    cutoff = (get_current_datetime().date() - timedelta(days=1)).strftime('%Y%m%d')
+    for name in list(offsets):
+        path = os.path.join(SPOOL_DIR, name)
+        day = name.rsplit('_', 1)[-1].split('.')[0]
+        if day >= cutoff:
+            continue
+        if not os.path.exists(path):
+            del offsets[name]
+        elif offsets[name] >= os.path.getsize(path):
+            os.remove(path)
+            del offsets[name]
+
+def reconcile_lane_spool(lock_timeout=2.0):
+    """Merge pending spooled sales into the shared data files.
+    Returns the number of sales merged, or None if the data directory was busy."""
+    spool_files = sorted(f for f in os.listdir(SPOOL_DIR) if f.endswith('.jsonl'))
+    if not spool_files:
+        return 0
+    
+    try:
+        with data_dir_lock(lock_timeout):
+            offsets = load_data(SPOOL_OFFSETS_FILE)
+            merged_count = 0
+            
+            # A pass that died part way left its journal; that batch is finished first
+            batch = load_data(MERGE_JOURNAL_FILE)
+            if batch:
+                path = os.path.join(SPOOL_DIR, batch['spool_file'])
+                sales = read_spool_batch(path, batch['offset'], end=batch['end'])[0] if os.path.exists(path) else []
+                transaction_ids = set(batch['transaction_ids'])
+                sales = [sale for sale in sales if sale['transaction_id'] in transaction_ids]
+                merge_spool_batch(batch, sales)
+                merged_count += len(sales)
+                offsets[batch['spool_file']] = max(offsets.get(batch['spool_file'], 0), batch['end'])
+                save_data(offsets, SPOOL_OFFSETS_FILE)
+                os.remove(MERGE_JOURNAL_FILE)
+            
+            transactions = None
+            for name in spool_files:
+                path = os.path.join(SPOOL_DIR, name)
+                offset = offsets.get(name, 0)
+                while offset < os.path.getsize(path):
+                    sales, new_offset, torn = read_spool_batch(path, offset)
+                    if new_offset == offset:
+                        break
+                    record_sales_conflicts(torn)
+                    new_sales = []
+                    if sales:
+                        if transactions is None:
+                            transactions = load_data(TRANSACTIONS_FILE)
+                        new_sales, conflicts = new_spooled_sales(sales, transactions)
+                        record_sales_conflicts(conflicts)
+                    if new_sales:
+                        batch = {
+                            'key': f"{name}@{offset}",
+                            'lane_id': get_lane_id(),
+                            'spool_file': name,
+                            'offset': offset,
+                            'end': new_offset,
+                            'transaction_ids': [sale['transaction_id'] for sale in new_sales]
+                        }
+                        save_data(batch, MERGE_JOURNAL_FILE)
+                        merge_spool_batch(batch, new_sales, transactions)
+                        merged_count += len(new_sales)
+                    # The offset moves only once every store has the batch
+                    offset = new_offset
+                    offsets[name] = offset
+                    save_data(offsets, SPOOL_OFFSETS_FILE)
+                    if new_sales:
+                        os.remove(MERGE_JOURNAL_FILE)
+            
+            prune_spool_files(offsets)
+            save_data(offsets, SPOOL_OFFSETS_FILE)
+            return merged_count
+    except (TimeoutError, OSError):
+        return None
+
+def count_pending_spooled_sales():
+    offsets = load_data(SPOOL_OFFSETS_FILE)
+    pending = 0
+    for name in os.listdir(SPOOL_DIR):
+        if name.endswith('.jsonl'):
+            path = os.path.join(SPOOL_DIR, name)
+            offset = offsets.get(name, 0)
+            if offset < os.path.getsize(path):
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    pending += sum(1 for raw in f if raw.endswith(b"\n") and raw.strip())
+    return pending
+
+class SpoolReconciler:
+    def __init__(self, interval=SPOOL_RECONCILE_INTERVAL):
+        self.interval = interval
+        self.wake_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.last_result = None
+        self.last_run = 0
+        self.last_error = None
+    
+    def start(self):
+        self.thread.start()
+    
+    def wake(self):
+        self.wake_event.set()
+    
+    def run(self):
+        while True:
+            self.wake_event.wait(self.interval)
+            self.wake_event.clear()
+            try:
+                self.last_result = reconcile_lane_spool()
+                self.last_error = None
+            except Exception as e:
+                self.last_result = None
+                self.last_error = f"Lane sync failed: {str(e)}"
+                logger.exception("Lane spool reconcile failed")
+            self.last_run = time.time()
+            try:
+                refresh_customer_segments_if_due()
+            except Exception as e:
+                self.last_error = f"Customer segment refresh failed: {str(e)}"
+                logger.exception("Customer segment refresh failed")
+
+# One reconciler per server process, shared by every session on this lane.
+# main() starts it once the data files are initialized and migrated.
+@st.cache_resource(show_spinner=False)
+def get_spool_reconciler():
+    reconciler = SpoolReconciler()
+    reconciler.start()
+    return reconciler
+
+# Brand index
+# product['brand'] is the only record of which brand a product belongs to. The
+# index maps every barcode to a brand code once per catalog version, and the
+# brand -> barcodes lists used by the brand screens are derived from it.
+class BrandIndex:
+    __slots__ = ('brands', 'barcodes', 'codes', 'positions')
+
+    def __init__(self, products, brands_list=()):
+        self.barcodes = np.array(sorted(products), dtype=object)
+        self.brands = sorted({p.get('brand') for p in products.values() if p.get('brand')} | set(brands_list))
+        lookup = {brand: code for code, brand in enumerate(self.brands)}
+        self.codes = np.array([lookup.get(products[b].get('brand'), -1) for b in self.barcodes], dtype=np.int32)
+        self.positions = {barcode: i for i, barcode in enumerate(self.barcodes)}
+
+    def brand_of(self, barcode):
+        position = self.positions.get(barcode)
+        if position is None or self.codes[position] < 0:
+            return None
+        return self.brands[self.codes[position]]
+
+    def products_by_brand(self):
+        order = np.argsort(self.codes, kind='stable')
+        bounds = np.searchsorted(self.codes[order], np.arange(len(self.brands) + 1))
+        return {brand: self.barcodes[order[bounds[code]:bounds[code + 1]]].tolist()
+                for code, brand in enumerate(self.brands)}
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def _brand_index_for_version(version):
+    return BrandIndex(load_data(PRODUCTS_FILE), load_data(BRANDS_FILE).get('brands', []))
+
+def get_brand_index():
+    return _brand_index_for_version(get_data_version(PRODUCTS_FILE, BRANDS_FILE))
+
+def get_brand_products():
+    return get_brand_index().products_by_brand()
+
+# Sales rollups
+# Per-day and per-hour totals kept up to date as sales merge and returns are
+# processed, so time-based sales reports read a handful of rows instead of
+# every transaction. Buckets are keyed "YYYY-MM-DD" and "YYYY-MM-DD HH";
+# 'brand_daily' holds revenue, units and transactions per brand per day, by
+# the brand each product had when it sold. Money is summed in minor units;
+# 'money_places' records the scale.
+ROLLUP_MONEY_FIELDS = ('sales', 'tax', 'discount', 'refunds')
+
+def empty_rollup_bucket():
+    return {
+        'sales': 0,
+        'transactions': 0,
+        'tax': 0,
+        'discount': 0,
+        'payment_methods': {},
+        'refunds': 0,
+        'returns': 0
+    }
+
+def post_sale_to_rollups(rollups, transaction, brand_of=None):
+    date = transaction['date']
+    if brand_of is not None:
+        day_brands = rollups['brand_daily'].setdefault(date[:10], {})
+        sold_brands = set()
+        for barcode, item in transaction.get('items', {}).items():
+            brand = brand_of(barcode)
+            if not brand:
+                continue
+            bucket = day_brands.setdefault(brand, {'revenue': 0, 'units': 0, 'transactions': 0})
+            bucket['revenue'] += to_minor(item.get('price', 0)) * item.get('quantity', 0)
+            bucket['units'] += item.get('quantity', 0)
+            if brand not in sold_brands:
+                bucket['transactions'] += 1
+                sold_brands.add(brand)
+    for grain, key in (('daily', date[:10]), ('hourly', date[:13])):
+        bucket = rollups[grain].setdefault(key, empty_rollup_bucket())
+        total = to_minor(transaction.get('total', 0))
+        bucket['sales'] += total
+        bucket['transactions'] += 1
+        bucket['tax'] += to_minor(transaction.get('tax', 0))
+        bucket['discount'] += to_minor(transaction.get('discount', 0))
+        method = transaction.get('payment_method', 'N/A')
+        bucket['payment_methods'][method] = bucket['payment_methods'].get(method, 0) + total
+
+def post_return_to_rollups(rollups, return_record):
+    date = return_record['return_date']
+    for grain, key in (('daily', date[:10]), ('hourly', date[:13])):
+        bucket = rollups[grain].setdefault(key, empty_rollup_bucket())
+        bucket['refunds'] += to_minor(return_record.get('total_refund', 0))
+        bucket['returns'] += 1
+
+def rebuild_sales_rollups():
+    rollups = {'daily': {}, 'hourly': {}, 'brand_daily': {}, 'money_places': get_money_places(),
+               'rebuilt_ts': time.time()}
+    brand_of = get_brand_index().brand_of
+    for transaction in load_data(TRANSACTIONS_FILE).values():
+        if transaction.get('date'):
+            post_sale_to_rollups(rollups, transaction, brand_of)
+    for return_record in load_data(RETURNS_FILE).values():
+        if return_record.get('return_date'):
+            post_return_to_rollups(rollups, return_record)
+    save_data(rollups, SALES_ROLLUPS_FILE)
+    return rollups
+
+def sales_rollups_current(rollups):
+    # Missing on first use of an existing store, or the currency scale changed
+    return 'brand_daily' in rollups and rollups.get('money_places') == get_money_places()
+
+def load_sales_rollups():
+    rollups = load_data(SALES_ROLLUPS_FILE)
+    if not sales_rollups_current(rollups):
+        rollups = rebuild_sales_rollups()
+    return rollups
+
+def update_sales_rollups(sales=(), returns=(), batch=None):
+    """Post sales and returns already saved to their files. A rebuild reads them
+    from those files, so nothing is posted on top of it."""
+    rollups = load_data(SALES_ROLLUPS_FILE)
+    if not sales_rollups_current(rollups):
+        rebuild_sales_rollups()
+        return
+    if batch_posted(rollups, batch):
+        return
+    brand_of = get_brand_index().brand_of if sales else None
+    for transaction in sales:
+        post_sale_to_rollups(rollups, transaction, brand_of)
+    for return_record in returns:
+        post_return_to_rollups(rollups, return_record)
+    mark_batch_posted(rollups, batch)
+    save_data(rollups, SALES_ROLLUPS_FILE)
+
+def sales_rollup_frame(rollups, grain, start_date, end_date):
+    """Rollup buckets in [start_date, end_date] as a DataFrame indexed by bucket key,
+    money in minor units"""
+    start_key = start_date.strftime("%Y-%m-%d")
+    end_key = end_date.strftime("%Y-%m-%d")
+    rows = {key: bucket for key, bucket in rollups[grain].items() if start_key <= key[:10] <= end_key}
+    report_df = pd.DataFrame.from_dict(rows, orient='index')
+    if not report_df.empty:
+        report_df = report_df.sort_index()
+        report_df[list(ROLLUP_MONEY_FIELDS)] = report_df[list(ROLLUP_MONEY_FIELDS)].astype(np.int64)
+        report_df['net_sales'] = report_df['sales'] - report_df['refunds']
+    return report_df
+
+def brand_sales_frame(start_date, end_date, brands=None):
+    """Revenue, units and transactions per brand in [start_date, end_date], from the rollups"""
+    start_key = start_date.strftime("%Y-%m-%d")
+    end_key = end_date.strftime("%Y-%m-%d")
+    rows = [(brand, bucket['revenue'], bucket['units'], bucket['transactions'])
+            for key, day_brands in load_sales_rollups()['brand_daily'].items() if start_key <= key <= end_key
+            for brand, bucket in day_brands.items()]
+    sales_df = pd.DataFrame(rows, columns=['brand', 'revenue', 'units', 'transactions']).astype(
+        {'revenue': np.int64, 'units': np.int64, 'transactions': np.int64}).groupby('brand').sum()
+    if brands is not None:
+        sales_df = sales_df.reindex(brands, fill_value=0)
+    return money_columns_to_units(sales_df, ['revenue'])
+
+def money_columns_to_units(df, columns, places=None):
+    """Minor-unit columns of an aggregated frame converted to currency amounts for display"""
+    places = get_money_places() if places is None else places
+    df = df.copy()
+    for column in columns:
+        if column in df.columns:
+            df[column] = df[column] / 10 ** places
+    return df
+
+# Sales velocity
+# Units sold per SKU per day over the last VELOCITY_WINDOW_DAYS days, and the
+# time each SKU last sold, kept up to date as sales merge. Rolling 7/30/90-day
+# units are sums over those day buckets; buckets that fall out of the window
+# are dropped on every update.
+VELOCITY_WINDOWS = (7, 30, 90)
+VELOCITY_WINDOW_DAYS = max(VELOCITY_WINDOWS)
+
+def post_sale_to_velocity(velocity, transaction):
+    day_units = velocity['daily'].setdefault(transaction['date'][:10], {})
+    ts = record_ts(transaction)
+    for barcode, item in transaction.get('items', {}).items():
+        day_units[barcode] = day_units.get(barcode, 0) + item.get('quantity', 0)
+        if ts is not None and ts > velocity['last_sold'].get(barcode, 0):
+            velocity['last_sold'][barcode] = ts
+
+def prune_sales_velocity(velocity):
+    cutoff = (get_current_datetime().date() - timedelta(days=VELOCITY_WINDOW_DAYS - 1)).strftime("%Y-%m-%d")
+    velocity['daily'] = {day: units for day, units in velocity['daily'].items() if day >= cutoff}
+
+def rebuild_sales_velocity():
+    velocity = {'daily': {}, 'last_sold': {}, 'rebuilt_ts': time.time()}
+    for transaction in load_data(TRANSACTIONS_FILE).values():
+        if transaction.get('date'):
+            post_sale_to_velocity(velocity, transaction)
+    prune_sales_velocity(velocity)
+    save_data(velocity, SALES_VELOCITY_FILE)
+    return velocity
+
+def load_sales_velocity():
+    velocity = load_data(SALES_VELOCITY_FILE)
+    if 'last_sold' not in velocity:
+        velocity = rebuild_sales_velocity()
+    return velocity
+
+def update_sales_velocity(sales, batch=None):
+    """Post sales already saved to TRANSACTIONS_FILE; a rebuild reads them from there"""
+    velocity = load_data(SALES_VELOCITY_FILE)
+    if 'last_sold' not in velocity:
+        rebuild_sales_velocity()
+        return
+    if batch_posted(velocity, batch):
+        return
+    for transaction in sales:
+        post_sale_to_velocity(velocity, transaction)
+    prune_sales_velocity(velocity)
+    mark_batch_posted(velocity, batch)
+    save_data(velocity, SALES_VELOCITY_FILE)
+
+def sales_velocity_frame(barcodes, velocity=None):
+    """Rolling units per window ('units_7d', ...) and 'last_sold' ts for barcodes,
+    summed over all day buckets at once"""
+    velocity = velocity or load_sales_velocity()
+    index = pd.Index(barcodes)
+    frame = pd.DataFrame(index=index)
+    rows = [(day, barcode, units) for day, day_units in velocity['daily'].items()
+            for barcode, units in day_units.items()]
+    days, sold, units = zip(*rows) if rows else ((), (), ())
+    positions = index.get_indexer(list(sold))
+    units = np.asarray(units, dtype=np.int64)
+    today = np.datetime64(get_current_datetime().date(), 'D')
+    age = (today - np.asarray(days, dtype='datetime64[D]')).astype(np.int64)
+    for window in VELOCITY_WINDOWS:
+        mask = (positions >= 0) & (age < window)
+        frame[f'units_{window}d'] = np.bincount(positions[mask], weights=units[mask],
+                                                minlength=len(index)).astype(np.int64)
+    frame['last_sold'] = pd.Series(velocity['last_sold'], dtype=float).reindex(index).to_numpy()
+    return frame
+
+def slow_moving_frame(cover_days=90):
+    """Items in stock ranked by capital tied up, with days of cover at the 30-day
+    sales rate. 'Dead' had no sales in 90 days; 'Slow' has more than cover_days
+    of stock. Capital is in minor units."""
+    snapshot = get_inventory_snapshot()
+    snapshot = snapshot[snapshot['quantity'] > 0]
+    frame = sales_velocity_frame(snapshot['barcode'])
+    frame['product'] = snapshot['name'].to_numpy()
+    frame['category'] = snapshot['category'].to_numpy()
+    quantity = snapshot['quantity'].to_numpy()
+    frame['quantity'] = quantity
+    frame['capital'] = snapshot['stock_value'].to_numpy()
+    
+    daily_rate = frame['units_30d'].to_numpy() / 30
+    with np.errstate(divide='ignore'):
+        cover = np.where(daily_rate > 0, quantity / np.where(daily_rate > 0, daily_rate, 1), np.inf)
+    frame['days_of_cover'] = np.round(cover, 1)
+    now = get_current_datetime().timestamp()
+    frame['days_since_sold'] = np.floor((now - frame['last_sold'].to_numpy()) / 86400)
+    frame['status'] = np.select([frame['units_90d'].to_numpy() == 0, cover > cover_days], ['Dead', 'Slow'], 'Moving')
+    
+    frame = frame[frame['status'] != 'Moving']
+    frame = frame.drop(columns='last_sold').rename_axis('barcode').reset_index()
+    return frame.sort_values(['capital', 'days_of_cover'], ascending=False, ignore_index=True)
+
+# Customer aggregates
+# Running totals per customer for sales that carry a customer_id: lifetime spend
+# and visits, first and last purchase time, and per-month buckets
+# "YYYY-MM" -> {'spend', 'visits', 'last_ts'}. Kept up to date as sales merge, so
+# customer reports read one row per customer and month instead of every sale.
+# Spend is in minor units; 'money_places' records the scale.
+def post_sale_to_customer_stats(stats, transaction):
+    customer_id = transaction.get('customer_id')
+    ts = record_ts(transaction)
+    if not customer_id or ts is None:
+        return
+    spend = to_minor(transaction.get('total', 0))
+    customer = stats['customers'].setdefault(customer_id, {
+        'spend': 0, 'visits': 0, 'first_ts': ts, 'last_ts': ts, 'monthly': {}
+    })
+    customer['spend'] += spend
+    customer['visits'] += 1
+    customer['first_ts'] = min(customer['first_ts'], ts)
+    customer['last_ts'] = max(customer['last_ts'], ts)
+    month = customer['monthly'].setdefault(transaction['date'][:7], {'spend': 0, 'visits': 0, 'last_ts': ts})
+    month['spend'] += spend
+    month['visits'] += 1
+    month['last_ts'] = max(month['last_ts'], ts)
+
+def rebuild_customer_stats():
+    stats = {'customers': {}, 'money_places': get_money_places(), 'rebuilt_ts': time.time()}
+    for transaction in load_data(TRANSACTIONS_FILE).values():
+        if transaction.get('date'):
+            post_sale_to_customer_stats(stats, transaction)
+    save_data(stats, CUSTOMER_STATS_FILE)
+    return stats
+
+def customer_stats_current(stats):
+    return 'customers' in stats and stats.get('money_places') == get_money_places()
+
+def load_customer_stats():
+    stats = load_data(CUSTOMER_STATS_FILE)
+    if not customer_stats_current(stats):
+        stats = rebuild_customer_stats()
+    return stats
+
+def update_customer_stats(sales, batch=None):
+    """Post sales already saved to TRANSACTIONS_FILE; a rebuild reads them from there"""
+    sales = [t for t in sales if t.get('customer_id')]
+    if not sales:
+        return
+    stats = load_data(CUSTOMER_STATS_FILE)
+    if not customer_stats_current(stats):
+        rebuild_customer_stats()
+        return
+    if batch_posted(stats, batch):
+        return
+    for transaction in sales:
+        post_sale_to_customer_stats(stats, transaction)
+    mark_batch_posted(stats, batch)
+    save_data(stats, CUSTOMER_STATS_FILE)
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def _customer_month_frame_for_version(version):
+    customers = load_customer_stats()['customers']
+    rows = [(customer_id, month, bucket['spend'], bucket['visits'], bucket['last_ts'])
+            for customer_id, customer in customers.items()
+            for month, bucket in customer['monthly'].items()]
+    frame = pd.DataFrame(rows, columns=['customer_id', 'month', 'spend', 'visits', 'last_ts'])
+    frame = frame.astype({'customer_id': 'category', 'spend': np.int64, 'visits': np.int64, 'last_ts': np.int64})
+    # A customer is new in the month of their first purchase
+    frame['first_month'] = frame.groupby('customer_id', observed=True)['month'].transform('min')
+    return frame
+
+def get_customer_month_frame():
+    """One row per customer and month with spend (minor units), visits, last_ts and
+    the customer's first_month. Shared until CUSTOMER_STATS_FILE changes; callers
+    must not modify it in place."""
+    return _customer_month_frame_for_version(get_data_version(CUSTOMER_STATS_FILE))
+
+def customer_months_in_range(start_date, end_date):
+    frame = get_customer_month_frame()
+    months = frame['month']
+    return frame[(months >= start_date.strftime("%Y-%m")) & (months <= end_date.strftime("%Y-%m"))]
+
+def customer_spending_frame(start_date, end_date):
+    """Transactions, spend (minor units) and last purchase ts per customer for the
+    months spanned by [start_date, end_date]"""
+    return customer_months_in_range(start_date, end_date).groupby('customer_id', observed=True).agg(
+        transactions=('visits', 'sum'), total_spent=('spend', 'sum'), last_ts=('last_ts', 'max'))
+
+def new_vs_returning_frame(start_date, end_date):
+    """Per month: customers buying for the first time and returning customers, with
+    their visits and spend (minor units)"""
+    frame = customer_months_in_range(start_date, end_date)
+    kind = np.where(frame['month'] == frame['first_month'], 'new', 'returning')
+    summary = frame.assign(kind=kind).pivot_table(
+        index='month', columns='kind', values=['customer_id', 'visits', 'spend'],
+        aggfunc={'customer_id': 'count', 'visits': 'sum', 'spend': 'sum'}, fill_value=0
+    )
+    summary.columns = [f"{kind}_{'customers' if value == 'customer_id' else value}" for value, kind in summary.columns]
+    columns = [f"{kind}_{value}" for kind in ('new', 'returning') for value in ('customers', 'visits', 'spend')]
+    return summary.reindex(columns=columns, fill_value=0).astype(np.int64)
+
+# Customer segments
+# RFM scoring of every loyalty customer from the customer x month frame: recency
+# (latest purchase), frequency (visits) and monetary (spend) are each ranked
+# among customers who have bought and scored 1-5 by quintile. The segment and
+# the "RFM" score string per customer id go to CUSTOMER_RFM_FILE, never onto the
+# loyalty records, which checkout and loyalty management save without the data
+# lock; a summary with the refresh date goes to CUSTOMER_SEGMENTS_FILE. Segments
+# refresh on the first reconciler pass of each day, or on demand as a report job.
+RFM_BINS = 5
+RFM_SEGMENTS = [
+    "Champions", "New Customers", "Loyal Customers", "Potential Loyalists",
+    "Can't Lose Them", "At Risk", "Hibernating", "Lost", "No Purchases"
+]
+
+def quantile_scores(values, mask, bins=RFM_BINS):
+    """1..bins by percentile rank among values[mask], ties sharing a score; 0 elsewhere"""
+    scores = np.zeros(len(values), dtype=np.int64)
+    if mask.any():
+        pct = pd.Series(values[mask]).rank(method='average', pct=True).to_numpy()
+        scores[mask] = np.ceil(pct * bins).astype(np.int64)
+    return scores
+
+def compute_rfm_segments(customer_ids, month_frame, now_ts):
+    """RFM values, scores and segment per customer id, in one pass over month_frame"""
+    index = pd.Index(customer_ids)
+    count = len(index)
+    customer_col = month_frame['customer_id']
+    positions = index.get_indexer(customer_col.cat.categories)[customer_col.cat.codes.to_numpy()]
+    known = positions >= 0
+    positions = positions[known]
+    
+    frequency = np.bincount(positions, weights=month_frame['visits'].to_numpy()[known],
+                            minlength=count).astype(np.int64)
+    monetary = np.bincount(positions, weights=month_frame['spend'].to_numpy()[known],
+                           minlength=count).astype(np.int64)
+    last_ts = np.zeros(count, dtype=np.int64)
+    np.maximum.at(last_ts, positions, month_frame['last_ts'].to_numpy()[known])
+    
+    buyers = frequency > 0
+    r = quantile_scores(last_ts, buyers)
+    f = quantile_scores(frequency, buyers)
+    m = quantile_scores(monetary, buyers)
+    fm = (f + m) / 2
+    segment = np.select([
+        ~buyers,
+        (r >= 4) & (fm >= 4),
+        (r >= 4) & (frequency == 1),
+        (r >= 3) & (fm >= 3),
+        r >= 3,
+        fm >= 4,
+        fm >= 3,
+        r == 2
+    ], ["No Purchases", "Champions", "New Customers", "Loyal Customers", "Potential Loyalists",
+        "Can't Lose Them", "At Risk", "Hibernating"], "Lost")
+    
+    return pd.DataFrame({
+        'recency_days': np.where(buyers, (now_ts - last_ts) // 86400, -1),
+        'frequency': frequency,
+        'monetary': monetary,
+        'r': r,
+        'f': f,
+        'm': m,
+        'segment': segment
+    }, index=index.rename('customer_id'))
+
+def refresh_customer_segments():
+    """Score all loyalty customers, store their segments and return the scores"""
+    customers = load_data(LOYALTY_FILE).get('customers', {})
+    rfm = compute_rfm_segments(list(customers), get_customer_month_frame(), int(time.time()))
+    scores = rfm['r'].astype(str) + rfm['f'].astype(str) + rfm['m'].astype(str)
+    save_data({customer_id: {'segment': segment, 'rfm': score}
+               for customer_id, segment, score in zip(rfm.index, rfm['segment'], scores)}, CUSTOMER_RFM_FILE)
+    save_data({
+        'date': get_current_datetime().strftime("%Y-%m-%d"),
+        'refreshed': get_current_datetime().strftime(DATETIME_FORMAT),
+        'customers': len(rfm),
+        'counts': {k: int(v) for k, v in rfm['segment'].value_counts().items()}
+    }, CUSTOMER_SEGMENTS_FILE)
+    return rfm
+
+def refresh_customer_segments_if_due():
+    today = get_current_datetime().strftime("%Y-%m-%d")
+    if load_data(CUSTOMER_SEGMENTS_FILE).get('date') == today:
+        return
+    with data_dir_lock():
+        # Another lane may have refreshed while this one waited
+        if load_data(CUSTOMER_SEGMENTS_FILE).get('date') != today:
+            refresh_customer_segments()
+
+# Dashboard counters
+# Running figures for the landing page: today's sales and transaction count, the
+# low-stock count and a bounded list of the most recent sales. Sales are posted
+# as they merge. The low-stock count is stamped with the inventory file version
+# it was taken from, so stock written anywhere else triggers one recount. The file
+# is only written under data_dir_lock; the dashboard refreshes a stale copy in
+# memory and writes it back only when the lock is free.
+RECENT_TRANSACTIONS_SIZE = 20
+
+def is_low_stock(item):
+    return item.get('quantity', 0) < item.get('reorder_point', 10)
+
+def inventory_stamp():
+    version = get_data_version(INVENTORY_FILE)[0]
+    return list(version) if version else None
+
+def recount_low_stock(counters, inventory):
+    counters['low_stock'] = sum(1 for item in inventory.values() if is_low_stock(item))
+    counters['inventory_version'] = inventory_stamp()
+
+def recent_transaction_entry(transaction):
+    return {
+        'transaction_id': transaction.get('transaction_id', 'N/A'),
+        'date': transaction.get('date', 'N/A'),
+        'total': transaction.get('total', 0),
+        'cashier': transaction.get('cashier', 'N/A')
+    }
+
+def roll_dashboard_day(counters):
+    today = get_current_datetime().strftime("%Y-%m-%d")
+    if counters.get('date') != today:
+        counters.update({'date': today, 'today_sales': 0, 'today_transactions': 0})
+
+def post_sale_to_counters(counters, transaction):
+    if transaction['date'][:10] == counters['date']:
+        counters['today_sales'] += to_minor(transaction.get('total', 0))
+        counters['today_transactions'] += 1
+
+def build_dashboard_counters():
+    counters = {'money_places': get_money_places(), 'rebuilt_ts': time.time()}
+    roll_dashboard_day(counters)
+    dated = [t for t in load_data(TRANSACTIONS_FILE).values() if t.get('date')]
+    for transaction in dated:
+        post_sale_to_counters(counters, transaction)
+    recent = sorted(dated, key=lambda t: t['date'])[-RECENT_TRANSACTIONS_SIZE:]
+    counters['recent'] = [recent_transaction_entry(t) for t in recent]
+    recount_low_stock(counters, load_data(INVENTORY_FILE))
+    return counters
+
+def refresh_dashboard_counters(counters):
+    """Bring stored counters up to date in memory; returns (counters, changed)"""
+    if 'recent' not in counters or counters.get('money_places') != get_money_places():
+        return build_dashboard_counters(), True
+    roll_dashboard_day(counters)
+    if counters.get('inventory_version') != inventory_stamp():
+        recount_low_stock(counters, load_data(INVENTORY_FILE))
+        return counters, True
+    return counters, False
+
+def load_dashboard_counters():
+    counters, changed = refresh_dashboard_counters(load_data(DASHBOARD_COUNTERS_FILE))
+    if changed:
+        try:
+            with data_dir_lock(timeout=0.5):
+                # Re-read under the lock so sales merged since the first read are kept
+                counters, changed = refresh_dashboard_counters(load_data(DASHBOARD_COUNTERS_FILE))
+                if changed:
+                    save_data(counters, DASHBOARD_COUNTERS_FILE)
+        except TimeoutError:
+            pass  # A merge holds the lock and saves its own counters; show the in-memory copy
+    return counters
+
+def update_dashboard_counters(sales=(), inventory=None, batch=None):
+    """Post merged sales; pass the inventory just saved to refresh the low-stock count.
+    The caller holds data_dir_lock."""
+    counters = load_data(DASHBOARD_COUNTERS_FILE)
+    if 'recent' not in counters or counters.get('money_places') != get_money_places():
+        save_data(build_dashboard_counters(), DASHBOARD_COUNTERS_FILE)
+        return
+    if batch_posted(counters, batch):
+        return
+    roll_dashboard_day(counters)
+    for transaction in sales:
+        post_sale_to_counters(counters, transaction)
+    if sales:
+        recent = counters['recent'] + [recent_transaction_entry(t) for t in sales]
+        recent.sort(key=lambda entry: entry['date'])
+        counters['recent'] = recent[-RECENT_TRANSACTIONS_SIZE:]
+    if inventory is not None:
+        recount_low_stock(counters, inventory)
+    mark_batch_posted(counters, batch)
+    save_data(counters, DASHBOARD_COUNTERS_FILE)
+
+# Stock movement ledger
+# Every change to an on-hand quantity is appended to STOCK_LEDGER_FILE as one
+# JSON line: when (date/ts/tz), barcode, delta, the balance it left, the source
+# type and id that caused it, and the user. The file is never rewritten. It is
+# read incrementally into columns indexed by product and by time, so a stock
+# level at any moment is the sum of the deltas before it.
+STOCK_MOVEMENT_SOURCES = {
+    'opening': "Opening Balance",
+    'sale': "Sale",
+    'delivery': "Outdoor Delivery",
+    'return': "Return",
+    'receipt': "PO Receipt",
+    'adjustment': "Adjustment",
+    'product': "Product Edit",
+    'import': "Bulk Import",
+    'bulk_update': "Bulk Update",
+    'delete': "Product Deleted"
+}
+STOCK_LEDGER_COLUMNS = ['date', 'ts', 'barcode', 'delta', 'balance', 'source', 'source_id', 'user', 'note']
+
+def stock_movement(barcode, delta, balance, source, source_id=None, user=None, note=None, stamp=None):
+    """One ledger row; stamp is {'date', 'ts', 'tz'}, now if not given"""
+    movement = dict(stamp or timestamp_fields())
+    movement.update({
+        'barcode': barcode,
+        'delta': int(delta),
+        'balance': int(balance),
+        'source': source,
+        'source_id': source_id,
+        'user': user
+    })
+    if note:
+        movement['note'] = note
+    return movement
+
+def record_stock_movements(movements):
+    """Append movements to the ledger with a single append write"""
+    movements = [m for m in movements if m['delta']]
+    if movements:
+        append_json_lines(STOCK_LEDGER_FILE, movements)
+
+def migrate_stock_ledger():
+    """Carry current stock into the ledger as opening balances and move the
+    per-item 'adjustments' lists out of INVENTORY_FILE"""
+    inventory = load_data(INVENTORY_FILE)
+    tz = get_store_timezone()
+    movements = []
+    for barcode, item in inventory.items():
+        adjustments = item.pop('adjustments', [])
+        stamps = epoch_seconds([a.get('date') for a in adjustments], tz)
+        history = 0
+        for adjustment, ts in zip(adjustments, stamps):
+            if ts is None:
+                continue
+            delta = adjustment.get('new_qty', 0) - adjustment.get('previous_qty', 0)
+            history += delta
+            movements.append(stock_movement(
+                barcode, delta, adjustment.get('new_qty', 0), 'adjustment',
+                source_id=adjustment.get('type'), user=adjustment.get('user'),
+                note=adjustment.get('notes'), stamp={'date': adjustment['date'], 'ts': ts, 'tz': tz.zone}
+            ))
+        # History before the ledger is incomplete; the opening row makes the
+        # deltas add up to the quantity on hand from here on
+        movements.append(stock_movement(barcode, item.get('quantity', 0) - history,
+                                        item.get('quantity', 0), 'opening', user='system'))
+    record_stock_movements(movements)
+    save_data(inventory, INVENTORY_FILE)
+
+class StockLedger:
+    """Columns of STOCK_LEDGER_FILE, extended with only the lines appended since
+    the last read. Rows are ordered by ts; product_rows maps each barcode to its
+    row numbers in that order."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        self.offset = 0
+        self.last_line = (0, b"")
+        self.pending = []
+        self.frame = pd.DataFrame({c: pd.Series(dtype=object) for c in STOCK_LEDGER_COLUMNS})
+        self.frame[['ts', 'delta', 'balance']] = self.frame[['ts', 'delta', 'balance']].astype(np.int64)
+        self.product_rows = {}
+    
+    def still_appended(self):
+        """False once the file was replaced or truncated, e.g. by a restore"""
+        start, line = self.last_line
+        try:
+            with open(STOCK_LEDGER_FILE, 'rb') as f:
+                f.seek(start)
+                return f.read(len(line)) == line
+        except OSError:
+            return False
+    
+    def refresh(self):
+        try:
+            size = os.path.getsize(STOCK_LEDGER_FILE)
+        except OSError:
+            size = 0
+        if size < self.offset or (self.offset and size and not self.still_appended()):
+            self.reset()
+        if size == self.offset:
+            return
+        rows = []
+        with open(STOCK_LEDGER_FILE, 'rb') as f:
+            f.seek(self.offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break  # movement still being written
+                self.last_line = (self.offset, raw)
+                self.offset += len(raw)
+                try:
+                    row = json.loads(raw)
+                except ValueError:
+                    continue
+                if row.get('ts') is not None:
+                    rows.append(row)
+        if rows:
+            self.extend(pd.DataFrame(rows, columns=STOCK_LEDGER_COLUMNS))
+    
+    def extend(self, rows):
+        rows[['ts', 'delta', 'balance']] = rows[['ts', 'delta', 'balance']].fillna(0).astype(np.int64)
+        frame = pd.concat([self.frame, rows], ignore_index=True)
+        # Merged sales carry the time they rang up, which may be before
+        # movements already written; a stable sort keeps append order on ties
+        self.frame = frame.iloc[np.argsort(frame['ts'].to_numpy(), kind='stable')].reset_index(drop=True)
+        codes, barcodes = pd.factorize(self.frame['barcode'])
+        by_product = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[by_product], np.arange(len(barcodes) + 1))
+        self.product_rows = {barcode: by_product[bounds[i]:bounds[i + 1]] for i, barcode in enumerate(barcodes)}
+    
+    def movements(self, barcode=None, start_ts=None, end_ts=None):
+        """Rows in time order; for one barcode, 'level' is the stock after each row"""
+        with self.lock:
+            self.refresh()
+            frame = self.frame
+            if barcode is not None:
+                frame = frame.iloc[self.product_rows.get(barcode, [])].copy()
+                frame['level'] = frame['delta'].cumsum()
+            ts = frame['ts'].to_numpy()
+            lo = np.searchsorted(ts, start_ts) if start_ts is not None else 0
+            hi = np.searchsorted(ts, end_ts) if end_ts is not None else len(ts)
+            return frame.iloc[lo:hi]
+    
+    def stock_at(self, ts):
+        """Quantity on hand per barcode just before ts"""
+        with self.lock:
+            self.refresh()
+            frame = self.frame.iloc[:np.searchsorted(self.frame['ts'].to_numpy(), ts)]
+            return frame.groupby('barcode', sort=False)['delta'].sum()
+    
+    def start_ts(self):
+        """Time from which levels are complete: the opening balances, if any"""
+        with self.lock:
+            self.refresh()
+            opening = self.frame['ts'][self.frame['source'] == 'opening']
+            ts = opening if len(opening) else self.frame['ts']
+            return int(ts.iloc[0]) if len(ts) else None
+
+# One ledger reader per server process, shared by every session
+@st.cache_resource(show_spinner=False)
+def get_stock_ledger():
+    return StockLedger()
+
+def stock_movement_frame(movements, products):
+    """Ledger rows for display: product names, source labels, newest first"""
+    frame = pd.DataFrame({
+        'Date': movements['date'],
+        'Product': movements['barcode'].map(lambda b: products.get(b, {}).get('name', 'Unknown')),
+        'Barcode': movements['barcode'],
+        'Change': movements['delta'],
+        'Balance': movements['balance'],
+        'Source': movements['source'].map(lambda s: STOCK_MOVEMENT_SOURCES.get(s, s)),
+        'Reference': movements['source_id'],
+        'User': movements['user'],
+        'Note': movements['note']
+    })
+    return frame.iloc[::-1].reset_index(drop=True)
+
+def stock_movement_view(products, key):
+    """Daily net movement by source over a date range, per product or overall,
+    and stock on hand as of a chosen day"""
+    ledger = get_stock_ledger()
+    first_ts = ledger.start_ts()
+    if first_ts is None:
+        st.info("No stock movements recorded yet")
+        return
+    tz = get_store_timezone()
+    # Stock levels are only complete from the first opening balance on
+    first_day = datetime.datetime.fromtimestamp(first_ts, tz).date()
+    today = get_current_datetime().date()
+    
+    product_options = {f"{v['name']} ({k})": k for k, v in products.items()}
+    selected_product = st.selectbox("Product", ["All Products"] + list(product_options.keys()),
+                                    key=f"{key}_product")
+    barcode = product_options.get(selected_product)
+    col1, col2 = st.columns(2)
+    with col1:
+        start_date = st.date_input("Start Date", value=today - timedelta(days=30), key=f"{key}_start")
+    with col2:
+        end_date = st.date_input("End Date", value=today, key=f"{key}_end")
+    
+    start_ts, end_ts = day_bounds(start_date, end_date)
+    movements = ledger.movements(barcode, start_ts, end_ts)
+    if movements.empty:
+        st.info("No stock movements in this period")
+    else:
+        days = pd.to_datetime(movements['ts'], unit='s', utc=True).dt.tz_convert(tz).dt.date
+        daily = movements.assign(day=days).pivot_table(
+            index='day', columns='source', values='delta', aggfunc='sum', fill_value=0
+        ).rename(columns=STOCK_MOVEMENT_SOURCES)
+        st.subheader("Net Movement by Day")
+        st.bar_chart(daily)
+        if barcode is not None:
+            st.subheader("Stock Level")
+            st.line_chart(pd.DataFrame({
+                'Stock': movements['level'].to_numpy()
+            }, index=pd.to_datetime(movements['ts'], unit='s', utc=True).dt.tz_convert(tz)))
+        st.dataframe(stock_movement_frame(movements, products))
+    
+    st.subheader("Stock On Hand As Of")
+    as_of = st.date_input("End of Day", value=today, min_value=first_day, key=f"{key}_as_of")
+    levels = ledger.stock_at(day_bounds(as_of)[1])
+    if barcode is not None:
+        st.metric("Quantity", int(levels.get(barcode, 0)))
+    elif not levels.empty:
+        st.dataframe(pd.DataFrame({
+            'Product': [products.get(b, {}).get('name', 'Unknown') for b in levels.index],
+            'Barcode': levels.index,
+            'Quantity': levels.to_numpy()
+        }).sort_values('Product'))
+
+# Sales line items
+# Transactions flattened once into columnar frames (one row per sale, one row
+# per line item) and kept until the underlying files change. Catalog fields
+# are joined per distinct barcode through categorical codes rather than per
+# line. Money columns (total, tax, discount, price, revenue) are int64 minor
+# units. The cached frames are shared; callers must not modify them in place.
+def get_data_version(*files):
+    version = []
+    for file in files:
+        try:
+            stat = os.stat(file)
+            version.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+def repeat_categorical(column, positions):
+    return pd.Categorical.from_codes(column.cat.codes.to_numpy()[positions], column.cat.categories)
+
+def build_sales_frames(transactions, products):
+    tx_values = [t for t in transactions.values() if t.get('date')]
+    sales_df = pd.DataFrame({
+        'transaction_id': [t.get('transaction_id', 'N/A') for t in tx_values],
+        'date': pd.to_datetime([t['date'] for t in tx_values], format="%Y-%m-%d %H:%M:%S", errors='coerce'),
+        'total': to_minor_array(np.fromiter((t.get('total', 0) for t in tx_values), dtype=float, count=len(tx_values))),
+        'tax': to_minor_array(np.fromiter((t.get('tax', 0) for t in tx_values), dtype=float, count=len(tx_values))),
+        'discount': to_minor_array(np.fromiter((t.get('discount', 0) for t in tx_values), dtype=float,
+                                               count=len(tx_values))),
+        'cashier': pd.Categorical([t.get('cashier', 'N/A') for t in tx_values]),
+        'payment_method': pd.Categorical([t.get('payment_method', 'N/A') for t in tx_values]),
+        'customer_id': pd.Categorical([t.get('customer_id') or 'Walk-in' for t in tx_values])
+    })
+    
+    item_dicts = [t.get('items') or {} for t in tx_values]
+    counts = np.fromiter((len(items) for items in item_dicts), dtype=np.int64, count=len(item_dicts))
+    lines = list(itertools.chain.from_iterable(items.values() for items in item_dicts))
+    tx_pos = np.repeat(np.arange(len(tx_values)), counts)
+    
+    barcode = pd.Categorical(list(itertools.chain.from_iterable(item_dicts)))
+    catalog = [products.get(b, {}) for b in barcode.categories]
+    def from_catalog(field, default):
+        values = np.array([p.get(field) or default for p in catalog] + [default], dtype=object)
+        return pd.Categorical(values[barcode.codes])
+    
+    quantity = np.fromiter((line.get('quantity', 0) for line in lines), dtype=float, count=len(lines))
+    price = to_minor_array(np.fromiter((line.get('price', 0) for line in lines), dtype=float, count=len(lines)))
+    line_items_df = pd.DataFrame({
+        'transaction_id': sales_df['transaction_id'].to_numpy()[tx_pos],
+        'date': sales_df['date'].to_numpy()[tx_pos],
+        'cashier': repeat_categorical(sales_df['cashier'], tx_pos),
+        'payment_method': repeat_categorical(sales_df['payment_method'], tx_pos),
+        'customer_id': repeat_categorical(sales_df['customer_id'], tx_pos),
+        'barcode': barcode,
+        'name': from_catalog('name', 'Unknown'),
+        'category': from_catalog('category', 'Unknown'),
+        'brand': from_catalog('brand', 'Unknown'),
+        'quantity': quantity,
+        'price': price,
+        'revenue': np.rint(quantity * price).astype(np.int64)
+    })
+    return sales_df, line_items_df
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def _sales_frames_for_version(version):
+    return build_sales_frames(load_data(TRANSACTIONS_FILE), load_data(PRODUCTS_FILE))
+
+def get_sales_frames():
+    return _sales_frames_for_version(get_data_version(TRANSACTIONS_FILE, PRODUCTS_FILE))
+
+def filter_by_date(df, start_date, end_date, column='date'):
+    start = pd.Timestamp(start_date)
+    end = pd.Timestamp(end_date) + pd.Timedelta(days=1)
+    return df[(df[column] >= start) & (df[column] < end)]
+
+# Report cache
+# Computed report tables keyed by report name, parameters and the version of
+# the data files they read, so an edit to any of those files invalidates the
+# entry on its own. Least recently used entries go once the budget is spent.
+REPORT_CACHE_BUDGET = 128 * 1024 * 1024  # bytes
+
+def estimate_report_size(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_report_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_report_size(v) for v in value)
+    return sys.getsizeof(value)
+
+class ReportCache:
+    def __init__(self, budget=REPORT_CACHE_BUDGET):
+        self.budget = budget
+        self.entries = collections.OrderedDict()  # key -> (value, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def _drop(self, key):
+        _, size = self.entries.pop(key)
+        self.size -= size
+    
+    def get_or_compute(self, name, params, files, compute):
+        version = get_data_version(*files)
+        key = (name, params, version)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            # Older versions of the same report can never be served again
+            for stale in [k for k in self.entries if k[0] == name and k[1] == params]:
+                self._drop(stale)
+        
+        value = compute()
+        size = estimate_report_size(value)
+        with self.lock:
+            if size <= self.budget:
+                if key in self.entries:
+                    self._drop(key)
+                self.entries[key] = (value, size)
+                self.size += size
+                while self.size > self.budget:
+                    self._drop(next(iter(self.entries)))
+        return value
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+@st.cache_resource(show_spinner=False)
+def get_report_cache():
+    return ReportCache()
+
+def cached_report(name, params, files, compute):
+    return get_report_cache().get_or_compute(name, params, files, compute)
+
+# Query engine
+# Custom reports are plain dicts, saved in CUSTOM_REPORTS_FILE:
+#   {'name', 'source', 'start_date', 'end_date', 'date_grain',
+#    'filters': [{'field', 'op', 'value'}], 'group_by': [...],
+#    'measures': [{'field', 'agg'}], 'limit'}
+# Dated sources are split into monthly partitions; the date range selects
+# partitions first and filters run per partition before anything is joined.
+QUERY_SOURCES = {
+    'sales': {
+        'label': "Transactions",
+        'files': (TRANSACTIONS_FILE, PRODUCTS_FILE),
+        'dimensions': {'date': 'date', 'cashier': 'cashier', 'payment method': 'payment_method',
+                       'customer': 'customer_id'},
+        'fields': ['total', 'tax', 'discount', 'transaction_id']
+    },
+    'line_items': {
+        'label': "Line Items",
+        'files': (TRANSACTIONS_FILE, PRODUCTS_FILE),
+        'dimensions': {'date': 'date', 'product': 'name', 'barcode': 'barcode', 'category': 'category',
+                       'brand': 'brand', 'cashier': 'cashier', 'payment method': 'payment_method',
+                       'customer': 'customer_id'},
+        'fields': ['revenue', 'quantity', 'price', 'transaction_id']
+    },
+    'returns': {
+        'label': "Returns",
+        'files': (RETURNS_FILE, PRODUCTS_FILE),
+        'dimensions': {'date': 'date', 'product': 'name', 'barcode': 'barcode', 'category': 'category',
+                       'brand': 'brand', 'cashier': 'cashier', 'reason': 'reason',
+                       'refund method': 'refund_method', 'customer': 'customer_id'},
+        'fields': ['refund', 'quantity', 'return_id']
+    },
+    'inventory': {
+        'label': "Inventory",
+        'files': (INVENTORY_FILE, PRODUCTS_FILE),
+        'dimensions': {'product': 'name', 'barcode': 'barcode', 'category': 'category', 'brand': 'brand',
+                       'supplier': 'supplier'},
+        'fields': ['quantity', 'reorder_point', 'needed', 'stock_value', 'cost', 'price', 'barcode']
+    },
+    'loyalty': {
+        'label': "Loyalty Customers",
+        'files': (LOYALTY_FILE,),
+        'dimensions': {'customer': 'name', 'tier': 'tier'},
+        'fields': ['points', 'customer_id']
+    }
+}
+QUERY_AGGREGATES = {'sum': 'sum', 'count': 'count', 'avg': 'mean', 'distinct': 'nunique', 'min': 'min', 'max': 'max'}
+QUERY_OPERATORS = ['=', '!=', 'in', 'contains', '>', '>=', '<', '<=']
+QUERY_DATE_GRAINS = {'hour': 'h', 'day': 'D', 'week': 'W', 'month': 'M'}
+QUERY_MONEY_FIELDS = {'total', 'tax', 'discount', 'price', 'revenue', 'refund', 'cost', 'stock_value'}
+
+def build_returns_frame(returns_data, products):
+    rows = [
+        (r['return_date'], r['return_id'], r.get('transaction_id'), barcode, item.get('quantity', 0),
+         item.get('subtotal', 0), item.get('reason', r.get('reason', 'N/A')), r.get('refund_method', 'N/A'),
+         r.get('processed_by', 'N/A'), r.get('customer_id') or 'Walk-in')
+        for r in returns_data.values() for barcode, item in r.get('items', {}).items()
+    ]
+    df = pd.DataFrame(rows, columns=['date', 'return_id', 'transaction_id', 'barcode', 'quantity', 'refund',
+                                     'reason', 'refund_method', 'cashier', 'customer_id'])
+    df['date'] = pd.to_datetime(df['date'], format="%Y-%m-%d %H:%M:%S", errors='coerce')
+    df['refund'] = to_minor_array(df['refund'])
+    catalog = {b: products.get(b, {}) for b in df['barcode'].unique()}
+    for field, default in (('name', 'Unknown'), ('category', 'Unknown'), ('brand', 'Unknown')):
+        df[field] = df['barcode'].map({b: p.get(field) or default for b, p in catalog.items()}).astype('category')
+    return df
+
+def build_inventory_frame(inventory, products):
+    barcodes = list(inventory.keys())
+    df = pd.DataFrame({
+        'barcode': barcodes,
+        'quantity': np.array([inventory[b].get('quantity', 0) for b in barcodes], dtype=np.int64),
+        'reorder_point': np.array([inventory[b].get('reorder_point', 10) for b in barcodes], dtype=np.int64),
+        'daily_forecast': np.array([inventory[b].get('daily_forecast', 0) for b in barcodes], dtype=float),
+        'last_updated': [inventory[b].get('last_updated', 'N/A') for b in barcodes],
+        'name': [products.get(b, {}).get('name', 'Unknown') for b in barcodes],
+        'category': pd.Categorical([products.get(b, {}).get('category') or 'Unknown' for b in barcodes]),
+        'brand': pd.Categorical([products.get(b, {}).get('brand') or 'Unknown' for b in barcodes]),
+        'supplier': pd.Categorical([products.get(b, {}).get('supplier') or 'Unknown' for b in barcodes]),
+        'cost': to_minor_array([float(products.get(b, {}).get('cost', 0) or 0) for b in barcodes]),
+        'price': to_minor_array([float(products.get(b, {}).get('price', 0) or 0) for b in barcodes])
+    })
+    df['stock_value'] = df['quantity'] * df['cost']
+    df['low_stock'] = df['quantity'] < df['reorder_point']
+    df['needed'] = np.maximum(df['reorder_point'] - df['quantity'], 0)
+    return df
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def _inventory_snapshot_for_version(version):
+    return build_inventory_frame(load_data(INVENTORY_FILE), load_data(PRODUCTS_FILE))
+
+def get_inventory_snapshot():
+    """Inventory joined with catalog cost, price and category, one row per stocked
+    barcode; cost, price and stock_value in minor units. Shared until either file
+    changes; callers must not modify it in place."""
+    return _inventory_snapshot_for_version(get_data_version(INVENTORY_FILE, PRODUCTS_FILE))
+
+def stock_levels_frame(snapshot):
+    return pd.DataFrame({
+        'product': snapshot['name'],
+        'barcode': snapshot['barcode'],
+        'quantity': snapshot['quantity'],
+        'reorder_point': snapshot['reorder_point'],
+        'status': np.where(snapshot['low_stock'], 'Low Stock', 'OK')
+    })
+
+def stock_value_frame(snapshot):
+    """Stock value per item, highest first, in currency units"""
+    value_df = pd.DataFrame({
+        'product': snapshot['name'],
+        'barcode': snapshot['barcode'],
+        'quantity': snapshot['quantity'],
+        'unit_cost': snapshot['cost'],
+        'total_value': snapshot['stock_value']
+    }).sort_values('total_value', ascending=False)
+    return money_columns_to_units(value_df, ['unit_cost', 'total_value'])
+
+def low_stock_frame(snapshot):
+    """Items below their reorder point with the quantity and cost to bring them back up"""
+    low = snapshot[snapshot['low_stock']]
+    low_df = pd.DataFrame({
+        'Product': low['name'],
+        'Barcode': low['barcode'],
+        'Current Stock': low['quantity'],
+        'Reorder Point': low['reorder_point'],
+        'Needed': low['needed'],
+        'Cost': low['cost'],
+        'Value Needed': low['needed'] * low['cost']
+    }).sort_values('Needed', ascending=False)
+    return money_columns_to_units(low_df, ['Cost', 'Value Needed'])
+
+def build_loyalty_frame(loyalty):
+    customers = loyalty.get('customers', {})
+    return pd.DataFrame({
+        'customer_id': list(customers.keys()),
+        'name': [c.get('name', 'Unknown') for c in customers.values()],
+        'tier': pd.Categorical([c.get('tier') or 'None' for c in customers.values()]),
+        'points': [c.get('points', 0) for c in customers.values()]
+    })
+
+def partition_by_month(df):
+    if df.empty:
+        return {}
+    months = df['date'].dt.to_period('M')
+    return {str(month): part for month, part in df.groupby(months, sort=True)}
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _query_source_data(source, version):
+    """Monthly partitions for dated sources, a single frame otherwise"""
+    if source in ('sales', 'line_items'):
+        sales_frame, line_items_frame = get_sales_frames()
+        return partition_by_month(sales_frame if source == 'sales' else line_items_frame)
+    if source == 'returns':
+        return partition_by_month(build_returns_frame(load_data(RETURNS_FILE), load_data(PRODUCTS_FILE)))
+    if source == 'inventory':
+        return get_inventory_snapshot()
+    return build_loyalty_frame(load_data(LOYALTY_FILE))
+
+def query_filter_mask(df, query_filter):
+    column = df[query_filter['field']]
+    op = query_filter['op']
+    value = query_filter['value']
+    if op == 'in':
+        values = [v.strip() for v in str(value).split(',')] if not isinstance(value, list) else value
+        return column.astype(str).isin(values)
+    if op == 'contains':
+        return column.astype(str).str.contains(str(value), case=False, na=False, regex=False)
+    if query_filter['field'] in QUERY_MONEY_FIELDS and op not in ('in', 'contains'):
+        value = to_minor(value)  # entered in currency units, stored in minor units
+    if op in ('=', '!='):
+        if pd.api.types.is_numeric_dtype(column):
+            value = float(value)
+        else:
+            column = column.astype(str)
+            value = str(value)
+        return column == value if op == '=' else column != value
+    value = pd.Timestamp(value) if pd.api.types.is_datetime64_any_dtype(column) else float(value)
+    return {'>': column > value, '>=': column >= value, '<': column < value, '<=': column <= value}[op]
+
+def run_query(query):
+    source = QUERY_SOURCES[query['source']]
+    data = _query_source_data(query['source'], get_data_version(*source['files']))
+    filters = [f for f in query.get('filters', []) if f.get('field') and f.get('value') not in (None, '')]
+    
+    def apply_filters(df):
+        for query_filter in filters:
+            df = df[query_filter_mask(df, query_filter)]
+        return df
+    
+    if isinstance(data, dict):
+        start = pd.Timestamp(query['start_date']) if query.get('start_date') else None
+        end = pd.Timestamp(query['end_date']) + pd.Timedelta(days=1) if query.get('end_date') else None
+        start_month = str(start.to_period('M')) if start is not None else None
+        end_month = str((end - pd.Timedelta(days=1)).to_period('M')) if end is not None else None
+        parts = []
+        for month, part in data.items():
+            # Whole partitions outside the range are never touched
+            if (start_month and month < start_month) or (end_month and month > end_month):
+                continue
+            if start is not None and month == start_month:
+                part = part[part['date'] >= start]
+            if end is not None and month == end_month:
+                part = part[part['date'] < end]
+            part = apply_filters(part)
+            if not part.empty:
+                parts.append(part)
+        if not parts:
+            return pd.DataFrame()
+        df = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+    else:
+        df = apply_filters(data)
+    
+    if df.empty:
+        return pd.DataFrame()
+    
+    measures = query.get('measures') or [{'field': source['fields'][0], 'agg': 'count'}]
+    named = {f"{m['agg']}_{m['field']}": (m['field'], QUERY_AGGREGATES[m['agg']]) for m in measures}
+    money = [name for name, (field, agg) in named.items()
+             if field in QUERY_MONEY_FIELDS and agg not in ('count', 'nunique')]
+    
+    keys = []
+    for dimension in query.get('group_by', []):
+        column = source['dimensions'][dimension]
+        if column == 'date':
+            grain = query.get('date_grain') or 'day'
+            keys.append(df['date'].dt.to_period(QUERY_DATE_GRAINS[grain]).astype(str).rename(grain))
+        else:
+            keys.append(df[column].rename(dimension))
+    
+    if not keys:
+        return money_columns_to_units(
+            pd.DataFrame({name: [df[field].agg(agg)] for name, (field, agg) in named.items()}), money)
+    
+    result = money_columns_to_units(df.groupby(keys, observed=True, sort=True).agg(**named), money)
+    if query.get('sort_by') in result.columns:
+        result = result.sort_values(query['sort_by'], ascending=False)
+    if query.get('limit'):
+        result = result.head(int(query['limit']))
+    return result
+
+def save_custom_report(query):
+    saved = load_data(CUSTOM_REPORTS_FILE)
+    report_id = query.get('report_id') or generate_short_id()
+    saved[report_id] = {**query, 'report_id': report_id}
+    save_data(saved, CUSTOM_REPORTS_FILE)
+    return report_id
+
+def delete_custom_report(report_id):
+    saved = load_data(CUSTOM_REPORTS_FILE)
+    if saved.pop(report_id, None) is not None:
+        save_data(saved, CUSTOM_REPORTS_FILE)
+
+# Streaming exports
+# Exports are written chunk by chunk from generators into a temp file, which is
+# then handed to st.download_button, so a large export is never held as one
+# DataFrame plus one CSV string.
+EXPORT_CHUNK_ROWS = 50000
+EXPORT_DIR = os.path.join(tempfile.gettempdir(), "pos_exports")
+EXPORT_MAX_AGE = 3600  # seconds
+EXCEL_MAX_ROWS = 1048575  # per sheet, excluding the header
+EXPORT_FORMATS = {
+    'CSV': (".csv", "text/csv"),
+    'Excel': (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    'Parquet': (".parquet", "application/octet-stream")
+}
+
+def iter_frame_chunks(df, rows=EXPORT_CHUNK_ROWS):
+    if df.index.name or isinstance(df.index, pd.MultiIndex):
+        df = df.reset_index()
+    for start in range(0, len(df), rows):
+        yield df.iloc[start:start + rows]
+
+def iter_line_item_chunks(transactions, products, start_date=None, end_date=None, rows=EXPORT_CHUNK_ROWS):
+    columns = ['transaction_id', 'date', 'cashier', 'payment_method', 'barcode', 'name', 'category',
+               'brand', 'quantity', 'price', 'revenue']
+    start = str(start_date) if start_date else None
+    end = str(end_date) if end_date else None
+    batch = []
+    for t in transactions.values():
+        day = t.get('date', '')[:10]
+        if (start and day < start) or (end and day > end):
+            continue
+        for barcode, item in t.get('items', {}).items():
+            product = products.get(barcode, {})
+            quantity = item.get('quantity', 0)
+            price = item.get('price', 0)
+            batch.append((t.get('transaction_id'), t.get('date'), t.get('cashier', 'N/A'),
+                          t.get('payment_method', 'N/A'), barcode, item.get('name', product.get('name', 'Unknown')),
+                          product.get('category', 'Unknown'), product.get('brand', 'Unknown'),
+                          quantity, price, quantity * price))
+            if len(batch) >= rows:
+                yield pd.DataFrame(batch, columns=columns)
+                batch = []
+    if batch:
+        yield pd.DataFrame(batch, columns=columns)
+
+def write_csv_chunks(chunks, path):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        for i, chunk in enumerate(chunks):
+            chunk.to_csv(f, header=i == 0, index=False)
+
+def write_excel_chunks(chunks, path):
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = None
+    sheet_rows = 0
+    for chunk in chunks:
+        for row in chunk.itertuples(index=False, name=None):
+            if sheet is None or sheet_rows == EXCEL_MAX_ROWS:
+                sheet = workbook.create_sheet(f"Sheet{len(workbook.worksheets) + 1}")
+                sheet.append(list(chunk.columns))
+                sheet_rows = 0
+            sheet.append(row)
+            sheet_rows += 1
+    if sheet is None:
+        workbook.create_sheet("Sheet1")
+    workbook.save(path)
+
+def write_parquet_chunks(chunks, path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    writer = None
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+def prune_exports():
+    cutoff = time.time() - EXPORT_MAX_AGE
+    for entry in os.scandir(EXPORT_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass  # Still being served or already removed
+
+def write_export(chunks, fmt='CSV', prefix="export"):
+    """Write an iterable of DataFrame chunks to a temp file and return its path"""
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    prune_exports()
+    fd, path = tempfile.mkstemp(prefix=f"{prefix}_", suffix=EXPORT_FORMATS[fmt][0], dir=EXPORT_DIR)
+    os.close(fd)
+    writers = {'CSV': write_csv_chunks, 'Excel': write_excel_chunks, 'Parquet': write_parquet_chunks}
+    try:
+        writers[fmt](chunks, path)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+def export_download(label, make_chunks, file_name, key):
+    """Format picker plus a button that streams make_chunks() into a download"""
+    fmt = st.selectbox("Export Format", list(EXPORT_FORMATS.keys()), key=f"{key}_format")
+    if st.button(label, key=key):
+        try:
+            path = write_export(make_chunks(), fmt, prefix=file_name)
+        except ImportError as e:
+            st.error(f"{fmt} export is not available on this server: {e}")
+            return
+        suffix, mime = EXPORT_FORMATS[fmt]
+        with open(path, 'rb') as f:
+            st.download_button(
+                label=f"Download {fmt}",
+                data=f,
+                file_name=f"{file_name}{suffix}",
+                mime=mime,
+                key=f"{key}_download"
+            )
+
+# Market basket mining
+# Frequent item pairs and triples over sales line items, as bundle candidates.
+# Baskets are encoded sparsely as sorted (basket, item) code pairs; items below
+# the minimum support are dropped before any combination is formed, and
+# combinations are generated and counted a block of baskets at a time, so memory
+# follows the block size and the number of distinct frequent itemsets rather
+# than the number of baskets.
+BASKET_BLOCK_ITEMS = 1_000_000  # basket entries per counting block
+MAX_BASKET_ITEMS = 30  # baskets with more frequent items (bulk orders) are left out of combinations
+
+def later_positions(last, ends):
+    """For tuples ending at positions `last`, each later position in the same basket:
+    (tuple row, position)"""
+    counts = ends - last - 1
+    rows = np.repeat(np.arange(len(last)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return rows, np.repeat(last, counts) + 1 + offsets
+
+def add_counts(keys, counts, new_keys):
+    """Merge counted itemset keys with a block of new occurrences"""
+    new_keys, new_counts = np.unique(new_keys, return_counts=True)
+    keys, inverse = np.unique(np.concatenate([keys, new_keys]), return_inverse=True)
+    return keys, np.bincount(inverse, weights=np.concatenate([counts, new_counts])).astype(np.int64)
+
+def basket_ends(baskets):
+    """End position of each entry's basket in a basket-sorted array, and basket sizes"""
+    starts = np.flatnonzero(np.r_[True, baskets[1:] != baskets[:-1]]) if len(baskets) else np.array([], dtype=np.int64)
+    sizes = np.diff(np.r_[starts, len(baskets)])
+    return np.repeat(starts + sizes, sizes), sizes
+
+def encode_baskets(line_items):
+    """Sorted unique (basket, item) codes and the barcodes behind item codes"""
+    baskets = pd.factorize(line_items['transaction_id'])[0].astype(np.int64)
+    barcode = line_items['barcode'].astype('category')
+    items = barcode.cat.codes.to_numpy().astype(np.int64)
+    pairs = np.unique(baskets * len(barcode.cat.categories) + items)
+    return pairs // len(barcode.cat.categories), pairs % len(barcode.cat.categories), barcode.cat.categories
+
+def mine_bundles(line_items, min_support=0.01, min_lift=1.0, max_size=3):
+    """Itemsets of 2..max_size items bought together in at least min_support of baskets,
+    with support, lift (observed over expected if bought independently) and confidence
+    (share of the least common item's baskets that hold the whole set)"""
+    columns = ['barcodes', 'size', 'baskets', 'support', 'lift', 'confidence']
+    if line_items.empty:
+        return pd.DataFrame(columns=columns)
+    baskets, items, barcodes = encode_baskets(line_items)
+    basket_count = int(baskets.max()) + 1
+    min_count = max(2, int(np.ceil(min_support * basket_count)))
+    
+    item_counts = np.bincount(items, minlength=len(barcodes))
+    frequent = np.flatnonzero(item_counts >= min_count)
+    remap = np.full(len(barcodes), -1, dtype=np.int64)
+    remap[frequent] = np.arange(len(frequent))
+    keep = remap[items] >= 0
+    baskets, items = baskets[keep], remap[items[keep]]
+    k = len(frequent)
+    
+    # Oversized baskets are dropped from combinations
+    _, sizes = basket_ends(baskets)
+    small = np.repeat(sizes <= MAX_BASKET_ITEMS, sizes)
+    baskets, items = baskets[small], items[small]
+    ends, _ = basket_ends(baskets)
+    
+    # Block boundaries fall between baskets
+    block_starts = [0]
+    while block_starts[-1] + BASKET_BLOCK_ITEMS < len(items):
+        block_starts.append(int(ends[block_starts[-1] + BASKET_BLOCK_ITEMS - 1]))
+    block_starts.append(len(items))
+    
+    pair_keys, pair_counts = np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    for lo, hi in zip(block_starts[:-1], block_starts[1:]):
+        first, second = later_positions(np.arange(lo, hi), ends[lo:hi])
+        first += lo
+        pair_keys, pair_counts = add_counts(pair_keys, pair_counts, items[first] * k + items[second])
+    frequent_pairs = pair_keys[pair_counts >= min_count]
+    
+    triple_keys, triple_counts = np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    if max_size >= 3 and len(frequent_pairs):
+        for lo, hi in zip(block_starts[:-1], block_starts[1:]):
+            first, second = later_positions(np.arange(lo, hi), ends[lo:hi])
+            first += lo
+            # Only extend pairs that are frequent themselves
+            kept = np.isin(items[first] * k + items[second], frequent_pairs)
+            first, second = first[kept], second[kept]
+            rows, third = later_positions(second, ends[second])
+            keys = (items[first[rows]] * k + items[second[rows]]) * k + items[third]
+            triple_keys, triple_counts = add_counts(triple_keys, triple_counts, keys)
+    
+    found = []
+    for size, keys, counts in ((2, pair_keys, pair_counts), (3, triple_keys, triple_counts)):
+        mask = counts >= min_count
+        keys, counts = keys[mask], counts[mask]
+        members = np.stack([keys // k ** (size - 1 - i) % k for i in range(size)], axis=1)
+        if size == 3:
+            # Every pair inside a frequent triple must be frequent
+            mask = np.isin(members[:, 0] * k + members[:, 2], frequent_pairs) & \
+                   np.isin(members[:, 1] * k + members[:, 2], frequent_pairs)
+            members, counts = members[mask], counts[mask]
+        member_counts = item_counts[frequent[members]]
+        support = counts / basket_count
+        expected = np.prod(member_counts / basket_count, axis=1)
+        found.append(pd.DataFrame({
+            'barcodes': [" + ".join(barcodes[frequent[m]]) for m in members],
+            'size': size,
+            'baskets': counts,
+            'support': support,
+            'lift': support / expected,
+            'confidence': counts / member_counts.min(axis=1)
+        }, columns=columns))
+    
+    result = pd.concat(found, ignore_index=True)
+    result = result[result['lift'] >= min_lift]
+    return result.sort_values(['lift', 'support'], ascending=False, ignore_index=True)
+
+def run_basket_mining_job(params, progress):
+    progress(0.1, "Loading line items")
+    _, line_items = get_sales_frames()
+    line_items = filter_by_date(line_items, datetime.date.fromisoformat(params['start_date']),
+                                datetime.date.fromisoformat(params['end_date']))
+    progress(0.3, f"Mining {line_items['transaction_id'].nunique()} baskets")
+    bundles = mine_bundles(line_items, params['min_support'], params['min_lift'])
+    products = load_data(PRODUCTS_FILE)
+    bundles.insert(1, 'products', [" + ".join(products.get(b, {}).get('name', 'Unknown') for b in codes.split(" + "))
+                                   for codes in bundles['barcodes']])
+    return bundles.head(params.get('limit', 200))
+
+# Demand forecasting
+# Reorder points from a SKU x day matrix of units sold, built from the sales
+# line items. Daily demand is smoothed exponentially with every SKU advanced one
+# day at a time; the smoothed level is the daily forecast and the smoothed
+# squared error its variance. A reorder point covers the forecast over the
+# supplier's lead time plus safety stock for the service level. Suggestions run
+# as a report job and are accepted into inventory from the Reorder Forecast tab.
+FORECAST_HISTORY_DAYS = 180
+FORECAST_ALPHA = 0.1
+FORECAST_SERVICE_LEVELS = {90: 1.28, 95: 1.65, 98: 2.05, 99: 2.33}  # service level % -> z
+DEFAULT_LEAD_TIME_DAYS = 7
+
+def daily_demand_matrix(line_items, barcodes, end_date, days):
+    """Units sold per barcode (rows) per day (columns) over the days up to end_date"""
+    start = np.datetime64(end_date, 'D') - (days - 1)
+    day = (line_items['date'].to_numpy().astype('datetime64[D]') - start).astype(np.int64)
+    sold = line_items['barcode'].array
+    positions = pd.Index(barcodes).get_indexer(sold.categories)
+    sku = np.where(sold.codes >= 0, positions[sold.codes], -1)
+    mask = (sku >= 0) & (day >= 0) & (day < days)
+    demand = np.bincount(sku[mask] * days + day[mask], weights=line_items['quantity'].to_numpy()[mask],
+                         minlength=len(barcodes) * days)
+    return demand.reshape(len(barcodes), days)
+
+def smooth_demand(demand, alpha=FORECAST_ALPHA):
+    """Exponentially smoothed daily level and variance for each row"""
+    level = demand.mean(axis=1)
+    variance = demand.var(axis=1)
+    for day in range(demand.shape[1]):
+        error = demand[:, day] - level
+        variance = (1 - alpha) * (variance + alpha * error ** 2)
+        level += alpha * error
+    return level, variance
+
+def supplier_lead_times(supplier_names):
+    suppliers = load_data(SUPPLIERS_FILE)
+    lead_times = {s['name']: s.get('lead_time_days') or DEFAULT_LEAD_TIME_DAYS for s in suppliers.values()}
+    by_supplier = np.array([lead_times.get(name, DEFAULT_LEAD_TIME_DAYS) for name in supplier_names.cat.categories],
+                           dtype=float)
+    return by_supplier[supplier_names.cat.codes.to_numpy()]
+
+def reorder_suggestions(service_level=95, history_days=FORECAST_HISTORY_DAYS):
+    """Forecast and suggested reorder point for every stocked barcode, from sales up
+    to yesterday"""
+    snapshot = get_inventory_snapshot()
+    _, line_items = get_sales_frames()
+    end_date = get_current_datetime().date() - timedelta(days=1)
+    demand = daily_demand_matrix(line_items, snapshot['barcode'], end_date, history_days)
+    forecast, variance = smooth_demand(demand)
+    lead_time = supplier_lead_times(snapshot['supplier'])
+    safety_stock = np.ceil(FORECAST_SERVICE_LEVELS[service_level] * np.sqrt(variance * lead_time))
+    suggested = np.ceil(forecast * lead_time + safety_stock - 1e-9).astype(np.int64)
+    return pd.DataFrame({
+        'barcode': snapshot['barcode'],
+        'product': snapshot['name'],
+        'supplier': snapshot['supplier'],
+        'lead_time_days': lead_time.astype(np.int64),
+        'units_sold': demand.sum(axis=1).astype(np.int64),
+        'daily_forecast': forecast.round(2),
+        'safety_stock': safety_stock.astype(np.int64),
+        'quantity': snapshot['quantity'],
+        'reorder_point': snapshot['reorder_point'],
+        'suggested_reorder_point': suggested
+    })
+
+def run_reorder_forecast_job(params, progress):
+    progress(0.1, "Forecasting demand")
+    return reorder_suggestions(params['service_level'], params['history_days'])
+
+def accept_reorder_suggestions(suggestions, user):
+    """Write suggested reorder points, safety stock and forecasts into inventory in
+    one save; returns the number of items updated"""
+    updated_at = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+    updated = 0
+    with locked_inventory() as inventory:
+        for row in suggestions.itertuples(index=False):
+            item = inventory.get(row.barcode)
+            if item is None:
+                continue
+            item['reorder_point'] = int(row.suggested_reorder_point)
+            item['safety_stock'] = int(row.safety_stock)
+            item['daily_forecast'] = float(row.daily_forecast)
+            item['last_updated'] = updated_at
+            item['updated_by'] = user
+            updated += 1
+    return updated
+
+# Auto replenishment
+# Items below their reorder point are grouped by supplier into draft purchase
+# orders. Each is ordered up to its reorder point plus the forecast demand over
+# the supplier's lead time, less what is on hand and what open orders have still
+# to deliver. Open quantities per barcode come from an index over the open POs,
+# rebuilt only when the PO index changes.
+OPEN_PO_STATUSES = ('draft', 'pending', 'partially_received')
+
+def build_open_po_index(purchase_orders):
+    """barcode -> quantity ordered on the given open POs and not yet received"""
+    open_quantities = collections.Counter()
+    for po in purchase_orders:
+        for item in po.get('items', []):
+            open_quantities[item['barcode']] += max(item['quantity'] - item.get('received', 0), 0)
+    return dict(open_quantities)
+
+def load_open_purchase_orders():
+    store = get_po_store()
+    return [po for po in (store.get(s['po_id']) for s in store.list(OPEN_PO_STATUSES)) if po]
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def _open_po_index_for_version(version):
+    return build_open_po_index(load_open_purchase_orders())
+
+def get_open_po_quantities():
+    return _open_po_index_for_version(get_data_version(PO_INDEX_FILE))
+
+def replenishment_plan(open_quantities=None):
+    """One row per low-stock item still short after open orders, with its order
+    quantity and the supplier it is ordered from; cost in minor units"""
+    snapshot = get_inventory_snapshot()
+    snapshot = snapshot[snapshot['low_stock']]
+    open_quantities = get_open_po_quantities() if open_quantities is None else open_quantities
+    on_order = np.array([open_quantities.get(b, 0) for b in snapshot['barcode']], dtype=np.int64)
+    lead_time = supplier_lead_times(snapshot['supplier'])
+    target = snapshot['reorder_point'].to_numpy() + np.ceil(snapshot['daily_forecast'].to_numpy() * lead_time)
+    order = np.maximum(target - snapshot['quantity'].to_numpy() - on_order, 0).astype(np.int64)
+    plan = pd.DataFrame({
+        'barcode': snapshot['barcode'],
+        'product': snapshot['name'],
+        'supplier': snapshot['supplier'].astype(str),
+        'quantity': snapshot['quantity'],
+        'reorder_point': snapshot['reorder_point'],
+        'on_order': on_order,
+        'order_quantity': order,
+        'cost': snapshot['cost']
+    })
+    return plan[plan['order_quantity'] > 0].sort_values(['supplier', 'product'], ignore_index=True)
+
+def create_replenishment_drafts(user):
+    """Draft one PO per supplier for the current replenishment plan, saved as one
+    batch with a single index write. Open quantities are re-read from the open
+    orders here, so orders drafted since the plan was shown are not ordered
+    again. Returns (new PO ids, items skipped for having no known supplier)."""
+    suppliers = load_data(SUPPLIERS_FILE)
+    supplier_ids = {supplier['name']: supplier_id for supplier_id, supplier in suppliers.items()}
+    plan = replenishment_plan(build_open_po_index(load_open_purchase_orders()))
+    known = plan['supplier'].isin(list(supplier_ids))
+    
+    drafts = []
+    for supplier_name, lines in plan[known].groupby('supplier', sort=True):
+        items = [{
+            'barcode': line.barcode,
+            'name': line.product,
+            'quantity': int(line.order_quantity),
+            'cost': from_minor(int(line.cost))
+        } for line in lines.itertuples(index=False)]
+        drafts.append(new_purchase_order(supplier_ids[supplier_name], supplier_name, items, user,
+                                         status='draft', source='auto_replenishment'))
+    
+    if drafts:
+        get_po_store().save(*drafts)
+    return [po['po_id'] for po in drafts], plan[~known]
+
+# Report jobs
+# Long reports run on a background pool. Job records live in REPORT_JOBS_FILE
+# and results are written under REPORTS_DIR/<job_id>/ as CSV, Parquet and a
+# PDF preview, so they stay downloadable after the user leaves the page.
+REPORT_JOB_WORKERS = 2
+REPORT_PDF_MAX_ROWS = 500
+
+def build_audit_sheet(progress=None):
+    inventory = load_data(INVENTORY_FILE)
+    products = load_data(PRODUCTS_FILE)
+    audit_data = []
+    for i, (barcode, inv_data) in enumerate(inventory.items()):
+        product = products.get(barcode, {'name': 'Unknown'})
+        audit_data.append({
+            'Product': product['name'],
+            'Barcode': barcode,
+            'System Quantity': inv_data.get('quantity', 0),
+            'Physical Count': "",
+            'Variance': "",
+            'Notes': ""
+        })
+        if progress and i % 5000 == 0:
+            progress(0.1 + 0.7 * i / len(inventory), f"Listed {i} of {len(inventory)} items")
+    return pd.DataFrame(audit_data, columns=['Product', 'Barcode', 'System Quantity', 'Physical Count', 'Variance', 'Notes'])
+
+def run_sales_report_job(params, progress):
+    progress(0.1, "Loading sales data")
+    start_date = datetime.date.fromisoformat(params['start_date'])
+    end_date = datetime.date.fromisoformat(params['end_date'])
+    data = compute_sales_report(params['report_type'], start_date, end_date)
+    return data['report'] if data else pd.DataFrame()
+
+def run_audit_sheet_job(params, progress):
+    progress(0.1, "Loading inventory")
+    return build_audit_sheet(progress)
+
+def run_payment_report_job(params, progress):
+    progress(0.1, "Loading sales data")
+    data = compute_payment_report(datetime.date.fromisoformat(params['start_date']),
+                                  datetime.date.fromisoformat(params['end_date']))
+    return data['summary'] if data else pd.DataFrame()
+
+def run_custom_report_job(params, progress):
+    progress(0.1, "Running query")
+    return run_query(params).reset_index()
+
+def run_customer_segments_job(params, progress):
+    progress(0.1, "Scoring customers")
+    with data_dir_lock(timeout=30):
+        rfm = refresh_customer_segments()
+    return money_columns_to_units(rfm, ['monetary']).reset_index()
+
+REPORT_JOB_TYPES = {
+    'sales': run_sales_report_job,
+    'inventory_audit': run_audit_sheet_job,
+    'payments': run_payment_report_job,
+    'custom': run_custom_report_job,
+    'customer_segments': run_customer_segments_job,
+    'basket_mining': run_basket_mining_job,
+    'reorder_forecast': run_reorder_forecast_job
+}
+
+def write_report_artifacts(job_id, title, report_df):
+    job_dir = os.path.join(REPORTS_DIR, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    artifacts = []
+    
+    write_csv_chunks(iter_frame_chunks(report_df), os.path.join(job_dir, "report.csv"))
+    artifacts.append("report.csv")
+    try:
+        write_parquet_chunks(iter_frame_chunks(report_df), os.path.join(job_dir, "report.parquet"))
+        artifacts.append("report.parquet")
+    except (ImportError, ValueError):
+        pass  # pyarrow not installed, or columns it cannot store
+    with open(os.path.join(job_dir, "report.pdf"), 'wb') as f:
+        f.write(render_table_pdf(title, report_df.head(REPORT_PDF_MAX_ROWS)))
+    artifacts.append("report.pdf")
+    return artifacts
+
+class ReportJobRunner:
+    def __init__(self, workers=REPORT_JOB_WORKERS):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="report-job")
+        self.lock = threading.Lock()
+        self.jobs = load_data(REPORT_JOBS_FILE)
+        # Jobs that were queued or running when the server stopped never finished
+        for job in self.jobs.values():
+            if job['status'] in ('queued', 'running'):
+                job['status'] = 'failed'
+                job['message'] = "Interrupted by server restart"
+    
+    def _save(self):
+        save_data(self.jobs, REPORT_JOBS_FILE)
+    
+    def _update(self, job_id, save=True, **changes):
+        with self.lock:
+            self.jobs[job_id].update(changes)
+            if save:
+                self._save()
+    
+    def submit(self, job_type, title, params, user):
+        job_id = generate_short_id()
+        with self.lock:
+            self.jobs[job_id] = {
+                'job_id': job_id,
+                'type': job_type,
+                'title': title,
+                'params': params,
+                'status': 'queued',
+                'progress': 0.0,
+                'message': "Waiting for a worker",
+                'artifacts': [],
+                'created_by': user,
+                'created': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
+                'finished': None
+            }
+            self._save()
+        self.pool.submit(self._run, job_id)
+        return job_id
+    
+    def _run(self, job_id):
+        job = self.jobs[job_id]
+        self._update(job_id, status='running', message="Started")
+        
+        def progress(fraction, message):
+            # Progress is only kept in memory; the file is written on status changes
+            self._update(job_id, save=False, progress=round(fraction, 3), message=message)
+        
+        try:
+            report_df = REPORT_JOB_TYPES[job['type']](job['params'], progress)
+            progress(0.9, "Writing artifacts")
+            artifacts = write_report_artifacts(job_id, job['title'], report_df)
+            self._update(job_id, status='done', progress=1.0, message=f"{len(report_df)} rows",
+                         artifacts=artifacts, finished=get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"))
+        except Exception as e:
+            self._update(job_id, status='failed', message=str(e),
+                         finished=get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"))
+    
+    def get(self, job_id):
+        with self.lock:
+            return dict(self.jobs[job_id]) if job_id in self.jobs else None
+    
+    def list_jobs(self):
+        with self.lock:
+            return sorted((dict(job) for job in self.jobs.values()), key=lambda j: j['created'], reverse=True)
+    
+    def delete(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job['status'] in ('queued', 'running'):
+                return False
+            del self.jobs[job_id]
+            self._save()
+        shutil.rmtree(os.path.join(REPORTS_DIR, job_id), ignore_errors=True)
+        return True
+
+@st.cache_resource(show_spinner=False)
+def get_report_job_runner():
+    return ReportJobRunner()
+
+def latest_job_result(job_type):
+    """(job, report DataFrame) of the newest finished job of a type, or (None, None)"""
+    for job in get_report_job_runner().list_jobs():
+        if job['type'] == job_type and job['status'] == 'done':
+            path = os.path.join(REPORTS_DIR, job['job_id'], "report.csv")
+            if os.path.exists(path):
+                return job, pd.read_csv(path, dtype=str, keep_default_na=False)
+    return None, None
+
+def submit_report_job(job_type, title, params):
+    job_id = get_report_job_runner().submit(job_type, title, params, st.session_state.user_info['username'])
+    st.success(f"Report job {job_id} started. Follow it on the Report Jobs tab.")
+    return job_id
+
+def report_jobs_tab():
+    st.header("Report Jobs")
+    runner = get_report_job_runner()
+    jobs = runner.list_jobs()
+    
+    if not jobs:
+        st.info("No report jobs yet. Use 'Run in Background' on a report to start one.")
+        return
+    
+    if st.button("Refresh", key="refresh_report_jobs"):
+        st.rerun()
+    
+    for job in jobs:
+        with st.expander(f"{job['title']} - {job['status'].upper()} ({job['created']})",
+                         expanded=job['status'] in ('queued', 'running')):
+            st.write(f"**Job ID:** {job['job_id']}  |  **Requested by:** {job['created_by']}")
+            if job['params']:
+                st.caption(", ".join(f"{k}: {v}" for k, v in job['params'].items()))
+            
+            if job['status'] in ('queued', 'running'):
+                progress_bar = st.progress(job['progress'], text=job['message'])
+                if st.button("Follow Progress", key=f"follow_{job['job_id']}"):
+                    # Poll until the job ends; leaving the page simply stops the loop
+                    while True:
+                        current = runner.get(job['job_id'])
+                        progress_bar.progress(current['progress'], text=current['message'])
+                        if current['status'] not in ('queued', 'running'):
+                            break
+                        time.sleep(0.5)
+                    st.rerun()
+            elif job['status'] == 'failed':
+                st.error(f"Failed: {job['message']}")
+            else:
+                st.success(f"Finished {job['finished']}: {job['message']}")
+                mimes = {'csv': "text/csv", 'parquet': "application/octet-stream", 'pdf': "application/pdf"}
+                cols = st.columns(len(job['artifacts']) + 1)
+                for col, artifact in zip(cols, job['artifacts']):
+                    path = os.path.join(REPORTS_DIR, job['job_id'], artifact)
+                    if os.path.exists(path):
+                        extension = artifact.rsplit('.', 1)[-1]
+                        with open(path, 'rb') as f:
+                            col.download_button(
+                                f"Download {extension.upper()}",
+                                data=f.read(),
+                                file_name=f"{job['type']}_{job['job_id']}.{extension}",
+                                mime=mimes.get(extension, "application/octet-stream"),
+                                key=f"download_{job['job_id']}_{extension}"
+                            )
+                if cols[-1].button("Delete", key=f"delete_job_{job['job_id']}"):
+                    runner.delete(job['job_id'])
+                    st.rerun()
+
+# Session state initialization
+if 'user_info' not in st.session_state:
+    st.session_state.user_info = None
+if 'cart' not in st.session_state:
+    st.session_state.cart = {}
+else:
+    # Carts created before the compact model stored a product dict per line
+    for barcode, line in list(st.session_state.cart.items()):
+        if isinstance(line, dict):
+            st.session_state.cart[barcode] = CartLine(barcode, line['quantity'], line['price'])
+if 'current_page' not in st.session_state:
+    st.session_state.current_page = "Login"
+if 'shift_started' not in st.session_state:
+    st.session_state.shift_started = False
+if 'shift_id' not in st.session_state:
+    st.session_state.shift_id = None
+if 'last_activity' not in st.session_state:
+    st.session_state.last_activity = time.time()
+if 'barcode_scanner_setup' not in st.session_state:
+    st.session_state.barcode_scanner_setup = False
+if 'scanned_barcode' not in st.session_state:
+    st.session_state.scanned_barcode = None
+if 'scanner_status' not in st.session_state:
+    st.session_state.scanner_status = "Not Connected"
+if 'pos_mode' not in st.session_state:
+    st.session_state.pos_mode = 'scan'
+if 'selected_category' not in st.session_state:
+    st.session_state.selected_category = None
+if 'selected_subcategory' not in st.session_state:
+    st.session_state.selected_subcategory = None
+if 'return_reason' not in st.session_state:
+    st.session_state.return_reason = ""
+if 'po_supplier' not in st.session_state:
+    st.session_state.po_supplier = None
+if 'po_items' not in st.session_state:
+    st.session_state.po_items = []
+
+# Setup barcode scanner if not already done
+if not st.session_state.barcode_scanner_setup:
+    setup_barcode_scanner()
+
+# Login Page
+def login_page():
+    st.title("Supermarket POS - Login")
+    
+    with st.form("login_form"):
+        username = st.text_input("Username")
+        password = st.text_input("Password", type="password")
+        submit_button = st.form_submit_button("Login")
+        
+        if submit_button:
+            user = verify_user(username, password)
+            if user:
+                if not user.get('active', True):
+                    st.error("This account is inactive. Please contact administrator.")
+                else:
+                    st.session_state.user_info = user
+                    st.session_state.current_page = "Dashboard"
+                    st.session_state.last_activity = time.time()
+                    st.rerun()
+            else:
+                st.error("Invalid username or password")
+
+# Shift Management
+def start_shift():
+    shifts = load_data(SHIFTS_FILE)
+    shift_id = generate_short_id()
+    
+    shifts[shift_id] = {
+        'shift_id': shift_id,
+        'user_id': st.session_state.user_info['username'],
+        **timestamp_fields('start_time'),
+        'end_time': None,
+        'starting_cash': 0.0,
+        'ending_cash': 0.0,
+        'transactions': [],
+        'status': 'active'
+    }
+    
+    save_data(shifts, SHIFTS_FILE)
+    st.session_state.shift_started = True
+    st.session_state.shift_id = shift_id
+    return shift_id
+
+def end_shift():
+    if not st.session_state.shift_started:
+        return False
+    
+    shifts = load_data(SHIFTS_FILE)
+    shift_id = st.session_state.shift_id
+    
+    if shift_id in shifts:
+        shifts[shift_id].update(timestamp_fields('end_time', 'end_ts'))
+        shifts[shift_id]['status'] = 'completed'
+        
+        # Cash totals must include sales still waiting in the lane spool
+        reconcile_lane_spool(lock_timeout=10.0)
+        transactions = load_data(TRANSACTIONS_FILE)
+        shift_transactions = [t for t in transactions.values() 
+                            if t.get('shift_id') == shift_id and t['payment_method'] == 'Cash']
+        total_cash = sum(t['total'] for t in shift_transactions)
+        
+        shifts[shift_id]['ending_cash'] = total_cash
+        
+        save_data(shifts, SHIFTS_FILE)
+        st.session_state.shift_started = False
+        st.session_state.shift_id = None
+        return True
+    return False
+
+# Dashboard
+def dashboard():
+    settings = load_data(SETTINGS_FILE)
     if settings.get('auto_logout', True):
         inactive_time = time.time() - st.session_state.last_activity
         timeout_minutes = settings.get('session_timeout', 30)
@@ -710,52 +3983,22 @@ def dashboard():
 def dashboard_content():
     st.header("Overview")
     
-    col1, col2, col3 = st.columns(3)
-    
-    products = load_data(PRODUCTS_FILE)
-    inventory = load_data(INVENTORY_FILE)
-    transactions = load_data(TRANSACTIONS_FILE)
-    
-    total_products = len(products)
-    low_stock_items = sum(1 for item in inventory.values() if item.get('quantity', 0) < item.get('reorder_point', 10))
-    
-    today_sales = 0
-    today = datetime.date.today()
-    for t in transactions.values():
-        try:
-            trans_date = datetime.datetime.strptime(t.get('date', ''), "%Y-%m-%d %H:%M:%S").date()
-            if trans_date == today:
-                today_sales += t.get('total', 0)
-        except (ValueError, KeyError):
-            continue
+    col1, col2, col3 = st.columns(3)
     
-    col1.metric("Total Products", total_products)
-    col2.metric("Low Stock Items", low_stock_items)
-    col3.metric("Today's Sales", format_currency(today_sales))
+    counters = load_dashboard_counters()
     
-    st.subheader("Recent Transactions")
+    col1.metric("Total Products", len(load_data(PRODUCTS_FILE)))
+    col2.metric("Low Stock Items", counters['low_stock'])
+    col3.metric("Today's Sales", format_money(counters['today_sales']),
+                help=f"{counters['today_transactions']} transaction(s) today")
     
-    def get_transaction_date(t):
-        try:
-            return datetime.datetime.strptime(t.get('date', ''), "%Y-%m-%d %H:%M:%S")
-        except (ValueError, KeyError):
-            return datetime.datetime.min
+    st.subheader("Recent Transactions")
     
-    recent_transactions = sorted(transactions.values(), 
-                               key=get_transaction_date, 
-                               reverse=True)[:5]
+    recent_transactions = counters['recent'][::-1][:5]
     
     if recent_transactions:
-        display_data = []
-        for t in recent_transactions:
-            display_data.append({
-                'transaction_id': t.get('transaction_id', 'N/A'),
-                'date': t.get('date', 'N/A'),
-                'total': format_currency(t.get('total', 0)),
-                'cashier': t.get('cashier', 'N/A')
-            })
-        
-        trans_df = pd.DataFrame(display_data)
+        trans_df = pd.DataFrame(recent_transactions)
+        trans_df['total'] = trans_df['total'].map(format_currency)
         st.dataframe(trans_df)
     else:
         st.info("No recent transactions")
@@ -775,6 +4018,13 @@ def pos_terminal():
         st.markdown(f"**Scanner Status:** <span style='color:{status_color}'>{st.session_state.scanner_status}</span>", 
                    unsafe_allow_html=True)
     
+    pending_sales = count_pending_spooled_sales()
+    if pending_sales:
+        st.caption(f"Lane sync pending: {pending_sales} sale(s) waiting to be merged")
+    sync_error = get_spool_reconciler().last_error
+    if sync_error:
+        st.error(sync_error)
+    
     # POS Mode Selection
     col1, col2 = st.columns(2)
     with col1:
@@ -817,16 +4067,7 @@ def pos_scan_mode():
                 stock = inventory.get(barcode, {}).get('quantity', 0)
                 
                 if stock > 0:
-                    if barcode in st.session_state.cart:
-                        st.session_state.cart[barcode]['quantity'] += 1
-                    else:
-                        st.session_state.cart[barcode] = {
-                            'name': product['name'],
-                            'price': product['price'],
-                            'quantity': 1,
-                            'description': product.get('description', ''),
-                            'brand': product.get('brand')
-                        }
+                    add_to_cart(barcode, product)
                     st.success(f"Added {product['name']} to cart")
                 else:
                     st.error(f"{product['name']} is out of stock")
@@ -897,16 +4138,7 @@ def pos_scan_mode():
                             
                             # Add to cart button
                             if st.button(f"Add to Cart", key=f"add_{barcode}", use_container_width=True):
-                                if barcode in st.session_state.cart:
-                                    st.session_state.cart[barcode]['quantity'] += 1
-                                else:
-                                    st.session_state.cart[barcode] = {
-                                        'name': product['name'],
-                                        'price': product['price'],
-                                        'quantity': 1,
-                                        'description': product.get('description', ''),
-                                        'brand': product.get('brand')
-                                    }
+                                add_to_cart(barcode, product)
                                 st.success(f"Added {product['name']} to cart")
     
     # Display cart and checkout
@@ -1016,16 +4248,7 @@ def pos_manual_mode():
                             
                             # Add to cart button
                             if st.button(f"Add to Cart", key=f"add_manual_{barcode}", use_container_width=True):
-                                if barcode in st.session_state.cart:
-                                    st.session_state.cart[barcode]['quantity'] += quantity
-                                else:
-                                    st.session_state.cart[barcode] = {
-                                        'name': product['name'],
-                                        'price': product['price'],
-                                        'quantity': quantity,
-                                        'description': product.get('description', ''),
-                                        'brand': product.get('brand')
-                                    }
+                                add_to_cart(barcode, product, quantity)
                                 st.success(f"Added {quantity} {product['name']} to cart")
     
     display_cart_and_checkout()
@@ -1042,31 +4265,35 @@ def display_cart_and_checkout():
     
     st.header("Current Sale")
     
+    # Descriptive fields are not kept in the cart; resolve them from the catalog
+    products = load_data(PRODUCTS_FILE)
+    
     # Create a copy of the cart items to avoid modification during iteration
     cart_items = list(st.session_state.cart.items())
     items_to_remove = []
     
     if cart_items:
-        for barcode, item in cart_items:
+        for barcode, line in cart_items:
+            product = products.get(barcode, {})
             with st.container():
                 col1, col2, col3, col4 = st.columns([4, 2, 2, 1])
                 with col1:
-                    st.write(f"**{item['name']}**")
-                    if item.get('description'):
+                    st.write(f"**{product.get('name', 'Unknown Product')}**")
+                    if product.get('description'):
                         with st.expander("Description"):
-                            st.write(item['description'])
+                            st.write(product['description'])
                 with col2:
                     new_qty = st.number_input(
                         "Qty", 
                         min_value=1, 
                         max_value=100, 
-                        value=item['quantity'], 
+                        value=line.quantity, 
                         key=f"edit_{barcode}"
                     )
-                    if new_qty != item['quantity']:
-                        st.session_state.cart[barcode]['quantity'] = new_qty
+                    if new_qty != line.quantity:
+                        line.quantity = new_qty
                 with col3:
-                    st.write(f"{format_currency(item['price'] * item['quantity'])}")
+                    st.write(f"{format_currency(line.line_total)}")
                 with col4:
                     if st.button("❌", key=f"remove_{barcode}"):
                         items_to_remove.append(barcode)
@@ -1076,10 +4303,10 @@ def display_cart_and_checkout():
             if barcode in st.session_state.cart:
                 del st.session_state.cart[barcode]
         
-        # Recalculate totals after potential changes
-        subtotal = sum(item['price'] * item['quantity'] for item in st.session_state.cart.values())
+        # Recalculate totals after potential changes; amounts from here on are minor units
+        subtotal = sum(line.line_total_minor for line in st.session_state.cart.values())
         tax_rate = settings.get('tax_rate', 0.0)
-        tax_amount = subtotal * tax_rate
+        tax_amount = scale_minor(subtotal, tax_rate)
         
         # Apply offers before calculating total
         total_before_offers = subtotal + tax_amount
@@ -1097,90 +4324,100 @@ def display_cart_and_checkout():
             if selected_discount:
                 discount = discount_options[selected_discount]
                 if discount['type'] == 'percentage':
-                    discount_amount = final_total * (discount['value'] / 100)
+                    discount_amount = scale_minor(final_total, discount['value'] / 100)
                 else:
-                    discount_amount = discount['value']
+                    discount_amount = to_minor(discount['value'])
                 
                 final_total -= discount_amount
-                st.write(f"Discount Applied: -{format_currency(discount_amount)}")
+                st.write(f"Discount Applied: -{format_money(discount_amount)}")
         
         st.markdown("---")
         col1, col2 = st.columns(2)
         with col1:
             st.subheader("Summary")
-            st.write(f"Subtotal: {format_currency(subtotal)}")
-            st.write(f"Tax ({tax_rate*100}%): {format_currency(tax_amount)}")
+            st.write(f"Subtotal: {format_money(subtotal)}")
+            st.write(f"Tax ({tax_rate*100}%): {format_money(tax_amount)}")
             if total_after_offers != total_before_offers:
-                st.write(f"After Offers: {format_currency(total_after_offers)}")
+                st.write(f"After Offers: {format_money(total_after_offers)}")
             if final_total != total_after_offers:
-                st.write(f"After Discount: {format_currency(final_total)}")
-            st.write(f"**Total: {format_currency(final_total)}**")
+                st.write(f"After Discount: {format_money(final_total)}")
+            st.write(f"**Total: {format_money(final_total)}**")
         
         with col2:
             st.subheader("Payment")
+            customers = load_data(LOYALTY_FILE).get('customers', {})
+            customer_options = {f"{v['name']} - {v.get('phone', 'No phone')}": k for k, v in customers.items()}
+            selected_customer = st.selectbox("Customer", ["Walk-in"] + list(customer_options.keys()),
+                                             key="pos_customer")
+            customer_id = customer_options.get(selected_customer)
+            
             payment_method = st.selectbox("Payment Method", 
                                         ["Cash", "Credit Card", "Debit Card", "Mobile Payment", "Bank Transfer", "International Card"])
             
             # Calculate payment charge
             payment_method_key = payment_method.lower().replace(" ", "_")
             payment_charge_percent = payment_charges.get(payment_method_key, 0.0)
-            payment_charge_amount = final_total * (payment_charge_percent / 100)
+            payment_charge_amount = scale_minor(final_total, payment_charge_percent / 100)
             
             total_with_payment_charge = final_total + payment_charge_amount
             
             if payment_charge_percent > 0:
-                st.info(f"Payment Fee ({payment_charge_percent}%): +{format_currency(payment_charge_amount)}")
-                st.write(f"**Amount Due: {format_currency(total_with_payment_charge)}**")
+                st.info(f"Payment Fee ({payment_charge_percent}%): +{format_money(payment_charge_amount)}")
+                st.write(f"**Amount Due: {format_money(total_with_payment_charge)}**")
             
-            amount_tendered = st.number_input("Amount Tendered", min_value=0.0, value=total_with_payment_charge, step=1.0)
+            amount_tendered = to_minor(st.number_input("Amount Tendered", min_value=0.0,
+                                                       value=from_minor(total_with_payment_charge), step=1.0))
             
             if st.button("Complete Sale", use_container_width=True):
                 if amount_tendered < total_with_payment_charge:
                     st.error("Amount tendered is less than total")
                 else:
-                    transactions = load_data(TRANSACTIONS_FILE)
                     transaction_id = generate_short_id()
                     
-                    transactions[transaction_id] = {
+                    transaction = {
                         'transaction_id': transaction_id,
-                        'date': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
-                        'items': st.session_state.cart.copy(),
-                        'subtotal': subtotal,
-                        'tax': tax_amount,
-                        'discount': final_total - (subtotal + tax_amount),
-                        'total': final_total,
+                        'lane_id': get_lane_id(),
+                        **timestamp_fields('date'),
+                        'line_format': TRANSACTION_LINE_FORMAT,
+                        'items': cart_to_transaction_items(st.session_state.cart),
+                        'subtotal': from_minor(subtotal),
+                        'tax': from_minor(tax_amount),
+                        'discount': from_minor(final_total - (subtotal + tax_amount)),
+                        'total': from_minor(final_total),
                         'payment_method': payment_method,
                         'payment_charge_percent': payment_charge_percent,
-                        'payment_charge_amount': payment_charge_amount,
-                        'amount_tendered': amount_tendered,
-                        'change': amount_tendered - total_with_payment_charge,
+                        'payment_charge_amount': from_minor(payment_charge_amount),
+                        'amount_tendered': from_minor(amount_tendered),
+                        'change': from_minor(amount_tendered - total_with_payment_charge),
                         'cashier': st.session_state.user_info['username'],
                         'shift_id': st.session_state.shift_id if is_cashier() else None
                     }
+                    if customer_id:
+                        transaction['customer_id'] = customer_id
                     
-                    inventory = load_data(INVENTORY_FILE)
-                    for barcode, item in st.session_state.cart.items():
-                        if barcode in inventory:
-                            inventory[barcode]['quantity'] -= item['quantity']
-                        else:
-                            inventory[barcode] = {'quantity': -item['quantity']}
-                    
-                    save_data(transactions, TRANSACTIONS_FILE)
-                    save_data(inventory, INVENTORY_FILE)
+                    # Stock and the shared ledger are updated by the lane reconciler
+                    spool_sale(transaction)
+                    get_spool_reconciler().wake()
                     
-                    receipt = generate_receipt(transactions[transaction_id])
+                    receipt = generate_receipt(transaction)
                     st.subheader("Receipt")
                     st.text(receipt)
                     
-                    if print_receipt(receipt):
+                    kick_drawer = payment_method == "Cash" and settings.get('cash_drawer_enabled', False)
+                    escpos = settings.get('printer_backend') == 'escpos'
+                    
+                    # ESC/POS printers get the drawer kick in the same write as the receipt
+                    if print_receipt(receipt, kick_drawer=kick_drawer and escpos,
+                                     template='sale', context=sale_receipt_context(transaction, products)):
                         st.success("Receipt printed successfully")
                     else:
                         st.warning("Receipt could not be printed automatically")
                     
-                    if payment_method == "Cash" and settings.get('cash_drawer_enabled', False):
+                    if kick_drawer and not escpos:
                         open_cash_drawer()
                     
                     st.session_state.cart = {}
+                    st.session_state.pop('pos_customer', None)
                     st.success("Sale completed successfully!")
                     
     else:
@@ -1189,124 +4426,43 @@ def display_cart_and_checkout():
 # Also fix the apply_offers_to_cart function to avoid iteration issues
 def apply_offers_to_cart(cart_items, current_total):
     """
-    Apply active offers to the cart and return the updated total
+    Apply active offers to the cart and return the updated total.
+    Totals and discounts are in minor units.
+    The ids of the offers applied to each line are recorded on the CartLine.
     """
     offers = load_data(OFFERS_FILE)
+    products = load_data(PRODUCTS_FILE)
     active_offers = [o for o in offers.values() if o['active']]
     
+    barcodes = list(cart_items)
+    lines = [cart_items[barcode] for barcode in barcodes]
+    applied_offers = price_offers(active_offers, np.zeros(len(lines), dtype=np.int64), 1, pd.Categorical(barcodes),
+                                  [line.quantity for line in lines], [line.price_minor for line in lines])
+    
     total_after_offers = current_total
-    applied_offers = []
+    line_promotions = {barcode: [] for barcode in cart_items}
+    for offer, discount, applied in applied_offers:
+        total_after_offers -= int(discount[0])
+        for barcode in itertools.compress(barcodes, applied):
+            line_promotions[barcode].append(offer.get('id', offer['name']))
     
-    for offer in active_offers:
-        if offer['type'] == 'bogo':
-            # Buy One Get One Free offer
-            for barcode, item in cart_items.items():  # This is safe because we're not modifying the cart
-                if barcode in offer.get('products', []):
-                    if item['quantity'] >= offer['buy_quantity']:
-                        free_qty = (item['quantity'] // offer['buy_quantity']) * offer['get_quantity']
-                        discount_amount = free_qty * item['price']
-                        total_after_offers -= discount_amount
-                        applied_offers.append({
-                            'type': 'bogo',
-                            'name': offer['name'],
-                            'product': item['name'],
-                            'discount': discount_amount
-                        })
-        
-        elif offer['type'] == 'bundle':
-            # Bundle offer - check if all bundle products are in cart
-            bundle_products = offer.get('products', [])
-            if all(barcode in cart_items for barcode in bundle_products):
-                bundle_price = offer.get('bundle_price', 0)
-                original_price = sum(cart_items[barcode]['price'] * cart_items[barcode]['quantity'] 
-                                   for barcode in bundle_products)
-                discount_amount = original_price - bundle_price
-                total_after_offers -= discount_amount
-                applied_offers.append({
-                    'type': 'bundle',
-                    'name': offer['name'],
-                    'discount': discount_amount
-                })
-        
-        elif offer['type'] == 'special_price':
-            # Special price offer
-            product_barcode = offer.get('product')
-            if product_barcode in cart_items:
-                special_price = offer.get('special_price', 0)
-                original_price = cart_items[product_barcode]['price']
-                quantity = cart_items[product_barcode]['quantity']
-                discount_amount = (original_price - special_price) * quantity
-                total_after_offers -= discount_amount
-                applied_offers.append({
-                    'type': 'special_price',
-                    'name': offer['name'],
-                    'product': cart_items[product_barcode]['name'],
-                    'discount': discount_amount
-                })
+    for barcode, promotions in line_promotions.items():
+        cart_items[barcode].promotions = tuple(promotions)
     
     # Display applied offers
     if applied_offers:
         st.subheader("🎁 Applied Offers")
-        for offer in applied_offers:
-            if offer['type'] == 'bogo':
-                st.success(f"{offer['name']}: -{format_currency(offer['discount'])}")
-            elif offer['type'] == 'bundle':
-                st.success(f"{offer['name']}: -{format_currency(offer['discount'])}")
-            elif offer['type'] == 'special_price':
-                st.success(f"{offer['name']} on {offer['product']}: -{format_currency(offer['discount'])}")
+        for offer, discount, _ in applied_offers:
+            if offer['type'] == 'special_price':
+                product_name = resolve_line_name(offer['product'], {}, products)
+                st.success(f"{offer['name']} on {product_name}: -{format_money(int(discount[0]))}")
+            else:
+                st.success(f"{offer['name']}: -{format_money(int(discount[0]))}")
     
     return max(total_after_offers, 0)  # Ensure total doesn't go negative
 
-def generate_receipt(transaction):
-    settings = load_data(SETTINGS_FILE)
-    receipt = ""
-    
-    # Header
-    receipt += f"{settings.get('store_name', 'Supermarket POS')}\n"
-    receipt += f"{settings.get('store_address', '')}\n"
-    receipt += f"{settings.get('store_phone', '')}\n"
-    receipt += "=" * 40 + "\n"
-    
-    if settings.get('receipt_header', ''):
-        receipt += f"{settings['receipt_header']}\n"
-        receipt += "=" * 40 + "\n"
-    
-    receipt += f"Date: {transaction['date']}\n"
-    receipt += f"Cashier: {transaction['cashier']}\n"
-    receipt += f"Transaction ID: {transaction['transaction_id']}\n"
-    receipt += "=" * 40 + "\n"
-    
-    # Items
-    for barcode, item in transaction['items'].items():
-        receipt += f"{item['name']} x{item['quantity']}: {format_currency(item['price'] * item['quantity'])}\n"
-    
-    receipt += "=" * 40 + "\n"
-    receipt += f"Subtotal: {format_currency(transaction['subtotal'])}\n"
-    receipt += f"Tax: {format_currency(transaction['tax'])}\n"
-    
-    # Show offers/discounts if any
-    if transaction.get('discount', 0) != 0:
-        receipt += f"Discount: -{format_currency(abs(transaction['discount']))}\n"
-    
-    receipt += f"Total: {format_currency(transaction['total'])}\n"
-    
-    # Show payment charge if any
-    if transaction.get('payment_charge_amount', 0) > 0:
-        receipt += f"Payment Fee ({transaction.get('payment_charge_percent', 0)}%): {format_currency(transaction['payment_charge_amount'])}\n"
-        receipt += f"Amount Due: {format_currency(transaction['total'] + transaction['payment_charge_amount'])}\n"
-    
-    receipt += f"Payment Method: {transaction['payment_method']}\n"
-    receipt += f"Amount Tendered: {format_currency(transaction['amount_tendered'])}\n"
-    receipt += f"Change: {format_currency(transaction['change'])}\n"
-    receipt += "=" * 40 + "\n"
-    
-    if settings.get('receipt_footer', ''):
-        receipt += f"{settings['receipt_footer']}\n"
-        receipt += "=" * 40 + "\n"
-    
-    receipt += "Thank you for shopping with us!\n"
-    
-    return receipt
+def generate_receipt(transaction, products=None):
+    return render_receipt_text(get_receipt_template('sale'), sale_receipt_context(transaction, products))
 # Outdoor Sales Module
 # Outdoor Sales Module - Fixed without rerun
 def outdoor_sales_portal():
@@ -1507,8 +4663,8 @@ def create_order_tab(outdoor_orders_data):
                 if st.button("❌", key=f"remove_{barcode}_{tab_key}"):
                     del st.session_state.outdoor_cart[barcode]
         
-        # Calculate totals
-        subtotal = sum(item['price'] * item['quantity'] for item in st.session_state.outdoor_cart.values())
+        # Calculate totals in minor units
+        subtotal = sum(to_minor(item['price']) * item['quantity'] for item in st.session_state.outdoor_cart.values())
         
         # Delivery options
         st.subheader("🚚 Delivery Options")
@@ -1524,16 +4680,16 @@ def create_order_tab(outdoor_orders_data):
         # Calculate delivery charges
         delivery_charge = 0
         if delivery_type == "Standard":
-            delivery_charge = delivery_charges['standard']
-            if subtotal >= delivery_charges['free_threshold']:
+            delivery_charge = to_minor(delivery_charges['standard'])
+            if subtotal >= to_minor(delivery_charges['free_threshold']):
                 delivery_charge = 0
                 st.success("🎉 Free standard delivery!")
         elif delivery_type == "Express":
-            delivery_charge = delivery_charges['express']
+            delivery_charge = to_minor(delivery_charges['express'])
         
         with col2:
             # FIXED: Removed 'key' parameter from st.metric()
-            st.metric("Delivery Charge", format_currency(delivery_charge))
+            st.metric("Delivery Charge", format_money(delivery_charge))
         
         # Payment method
         st.subheader("💳 Payment Method")
@@ -1546,10 +4702,10 @@ def create_order_tab(outdoor_orders_data):
         # Calculate payment charge
         payment_method_key = payment_method.lower().replace(" ", "_")
         payment_charge_percent = payment_charges.get(payment_method_key, 0.0)
-        payment_charge_amount = subtotal * (payment_charge_percent / 100)
+        payment_charge_amount = scale_minor(subtotal, payment_charge_percent / 100)
         
         if payment_charge_percent > 0:
-            st.info(f"ℹ️ {payment_method} fee: {payment_charge_percent}% ({format_currency(payment_charge_amount)})")
+            st.info(f"ℹ️ {payment_method} fee: {payment_charge_percent}% ({format_money(payment_charge_amount)})")
         
         total = subtotal + delivery_charge + payment_charge_amount
         
@@ -1558,13 +4714,13 @@ def create_order_tab(outdoor_orders_data):
         col1, col2 = st.columns(2)
         with col1:
             # FIXED: Removed 'key' parameter from st.metric()
-            st.metric("Subtotal", format_currency(subtotal))
-            st.metric("Delivery", format_currency(delivery_charge))
+            st.metric("Subtotal", format_money(subtotal))
+            st.metric("Delivery", format_money(delivery_charge))
             if payment_charge_amount > 0:
-                st.metric("Payment Fee", format_currency(payment_charge_amount))
+                st.metric("Payment Fee", format_money(payment_charge_amount))
         with col2:
             # FIXED: Removed 'key' parameter from st.metric()
-            st.metric("Total", format_currency(total), delta=None)
+            st.metric("Total", format_money(total), delta=None)
         
         # Delivery address
         st.subheader("🏠 Delivery Address")
@@ -1591,13 +4747,13 @@ def create_order_tab(outdoor_orders_data):
                     customer_options if selected_customer != "➕ New Customer" else None,
                     customer_info,
                     delivery_type,
-                    delivery_charge,
+                    from_minor(delivery_charge),
                     payment_method,
                     payment_charge_percent,
-                    payment_charge_amount,
+                    from_minor(payment_charge_amount),
                     delivery_address,
                     order_notes,
-                    total
+                    from_minor(total)
                 )
                 if success:
                     st.session_state.outdoor_cart = {}
@@ -1682,6 +4838,22 @@ def delivery_management_tab():
     
     outdoor_orders_data = load_data(OUTDOOR_ORDERS_FILE)
     outdoor_orders = outdoor_orders_data.get('orders', {})
+    
+    with st.expander("🖨️ Reprint a Day's Orders"):
+        reprint_date = st.date_input("Order Date", value=get_current_datetime().date(), key="reprint_date")
+        day = reprint_date.strftime("%Y-%m-%d")
+        day_orders = [o for o in outdoor_orders.values() if o.get('created_date', '').startswith(day)]
+        st.write(f"{len(day_orders)} order(s) on {day}")
+        if day_orders and st.button("Prepare PDFs", key="reprint_day_orders"):
+            rendered = render_pdfs([
+                (f"receipt_{o['order_id']}.pdf", 'outdoor', outdoor_receipt_context(o)) for o in day_orders
+            ])
+            st.download_button(
+                "📦 Download Receipts (ZIP)",
+                data=zip_pdfs(rendered),
+                file_name=f"outdoor_receipts_{day}.zip",
+                mime="application/zip"
+            )
     approved_orders = [o for o in outdoor_orders.values() if o['status'] == 'approved']
     
     if not approved_orders:
@@ -1819,7 +4991,8 @@ def create_outdoor_order(selected_customer, customer_options, customer_info, del
             'customer_name': customer_info['name'] if selected_customer == "➕ New Customer" else customer_name,
             'customer_phone': customer_info['phone'] if selected_customer == "➕ New Customer" else customer_phone,
             'items': st.session_state.outdoor_cart.copy(),
-            'subtotal': sum(item['price'] * item['quantity'] for item in st.session_state.outdoor_cart.values()),
+            'subtotal': from_minor(sum(to_minor(item['price']) * item['quantity']
+                                       for item in st.session_state.outdoor_cart.values())),
             'delivery_charge': delivery_charge,
             'payment_method': payment_method,
             'payment_charge_percent': payment_charge_percent,
@@ -1830,7 +5003,7 @@ def create_outdoor_order(selected_customer, customer_options, customer_info, del
             'notes': order_notes,
             'status': 'pending_approval',
             'created_by': st.session_state.user_info['username'],
-            'created_date': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
+            **timestamp_fields('created_date'),
             'approved_by': None,
             'approved_date': None,
             'delivered_by': None,
@@ -1868,18 +5041,21 @@ def mark_as_delivered(order_id):
     
     outdoor_orders_data['orders'][order_id]['status'] = 'delivered'
     outdoor_orders_data['orders'][order_id]['delivered_by'] = st.session_state.user_info['username']
-    outdoor_orders_data['orders'][order_id]['delivery_date'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+    outdoor_orders_data['orders'][order_id].update(timestamp_fields('delivery_date', 'delivery_ts'))
     
     # Update inventory
-    inventory = load_data(INVENTORY_FILE)
-    for barcode, item in order['items'].items():
-        if barcode in inventory:
-            inventory[barcode]['quantity'] -= item['quantity']
-            inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-            inventory[barcode]['updated_by'] = st.session_state.user_info['username']
+    movements = []
+    with locked_inventory() as inventory:
+        for barcode, item in order['items'].items():
+            if barcode in inventory:
+                inventory[barcode]['quantity'] -= item['quantity']
+                inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                inventory[barcode]['updated_by'] = st.session_state.user_info['username']
+                movements.append(stock_movement(barcode, -item['quantity'], inventory[barcode]['quantity'],
+                                                'delivery', order_id, st.session_state.user_info['username']))
     
     save_data(outdoor_orders_data, OUTDOOR_ORDERS_FILE)
-    save_data(inventory, INVENTORY_FILE)
+    record_stock_movements(movements)
     st.success("Order marked as delivered. Inventory updated.")
     st.rerun()
 
@@ -1945,205 +5121,14 @@ def print_pos_receipt(order_data):
         st.error(f"Printing error: {str(e)}")
         return False
 
-def generate_pos_receipt_html(order_data, settings):
+def generate_pos_receipt_html(order_data, settings=None):
     """Generate POS-style receipt HTML"""
-    store_name = settings.get('store_name', 'SUPERMARKET POS')
-    store_address = settings.get('store_address', '')
-    store_phone = settings.get('store_phone', '')
-    
-    items_html = ""
-    for item in order_data['items'].values():
-        items_html += f"""
-        <div style="display: flex; justify-content: space-between; margin: 2px 0; font-size: 11px;">
-            <div>{item['name'][:20]}{'...' if len(item['name']) > 20 else ''}</div>
-            <div>{item['quantity']} x {format_currency(item['price'])}</div>
-            <div>{format_currency(item['price'] * item['quantity'])}</div>
-        </div>
-        """
-    
-    return f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Receipt #{order_data['order_id']}</title>
-        <style>
-            @media print {{
-                body {{
-                    font-family: 'Courier New', monospace;
-                    font-size: 12px;
-                    width: 80mm;
-                    margin: 0;
-                    padding: 5mm;
-                    line-height: 1.2;
-                }}
-                .header {{ text-align: center; margin-bottom: 10px; }}
-                .divider {{ border-top: 1px dashed #000; margin: 8px 0; }}
-                .total-row {{ border-top: 2px solid #000; padding-top: 5px; font-weight: bold; }}
-                .footer {{ text-align: center; margin-top: 15px; font-size: 10px; }}
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <h2 style="margin: 5px 0; font-size: 14px;">{store_name}</h2>
-            <div style="font-size: 10px;">{store_address}</div>
-            <div style="font-size: 10px;">Tel: {store_phone}</div>
-        </div>
-        
-        <div class="divider"></div>
-        
-        <div style="text-align: center; font-weight: bold;">
-            OUTDOOR ORDER RECEIPT
-        </div>
-        
-        <div style="display: flex; justify-content: space-between; font-size: 11px;">
-            <div>Order #: {order_data['order_id']}</div>
-            <div>{order_data['created_date']}</div>
-        </div>
-        
-        <div class="divider"></div>
-        
-        <div style="font-size: 11px;">
-            <div><strong>Customer:</strong> {order_data['customer_name']}</div>
-            <div><strong>Phone:</strong> {order_data.get('customer_phone', 'N/A')}</div>
-            <div><strong>Delivery:</strong> {order_data['delivery_type']}</div>
-        </div>
-        
-        <div class="divider"></div>
-        
-        <div style="font-weight: bold; display: flex; justify-content: space-between; font-size: 11px;">
-            <div>ITEM</div>
-            <div>QTY</div>
-            <div>AMOUNT</div>
-        </div>
-        
-        <div class="divider"></div>
-        
-        {items_html}
-        
-        <div class="divider"></div>
-        
-        <div style="display: flex; justify-content: space-between; font-size: 11px;">
-            <div>Subtotal:</div>
-            <div>{format_currency(order_data['subtotal'])}</div>
-        </div>
-        
-        <div style="display: flex; justify-content: space-between; font-size: 11px;">
-            <div>Delivery:</div>
-            <div>{format_currency(order_data['delivery_charge'])}</div>
-        </div>
-        
-        {"".join([f'<div style="display: flex; justify-content: space-between; font-size: 11px;"><div>Payment Fee ({order_data["payment_charge_percent"]}%):</div><div>{format_currency(order_data["payment_charge_amount"])}</div></div>' if order_data.get('payment_charge_amount', 0) > 0 else ''])}
-        
-        <div class="total-row" style="display: flex; justify-content: space-between; font-size: 12px;">
-            <div><strong>TOTAL:</strong></div>
-            <div><strong>{format_currency(order_data['total'])}</strong></div>
-        </div>
-        
-        <div style="font-size: 10px; margin-top: 5px;">
-            <div>Payment: {order_data['payment_method']}</div>
-            <div>Status: {order_data['status'].replace('_', ' ').title()}</div>
-        </div>
-        
-        <div class="divider"></div>
-        
-        <div style="font-size: 10px;">
-            <div><strong>Delivery Address:</strong></div>
-            <div>{order_data['delivery_address']}</div>
-        </div>
-        
-        {"".join([f'<div style="font-size: 10px; margin-top: 5px;"><strong>Notes:</strong> {order_data["notes"]}</div>' if order_data.get('notes') else ''])}
-        
-        <div class="footer">
-            <div>Thank you for your order!</div>
-            <div>{get_current_datetime().strftime('%Y-%m-%d %H:%M:%S')}</div>
-            <div>Printed by: {order_data['created_by']}</div>
-        </div>
-    </body>
-    </html>
-    """
+    return render_receipt_html(get_receipt_template('outdoor'), outdoor_receipt_context(order_data))
 
 def download_pdf_receipt(order_data):
     """Download PDF receipt"""
     try:
-        settings = load_data(SETTINGS_FILE)
-        pdf = FPDF.FPDF(format=(80, 200))  # POS receipt size
-        pdf.add_page()
-        pdf.set_font("Courier", size=10)
-        
-        # Store header
-        pdf.cell(0, 5, settings.get('store_name', 'SUPERMARKET POS'), 0, 1, 'C')
-        pdf.set_font("Courier", size=8)
-        pdf.cell(0, 4, settings.get('store_address', ''), 0, 1, 'C')
-        pdf.cell(0, 4, f"Tel: {settings.get('store_phone', '')}", 0, 1, 'C')
-        
-        pdf.ln(2)
-        pdf.set_font("Courier", size=10)
-        pdf.cell(0, 5, "OUTDOOR ORDER RECEIPT", 0, 1, 'C')
-        pdf.line(10, pdf.get_y(), 70, pdf.get_y())
-        pdf.ln(2)
-        
-        # Order info
-        pdf.cell(0, 4, f"Order #: {order_data['order_id']}", 0, 1)
-        pdf.cell(0, 4, f"Date: {order_data['created_date']}", 0, 1)
-        pdf.line(10, pdf.get_y(), 70, pdf.get_y())
-        pdf.ln(2)
-        
-        # Customer info
-        pdf.cell(0, 4, f"Customer: {order_data['customer_name']}", 0, 1)
-        pdf.cell(0, 4, f"Phone: {order_data.get('customer_phone', 'N/A')}", 0, 1)
-        pdf.cell(0, 4, f"Delivery: {order_data['delivery_type']}", 0, 1)
-        pdf.line(10, pdf.get_y(), 70, pdf.get_y())
-        pdf.ln(2)
-        
-        # Items
-        pdf.cell(30, 4, "ITEM", 0, 0)
-        pdf.cell(15, 4, "QTY", 0, 0, 'R')
-        pdf.cell(25, 4, "AMOUNT", 0, 1, 'R')
-        pdf.line(10, pdf.get_y(), 70, pdf.get_y())
-        
-        for item in order_data['items'].values():
-            pdf.cell(30, 4, item['name'][:15] + ('...' if len(item['name']) > 15 else ''), 0, 0)
-            pdf.cell(15, 4, str(item['quantity']), 0, 0, 'R')
-            pdf.cell(25, 4, format_currency(item['price'] * item['quantity']), 0, 1, 'R')
-        
-        pdf.line(10, pdf.get_y(), 70, pdf.get_y())
-        pdf.ln(2)
-        
-        # Totals
-        pdf.cell(45, 4, "Subtotal:", 0, 0)
-        pdf.cell(25, 4, format_currency(order_data['subtotal']), 0, 1, 'R')
-        
-        pdf.cell(45, 4, "Delivery:", 0, 0)
-        pdf.cell(25, 4, format_currency(order_data['delivery_charge']), 0, 1, 'R')
-        
-        if order_data.get('payment_charge_amount', 0) > 0:
-            pdf.cell(45, 4, f"Fee ({order_data['payment_charge_percent']}%):", 0, 0)
-            pdf.cell(25, 4, format_currency(order_data['payment_charge_amount']), 0, 1, 'R')
-        
-        pdf.set_font("Courier", 'B', 10)
-        pdf.cell(45, 5, "TOTAL:", 0, 0)
-        pdf.cell(25, 5, format_currency(order_data['total']), 0, 1, 'R')
-        pdf.set_font("Courier", size=8)
-        
-        pdf.ln(2)
-        pdf.cell(0, 4, f"Payment: {order_data['payment_method']}", 0, 1)
-        pdf.cell(0, 4, f"Status: {order_data['status'].replace('_', ' ').title()}", 0, 1)
-        pdf.line(10, pdf.get_y(), 70, pdf.get_y())
-        
-        # Delivery address
-        pdf.multi_cell(0, 4, f"Delivery Address:\n{order_data['delivery_address']}")
-        
-        if order_data.get('notes'):
-            pdf.ln(2)
-            pdf.multi_cell(0, 4, f"Notes: {order_data['notes']}")
-        
-        pdf.ln(5)
-        pdf.cell(0, 4, "Thank you for your order!", 0, 1, 'C')
-        pdf.cell(0, 4, get_current_datetime().strftime('%Y-%m-%d %H:%M:%S'), 0, 1, 'C')
-        pdf.cell(0, 4, f"Printed by: {order_data['created_by']}", 0, 1, 'C')
-        
-        pdf_data = pdf.output(dest='S').encode('latin1')
+        pdf_data = render_receipt_pdf(get_receipt_template('outdoor'), outdoor_receipt_context(order_data))
         
         st.download_button(
             label="📄 Download PDF Receipt",
@@ -2176,57 +5161,7 @@ def download_text_receipt(order_data):
 
 def generate_text_receipt(order_data):
     """Generate text format receipt"""
-    settings = load_data(SETTINGS_FILE)
-    receipt = []
-    
-    receipt.append("=" * 40)
-    receipt.append(f"{settings.get('store_name', 'SUPERMARKET POS').center(40)}")
-    receipt.append(f"{settings.get('store_address', '').center(40)}")
-    receipt.append(f"Tel: {settings.get('store_phone', '').center(40)}")
-    receipt.append("=" * 40)
-    receipt.append("OUTDOOR ORDER RECEIPT".center(40))
-    receipt.append("=" * 40)
-    receipt.append(f"Order #: {order_data['order_id']}")
-    receipt.append(f"Date: {order_data['created_date']}")
-    receipt.append("-" * 40)
-    receipt.append(f"Customer: {order_data['customer_name']}")
-    receipt.append(f"Phone: {order_data.get('customer_phone', 'N/A')}")
-    receipt.append(f"Delivery: {order_data['delivery_type']}")
-    receipt.append("-" * 40)
-    receipt.append("ITEM".ljust(20) + "QTY".rjust(5) + "AMOUNT".rjust(15))
-    receipt.append("-" * 40)
-    
-    for item in order_data['items'].values():
-        name = item['name'][:18] + ('..' if len(item['name']) > 18 else '')
-        receipt.append(f"{name.ljust(20)}{str(item['quantity']).rjust(5)}{format_currency(item['price'] * item['quantity']).rjust(15)}")
-    
-    receipt.append("-" * 40)
-    receipt.append(f"Subtotal:".ljust(25) + format_currency(order_data['subtotal']).rjust(15))
-    receipt.append(f"Delivery:".ljust(25) + format_currency(order_data['delivery_charge']).rjust(15))
-    
-    if order_data.get('payment_charge_amount', 0) > 0:
-        receipt.append(f"Fee ({order_data['payment_charge_percent']}%):".ljust(25) + format_currency(order_data['payment_charge_amount']).rjust(15))
-    
-    receipt.append("=" * 40)
-    receipt.append(f"TOTAL:".ljust(25) + format_currency(order_data['total']).rjust(15))
-    receipt.append("=" * 40)
-    receipt.append(f"Payment: {order_data['payment_method']}")
-    receipt.append(f"Status: {order_data['status'].replace('_', ' ').title()}")
-    receipt.append("-" * 40)
-    receipt.append("DELIVERY ADDRESS:")
-    receipt.append(order_data['delivery_address'])
-    
-    if order_data.get('notes'):
-        receipt.append("-" * 40)
-        receipt.append(f"NOTES: {order_data['notes']}")
-    
-    receipt.append("=" * 40)
-    receipt.append("Thank you for your order!".center(40))
-    receipt.append(get_current_datetime().strftime('%Y-%m-%d %H:%M:%S').center(40))
-    receipt.append(f"Printed by: {order_data['created_by']}".center(40))
-    receipt.append("=" * 40)
-    
-    return "\n".join(receipt)
+    return render_receipt_text(get_receipt_template('outdoor'), outdoor_receipt_context(order_data))
 
 
 def save_draft_order():
@@ -2248,7 +5183,7 @@ def brands_management():
         
         brands_data = load_data(BRANDS_FILE)
         brands_list = brands_data.get('brands', [])
-        brand_products = brands_data.get('brand_products', {})
+        brand_products = get_brand_products()
         
         st.subheader("Current Brands")
         if not brands_list:
@@ -2264,9 +5199,6 @@ def brands_management():
                 if new_brand and new_brand not in brands_list:
                     brands_list.append(new_brand)
                     brands_data['brands'] = brands_list
-                    if new_brand not in brand_products:
-                        brand_products[new_brand] = []
-                    brands_data['brand_products'] = brand_products
                     save_data(brands_data, BRANDS_FILE)
                     st.success(f"Brand '{new_brand}' added successfully")
                     st.rerun()
@@ -2284,9 +5216,6 @@ def brands_management():
                 else:
                     brands_list.remove(brand_to_remove)
                     brands_data['brands'] = brands_list
-                    if brand_to_remove in brand_products:
-                        del brand_products[brand_to_remove]
-                    brands_data['brand_products'] = brand_products
                     save_data(brands_data, BRANDS_FILE)
                     st.success(f"Brand '{brand_to_remove}' removed successfully")
                     st.rerun()
@@ -2321,18 +5250,7 @@ def brands_management():
                     
                     if selected_brand and st.button("Assign Brand"):
                         products[barcode]['brand'] = selected_brand
-                        
-                        # Update brand_products mapping
-                        brand_products = brands_data.get('brand_products', {})
-                        if selected_brand not in brand_products:
-                            brand_products[selected_brand] = []
-                        if barcode not in brand_products[selected_brand]:
-                            brand_products[selected_brand].append(barcode)
-                        
-                        brands_data['brand_products'] = brand_products
-                        
                         save_data(products, PRODUCTS_FILE)
-                        save_data(brands_data, BRANDS_FILE)
                         st.success(f"Brand '{selected_brand}' assigned to {product['name']}")
                         st.rerun()
             
@@ -2348,22 +5266,14 @@ def brands_management():
                 
                 if bulk_brand and st.button("Assign to Selected"):
                     updated_count = 0
-                    brand_products = brands_data.get('brand_products', {})
                     
                     for product_label in selected_products:
                         barcode = all_products[product_label]
-                        products[barcode]['brand'] = bulk_brand
-                        
-                        if bulk_brand not in brand_products:
-                            brand_products[bulk_brand] = []
-                        if barcode not in brand_products[bulk_brand]:
-                            brand_products[bulk_brand].append(barcode)
+                        if products[barcode].get('brand') != bulk_brand:
+                            products[barcode]['brand'] = bulk_brand
                             updated_count += 1
                     
-                    brands_data['brand_products'] = brand_products
-                    
                     save_data(products, PRODUCTS_FILE)
-                    save_data(brands_data, BRANDS_FILE)
                     st.success(f"Brand '{bulk_brand}' assigned to {updated_count} products")
                     st.rerun()
     
@@ -2373,9 +5283,8 @@ def brands_management():
         brands_data = load_data(BRANDS_FILE)
         products = load_data(PRODUCTS_FILE)
         inventory = load_data(INVENTORY_FILE)
-        transactions = load_data(TRANSACTIONS_FILE)
         brands_list = brands_data.get('brands', [])
-        brand_products = brands_data.get('brand_products', {})
+        brand_products = get_brand_products()
         
         if not brands_list:
             st.info("No brands available for reporting")
@@ -2412,20 +5321,13 @@ def brands_management():
                     st.write(f"**Total Inventory Value:** {format_currency(total_value)}")
                     
                     # Sales data (last 30 days)
-                    thirty_days_ago = (datetime.datetime.now() - datetime.timedelta(days=30)).date()
-                    sales_total = 0
-                    units_sold = 0
-                    
-                    for transaction in transactions.values():
-                        try:
-                            trans_date = datetime.datetime.strptime(transaction.get('date', ''), "%Y-%m-%d %H:%M:%S").date()
-                            if trans_date >= thirty_days_ago:
-                                for barcode, item in transaction.get('items', {}).items():
-                                    if barcode in brand_products.get(selected_brand, []):
-                                        sales_total += item['price'] * item['quantity']
-                                        units_sold += item['quantity']
-                        except (ValueError, KeyError):
-                            continue
+                    today = get_current_datetime().date()
+                    brand_sales = brand_sales_frame(today - datetime.timedelta(days=30), today)
+                    if selected_brand in brand_sales.index:
+                        sales_total = brand_sales.at[selected_brand, 'revenue']
+                        units_sold = brand_sales.at[selected_brand, 'units']
+                    else:
+                        sales_total = units_sold = 0
                     
                     st.write(f"**Sales (Last 30 Days):** {format_currency(sales_total)}")
                     st.write(f"**Units Sold (Last 30 Days):** {units_sold}")
@@ -2443,24 +5345,7 @@ def brands_management():
                 with col2:
                     end_date = st.date_input("End Date", value=datetime.date.today())
                 
-                brand_sales = {}
-                for brand in brands_list:
-                    brand_sales[brand] = {'revenue': 0, 'units': 0}
-                
-                for transaction in transactions.values():
-                    try:
-                        trans_date = datetime.datetime.strptime(transaction.get('date', ''), "%Y-%m-%d %H:%M:%S").date()
-                        if start_date <= trans_date <= end_date:
-                            for barcode, item in transaction.get('items', {}).items():
-                                product = products.get(barcode, {})
-                                brand = product.get('brand')
-                                if brand and brand in brand_sales:
-                                    brand_sales[brand]['revenue'] += item['price'] * item['quantity']
-                                    brand_sales[brand]['units'] += item['quantity']
-                    except (ValueError, KeyError):
-                        continue
-                
-                sales_df = pd.DataFrame.from_dict(brand_sales, orient='index')
+                sales_df = brand_sales_frame(start_date, end_date, brands_list)[['revenue', 'units']]
                 sales_df = sales_df.sort_values('revenue', ascending=False)
                 
                 st.dataframe(sales_df)
@@ -2509,48 +5394,6 @@ def brands_management():
                 # Chart
                 st.bar_chart(count_df['Product Count'])
 
-def generate_receipt(transaction):
-    settings = load_data(SETTINGS_FILE)
-    receipt = ""
-    
-    # Header
-    receipt += f"{settings.get('store_name', 'Supermarket POS')}\n"
-    receipt += f"{settings.get('store_address', '')}\n"
-    receipt += f"{settings.get('store_phone', '')}\n"
-    receipt += "=" * 40 + "\n"
-    
-    if settings.get('receipt_header', ''):
-        receipt += f"{settings['receipt_header']}\n"
-        receipt += "=" * 40 + "\n"
-    
-    receipt += f"Date: {transaction['date']}\n"
-    receipt += f"Cashier: {transaction['cashier']}\n"
-    receipt += f"Transaction ID: {transaction['transaction_id']}\n"
-    receipt += "=" * 40 + "\n"
-    
-    # Items
-    for barcode, item in transaction['items'].items():
-        receipt += f"{item['name']} x{item['quantity']}: {format_currency(item['price'] * item['quantity'])}\n"
-    
-    receipt += "=" * 40 + "\n"
-    receipt += f"Subtotal: {format_currency(transaction['subtotal'])}\n"
-    receipt += f"Tax: {format_currency(transaction['tax'])}\n"
-    if transaction['discount'] != 0:
-        receipt += f"Discount: -{format_currency(abs(transaction['discount']))}\n"
-    receipt += f"Total: {format_currency(transaction['total'])}\n"
-    receipt += f"Payment Method: {transaction['payment_method']}\n"
-    receipt += f"Amount Tendered: {format_currency(transaction['amount_tendered'])}\n"
-    receipt += f"Change: {format_currency(transaction['change'])}\n"
-    receipt += "=" * 40 + "\n"
-    
-    if settings.get('receipt_footer', ''):
-        receipt += f"{settings['receipt_footer']}\n"
-        receipt += "=" * 40 + "\n"
-    
-    receipt += "Thank you for shopping with us!\n"
-    
-    return receipt
-
 # Returns & Refunds Management
 # Returns & Refunds Management with proper receipt printing
 # Returns & Refunds Management Module
@@ -2698,7 +5541,8 @@ def process_return_tab():
             
             return_items = {}
             for barcode, item in transaction['items'].items():
-                with st.expander(f"{item['name']} - {item['quantity']} x {format_currency(item['price'])}"):
+                item_name = resolve_line_name(barcode, item, products)
+                with st.expander(f"{item_name} - {item['quantity']} x {format_currency(item['price'])}"):
                     col1, col2 = st.columns(2)
                     with col1:
                         max_returnable = item['quantity']
@@ -2734,10 +5578,10 @@ def process_return_tab():
                             
                             if return_qty > 0 and return_reason and condition:
                                 return_items[barcode] = {
-                                    'name': item['name'],
+                                    'name': item_name,
                                     'quantity': return_qty,
                                     'price': item['price'],
-                                    'subtotal': return_qty * item['price'],
+                                    'subtotal': from_minor(return_qty * to_minor(item['price'])),
                                     'reason': return_reason,
                                     'condition': condition
                                 }
@@ -2748,10 +5592,14 @@ def process_return_tab():
                 st.subheader("Step 3: Process Return")
                 
                 # Calculate refund amounts
-                total_refund = sum(item['subtotal'] for item in return_items.values())
-                original_tax_rate = transaction['tax'] / transaction['subtotal'] if transaction['subtotal'] > 0 else 0
-                tax_refund = total_refund * original_tax_rate
-                total_refund_amount = total_refund + tax_refund
+                refund_minor = sum(to_minor(item['subtotal']) for item in return_items.values())
+                original_subtotal = to_minor(transaction['subtotal'])
+                # Tax comes back in the proportion it was charged on the original sale
+                tax_refund_minor = (scale_minor(to_minor(transaction['tax']), decimal.Decimal(refund_minor) / original_subtotal)
+                                    if original_subtotal > 0 else 0)
+                total_refund = from_minor(refund_minor)
+                tax_refund = from_minor(tax_refund_minor)
+                total_refund_amount = from_minor(refund_minor + tax_refund_minor)
                 
                 st.write(f"**Subtotal Refund:** {format_currency(total_refund)}")
                 st.write(f"**Tax Refund:** {format_currency(tax_refund)}")
@@ -2780,7 +5628,7 @@ def process_return_tab():
                         'return_id': return_id,
                         'transaction_id': transaction_id,
                         'original_date': transaction['date'],
-                        'return_date': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
+                        **timestamp_fields('return_date'),
                         'items': return_items,
                         'subtotal_refund': total_refund,
                         'tax_refund': tax_refund,
@@ -2799,15 +5647,25 @@ def process_return_tab():
                         return_record['customer_id'] = customer_id
                     
                     # Update inventory
-                    for barcode, item in return_items.items():
-                        if barcode in inventory:
-                            inventory[barcode]['quantity'] += item['quantity']
-                        else:
-                            inventory[barcode] = {'quantity': item['quantity']}
+                    movements = []
+                    with locked_inventory() as inventory:
+                        for barcode, item in return_items.items():
+                            if barcode in inventory:
+                                inventory[barcode]['quantity'] += item['quantity']
+                            else:
+                                inventory[barcode] = {'quantity': item['quantity']}
+                            movements.append(stock_movement(barcode, item['quantity'], inventory[barcode]['quantity'],
+                                                            'return', return_id, st.session_state.user_info['username'],
+                                                            note=item['reason']))
+                            
+                            # Add restock note
+                            inventory[barcode]['last_restock'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                            inventory[barcode]['restock_reason'] = f"Return: {item['reason']}"
                         
-                        # Add restock note
-                        inventory[barcode]['last_restock'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                        inventory[barcode]['restock_reason'] = f"Return: {item['reason']}"
+                        # Post the return while the lock is held; the reconciler writes the same rollups
+                        returns[return_id] = return_record
+                        save_data(returns, RETURNS_FILE)
+                        update_sales_rollups(returns=[return_record])
                     
                     # Handle cash drawer if refund is cash
                     if refund_method == "Cash" and is_cashier() and st.session_state.shift_started:
@@ -2822,10 +5680,8 @@ def process_return_tab():
                         })
                         save_data(cash_drawer, CASH_DRAWER_FILE)
                     
-                    # Save everything
-                    returns[return_id] = return_record
-                    save_data(returns, RETURNS_FILE)
-                    save_data(inventory, INVENTORY_FILE)
+                    # Save everything; the low-stock count follows the inventory stamp
+                    record_stock_movements(movements)
                     
                     st.success(f"Return processed successfully! Return ID: {return_id}")
                     
@@ -2868,14 +5724,8 @@ def return_analytics_tab():
         end_date = st.date_input("End Date", value=datetime.date.today())
     
     # Filter returns by date
-    filtered_returns = []
-    for return_data in returns.values():
-        try:
-            return_date = datetime.datetime.strptime(return_data['return_date'], "%Y-%m-%d %H:%M:%S").date()
-            if start_date <= return_date <= end_date:
-                filtered_returns.append(return_data)
-        except (ValueError, KeyError):
-            continue
+    start_ts, end_ts = day_bounds(start_date, end_date)
+    filtered_returns = [r for r in returns.values() if in_ts_range(r, start_ts, end_ts, field='return_date')]
     
     if not filtered_returns:
         st.info("No returns in selected date range")
@@ -2958,15 +5808,12 @@ def view_returns_tab():
         refund_filter = st.selectbox("Refund Method", ["All", "Cash", "Store Credit", "Original Payment Method", "Exchange"])
     
     # Apply filters
+    filter_days = {"Last 7 days": 7, "Last 30 days": 30, "Last 90 days": 90}.get(date_filter)
+    since_ts = int(time.time()) - filter_days * 86400 if filter_days else None
     filtered_returns = []
     for return_id, return_data in returns.items():
         # Date filter
-        return_date = datetime.datetime.strptime(return_data['return_date'], "%Y-%m-%d %H:%M:%S")
-        if date_filter == "Last 7 days" and return_date < datetime.datetime.now() - datetime.timedelta(days=7):
-            continue
-        if date_filter == "Last 30 days" and return_date < datetime.datetime.now() - datetime.timedelta(days=30):
-            continue
-        if date_filter == "Last 90 days" and return_date < datetime.datetime.now() - datetime.timedelta(days=90):
+        if since_ts is not None and not in_ts_range(return_data, since_ts, field='return_date'):
             continue
         
         # Status filter
@@ -3051,11 +5898,8 @@ def refund_history_tab():
         end_date = st.date_input("End Date", value=datetime.date.today(), key="refund_end")
     
     # Filter returns by date
-    filtered_returns = []
-    for return_data in returns.values():
-        return_date = datetime.datetime.strptime(return_data['return_date'], "%Y-%m-%d %H:%M:%S").date()
-        if start_date <= return_date <= end_date:
-            filtered_returns.append(return_data)
+    start_ts, end_ts = day_bounds(start_date, end_date)
+    filtered_returns = [r for r in returns.values() if in_ts_range(r, start_ts, end_ts, field='return_date')]
     
     if not filtered_returns:
         st.info("No refunds in selected date range")
@@ -3105,57 +5949,7 @@ def refund_history_tab():
                 st.write(f"**Status:** {return_data['status']}")
 
 def generate_return_receipt(return_data):
-    settings = load_data(SETTINGS_FILE)
-    receipt = []
-    
-    # Header
-    receipt.append("=" * 50)
-    receipt.append(f"{settings.get('store_name', 'SUPERMARKET POS').center(50)}")
-    receipt.append(f"{settings.get('store_address', '').center(50)}")
-    receipt.append(f"Tel: {settings.get('store_phone', '').center(50)}")
-    receipt.append("=" * 50)
-    receipt.append("RETURN RECEIPT".center(50))
-    receipt.append("=" * 50)
-    
-    # Return information
-    receipt.append(f"Return ID: {return_data['return_id']}")
-    receipt.append(f"Original Transaction: {return_data['transaction_id']}")
-    receipt.append(f"Date: {return_data['return_date']}")
-    receipt.append(f"Processed by: {return_data['processed_by']}")
-    receipt.append(f"Reason: {return_data['reason']}")
-    receipt.append("-" * 50)
-    
-    # Items header
-    receipt.append("RETURNED ITEMS:")
-    receipt.append("-" * 50)
-    receipt.append(f"{'ITEM'.ljust(30)}{'QTY'.rjust(5)}{'AMOUNT'.rjust(15)}")
-    receipt.append("-" * 50)
-    
-    # Items
-    for barcode, item in return_data['items'].items():
-        name = item['name'][:28] + ('..' if len(item['name']) > 28 else '')
-        receipt.append(f"{name.ljust(30)}{str(item['quantity']).rjust(5)}{format_currency(item['subtotal']).rjust(15)}")
-    
-    # Totals
-    receipt.append("-" * 50)
-    receipt.append(f"{'Subtotal Refund:'.ljust(35)}{format_currency(return_data['total_refund'] - return_data['tax_refund']).rjust(15)}")
-    receipt.append(f"{'Tax Refund:'.ljust(35)}{format_currency(return_data['tax_refund']).rjust(15)}")
-    receipt.append("=" * 50)
-    receipt.append(f"{'TOTAL REFUND:'.ljust(35)}{format_currency(return_data['total_refund']).rjust(15)}")
-    receipt.append("=" * 50)
-    
-    # Payment information
-    receipt.append(f"Refund Method: {return_data['refund_method']}")
-    receipt.append(f"Status: {return_data['status']}")
-    receipt.append("-" * 50)
-    
-    # Footer
-    if settings.get('receipt_footer', ''):
-        receipt.append(settings['receipt_footer'])
-    receipt.append("Thank you for your business!".center(50))
-    receipt.append("=" * 50)
-    
-    return "\n".join(receipt)
+    return render_receipt_text(get_receipt_template('return'), return_receipt_context(return_data))
 
 def print_receipt_page(receipt_text, receipt_title):
     """Create a printable HTML page for the receipt"""
@@ -3270,209 +6064,87 @@ def print_receipt_page(receipt_text, receipt_title):
         <div class="no-print">
             <button class="print-btn" onclick="window.print()">
                 🖨️ Print Receipt Now
-            </button>
-            
-            <div class="instructions">
-                <p><strong>Tip:</strong> For best results, use landscape orientation if your receipt is wide.</p>
-                <p>If printing doesn't work, use the download option in the main application.</p>
-            </div>
-        </div>
-        
-        <div class="print-only">
-            <p>Printed on: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
-        </div>
-    </body>
-    </html>
-    """
-    
-    # Create temporary directory if it doesn't exist
-    os.makedirs("print_cache", exist_ok=True)
-    
-    # Generate unique filename
-    timestamp = int(time.time())
-    filename = f"print_cache/receipt_{timestamp}.html"
-    
-    try:
-        # Save HTML file
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(html_content)
-        
-        # Open in new tab
-        js_code = f"""
-        <script>
-        function openPrintPage() {{
-            window.open('{filename}', '_blank', 'width=800,height=1000');
-        }}
-        openPrintPage();
-        </script>
-        """
-        
-        st.components.v1.html(js_code, height=0)
-        return True
-        
-    except Exception as e:
-        st.error(f"Error creating print page: {str(e)}")
-        # Fallback: show receipt in expander
-        with st.expander("Printing Failed - View Receipt Content"):
-            st.text(receipt_text)
-            st.info("Please use your browser's print function or the download option.")
-        return False
-
-# Initialize clipboard state
-if 'clipboard_text' not in st.session_state:
-    st.session_state.clipboard_text = ""
-
-# Purchase Orders Management
-# Constants (at the top of your file)
-PURCHASE_ORDERS_FILE = os.path.join(DATA_DIR, "purchase_orders.json")
-
-def generate_purchase_order(supplier_id, items):
-    suppliers = load_data(SUPPLIERS_FILE)
-    products = load_data(PRODUCTS_FILE)
-    purchase_orders = load_data(PURCHASE_ORDERS_FILE)
-    
-    if supplier_id not in suppliers:
-        return None
-    
-    supplier = suppliers[supplier_id]
-    po_id = generate_short_id()
-    
-    # Calculate totals
-    total_cost = 0
-    for item in items:
-        product = products.get(item['barcode'], {})
-        total_cost += item['quantity'] * product.get('cost', 0)
-    
-    # Create PO
-    purchase_orders[po_id] = {
-        'po_id': po_id,
-        'supplier_id': supplier_id,
-        'supplier_name': supplier['name'],
-        'date_created': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
-        'created_by': st.session_state.user_info['username'],
-        'items': items,
-        'total_cost': total_cost,
-        'status': 'pending',  # pending, partially_received, received, cancelled
-        'receipts': [],  # Array to track multiple receipts
-        'date_received': None,
-        'received_by': None
-    }
-    
-    save_data(purchase_orders, PURCHASE_ORDERS_FILE)
-    return po_id
-
-def generate_po_report(po_id):
-    purchase_orders = load_data(PURCHASE_ORDERS_FILE)
-    products = load_data(PRODUCTS_FILE)
-    settings = load_data(SETTINGS_FILE)
-    
-    if po_id not in purchase_orders:
-        return None
-    
-    po = purchase_orders[po_id]
-    
-    report = f"PURCHASE ORDER #{po_id}\n"
-    report += f"{settings.get('store_name', 'Supermarket POS')}\n"
-    report += f"Date: {po['date_created']}\n"
-    report += "=" * 50 + "\n"
-    report += f"Supplier: {po['supplier_name']}\n"
-    report += f"Created by: {po['created_by']}\n"
-    report += "=" * 50 + "\n"
-    report += "ITEMS:\n"
-    report += "Barcode\tProduct\tQty\tUnit Cost\tTotal\n"
-    
-    for item in po['items']:
-        product = products.get(item['barcode'], {'name': 'Unknown', 'cost': 0})
-        report += f"{item['barcode']}\t{product['name']}\t{item['quantity']}\t"
-        report += f"{format_currency(product.get('cost', 0))}\t"
-        report += f"{format_currency(item['quantity'] * product.get('cost', 0))}\n"
-    
-    report += "=" * 50 + "\n"
-    report += f"TOTAL COST: {format_currency(po['total_cost'])}\n"
-    report += f"STATUS: {po['status'].upper().replace('_', ' ')}\n"
-    
-    if po['receipts']:
-        report += "\nRECEIPT HISTORY:\n"
-        for receipt in po['receipts']:
-            report += f"- {receipt['date']} by {receipt['received_by']}\n"
-            for item in receipt['items']:
-                report += f"  {item['name']}: {item['received_quantity']}/{item['ordered_quantity']}\n"
-    
-    if po['status'] in ['received', 'partially_received']:
-        report += f"\nCompleted on: {po['date_received']} by {po['received_by']}\n"
-    
-    return report
-
-def process_received_po(po_id, received_items, notes, mark_as_complete=False):
-    purchase_orders = load_data(PURCHASE_ORDERS_FILE)
-    inventory = load_data(INVENTORY_FILE)
-    products = load_data(PRODUCTS_FILE)
-    
-    if po_id not in purchase_orders:
-        return False
-    
-    po = purchase_orders[po_id]
-    
-    if po['status'] == 'received':
-        return True  # Already fully processed
-    
-    # Update inventory only for received items
-    for item in received_items:
-        if item['received_quantity'] > 0:
-            barcode = item['barcode']
-            
-            if barcode in inventory:
-                inventory[barcode]['quantity'] += item['received_quantity']
-            else:
-                # Initialize inventory with default values if product doesn't exist in inventory
-                inventory[barcode] = {
-                    'quantity': item['received_quantity'],
-                    'reorder_point': 10,  # Default reorder point
-                    'cost': products.get(barcode, {}).get('cost', 0)  # Get cost from products if available
-                }
-            
-            inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-            inventory[barcode]['updated_by'] = st.session_state.user_info['username']
-    
-    # Update PO status
-    if all(item['received_quantity'] == item['ordered_quantity'] for item in received_items):
-        po['status'] = 'received'
-    elif mark_as_complete:
-        po['status'] = 'partially_received'
-    else:
-        po['status'] = 'pending'  # Still waiting for more items
+            </button>
+            
+            <div class="instructions">
+                <p><strong>Tip:</strong> For best results, use landscape orientation if your receipt is wide.</p>
+                <p>If printing doesn't work, use the download option in the main application.</p>
+            </div>
+        </div>
+        
+        <div class="print-only">
+            <p>Printed on: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
+        </div>
+    </body>
+    </html>
+    """
     
-    # Add receipt details to PO
-    po['receipts'] = po.get('receipts', [])
-    po['receipts'].append({
-        'date': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
-        'received_by': st.session_state.user_info['username'],
-        'items': received_items,
-        'notes': notes
-    })
+    # Create temporary directory if it doesn't exist
+    os.makedirs("print_cache", exist_ok=True)
     
-    # Update the PO items if partially received and marked as complete
-    if mark_as_complete and po['status'] == 'partially_received':
-        # Adjust PO items to only include remaining quantities
-        po['items'] = [
-            {
-                'barcode': item['barcode'],
-                'name': item['name'],
-                'quantity': item['ordered_quantity'] - item['received_quantity'],
-                'cost': item['cost']
-            }
-            for item in received_items
-            if item['received_quantity'] < item['ordered_quantity']
-        ]
+    # Generate unique filename
+    timestamp = int(time.time())
+    filename = f"print_cache/receipt_{timestamp}.html"
     
-    # Update completion info if fully or partially completed
-    if po['status'] in ['received', 'partially_received']:
-        po['date_received'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-        po['received_by'] = st.session_state.user_info['username']
+    try:
+        # Save HTML file
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(html_content)
+        
+        # Open in new tab
+        js_code = f"""
+        <script>
+        function openPrintPage() {{
+            window.open('{filename}', '_blank', 'width=800,height=1000');
+        }}
+        openPrintPage();
+        </script>
+        """
+        
+        st.components.v1.html(js_code, height=0)
+        return True
+        
+    except Exception as e:
+        st.error(f"Error creating print page: {str(e)}")
+        # Fallback: show receipt in expander
+        with st.expander("Printing Failed - View Receipt Content"):
+            st.text(receipt_text)
+            st.info("Please use your browser's print function or the download option.")
+        return False
+
+# Initialize clipboard state
+if 'clipboard_text' not in st.session_state:
+    st.session_state.clipboard_text = ""
+
+# Purchase Orders Management
+def auto_replenish_tab():
+    st.header("Auto Replenish")
+    st.info("Items below their reorder point, ordered up to the reorder point plus forecast demand over the "
+            "supplier's lead time, less stock on hand and quantities already on open orders.")
+    
+    plan = replenishment_plan()
+    if plan.empty:
+        st.success("Nothing to order: all items are above their reorder point or already on order")
+        return
     
-    save_data(purchase_orders, PURCHASE_ORDERS_FILE)
-    save_data(inventory, INVENTORY_FILE)
-    return True
+    supplier_totals = plan.assign(value=plan['order_quantity'] * plan['cost']).groupby('supplier').agg(
+        items=('barcode', 'size'), units=('order_quantity', 'sum'), value=('value', 'sum')).reset_index()
+    st.dataframe(money_columns_to_units(supplier_totals, ['value']).rename(columns={
+        'supplier': 'Supplier', 'items': 'Items', 'units': 'Units', 'value': 'Order Value'
+    }), hide_index=True)
+    st.dataframe(money_columns_to_units(plan, ['cost']).rename(columns={
+        'barcode': 'Barcode', 'product': 'Product', 'supplier': 'Supplier', 'quantity': 'Current Stock',
+        'reorder_point': 'Reorder Point', 'on_order': 'On Order', 'order_quantity': 'Order Qty', 'cost': 'Unit Cost'
+    }), hide_index=True)
+    
+    if st.button(f"Create Draft POs for {len(supplier_totals)} Suppliers", key="create_replenishment_drafts"):
+        po_ids, skipped = create_replenishment_drafts(st.session_state.user_info['username'])
+        if po_ids:
+            st.success(f"Created {len(po_ids)} draft purchase orders: {', '.join(po_ids)}. "
+                       "Review and submit them under View POs.")
+        if not skipped.empty:
+            st.warning(f"{len(skipped)} items have no known supplier and were not ordered: "
+                       f"{', '.join(skipped['product'].head(20))}")
 
 def purchase_orders_management():
     if not is_manager():
@@ -3481,7 +6153,7 @@ def purchase_orders_management():
     
     st.title("Purchase Orders Management")
     
-    tab1, tab2, tab3 = st.tabs(["Create PO", "View POs", "Receive PO"])
+    tab1, tab2, tab3, tab4 = st.tabs(["Create PO", "View POs", "Receive PO", "Auto Replenish"])
     
     with tab1:
         st.header("Create Purchase Order")
@@ -3631,17 +6303,17 @@ def purchase_orders_management():
     with tab2:
         st.header("View Purchase Orders")
         
-        purchase_orders = load_data(PURCHASE_ORDERS_FILE)
-        suppliers = load_data(SUPPLIERS_FILE)
+        store = get_po_store()
+        supplier_names = store.supplier_names()
         
-        if not purchase_orders:
+        if not supplier_names:
             st.info("No purchase orders available")
         else:
             col1, col2 = st.columns(2)
             with col1:
-                status_filter = st.selectbox("Filter by Status", ["All", "pending", "partially_received", "received"])
+                status_filter = st.selectbox("Filter by Status", ["All"] + list(PO_STATUSES))
             with col2:
-                supplier_filter = st.selectbox("Filter by Supplier", ["All"] + list(set(po['supplier_name'] for po in purchase_orders.values())))
+                supplier_filter = st.selectbox("Filter by Supplier", ["All"] + supplier_names)
             
             col1, col2 = st.columns(2)
             with col1:
@@ -3649,28 +6321,27 @@ def purchase_orders_management():
             with col2:
                 end_date = st.date_input("End Date", value=datetime.date.today())
             
-            filtered_pos = []
-            for po_id, po in purchase_orders.items():
-                try:
-                    po_date = datetime.datetime.strptime(po['date_created'], "%Y-%m-%d %H:%M:%S").date()
-                    if (status_filter == "All" or po['status'] == status_filter) and \
-                       (supplier_filter == "All" or po['supplier_name'] == supplier_filter) and \
-                       (start_date <= po_date <= end_date):
-                        filtered_pos.append(po)
-                except (ValueError, KeyError):
-                    continue
+            start_ts, end_ts = day_bounds(start_date, end_date)
+            filtered_pos = store.list(statuses=None if status_filter == "All" else [status_filter],
+                                      supplier=None if supplier_filter == "All" else supplier_filter,
+                                      start_ts=start_ts, end_ts=end_ts)
             
             if not filtered_pos:
                 st.info("No purchase orders match the filters")
             else:
                 st.subheader("Purchase Orders Summary")
+                page_count = (len(filtered_pos) - 1) // PO_PAGE_SIZE + 1
+                page = st.number_input("Page", min_value=1, max_value=page_count, value=1, step=1, key="po_page")
+                page_pos = filtered_pos[(page - 1) * PO_PAGE_SIZE:page * PO_PAGE_SIZE]
+                st.caption(f"{len(filtered_pos)} purchase orders, page {page} of {page_count}")
+                
                 po_summary = []
-                for po in filtered_pos:
+                for po in page_pos:
                     po_summary.append({
                         'PO ID': po['po_id'],
                         'Supplier': po['supplier_name'],
                         'Date': po['date_created'],
-                        'Items': len(po['items']),
+                        'Items': po['item_count'],
                         'Total Cost': format_currency(po['total_cost']),
                         'Status': po['status'].capitalize().replace('_', ' '),
                         'Created By': po['created_by']
@@ -3678,15 +6349,12 @@ def purchase_orders_management():
                 
                 st.dataframe(pd.DataFrame(po_summary))
                 
-                selected_po = st.selectbox("View PO Details", [""] + [f"{po['po_id']} - {po['supplier_name']}" for po in filtered_pos])
+                selected_po = st.selectbox("View PO Details", [""] + [f"{po['po_id']} - {po['supplier_name']}" for po in page_pos])
                 
                 if selected_po:
                     po_id = selected_po.split(" - ")[0]
-                    po = purchase_orders[po_id]
-                    
-                    # Initialize receipts if not exists
-                    if 'receipts' not in po:
-                        po['receipts'] = []
+                    po = store.get(po_id)
+                    receipts = po_receipts(po_id)
                     
                     st.subheader(f"Purchase Order #{po_id}")
                     st.write(f"Supplier: {po['supplier_name']}")
@@ -3699,27 +6367,49 @@ def purchase_orders_management():
                     items_df = pd.DataFrame(po['items'])
                     st.dataframe(items_df)
                     
-                    if po['receipts']:
+                    if receipts:
                         st.subheader("Receipt History")
-                        for receipt in po['receipts']:
+                        for receipt in receipts:
                             st.write(f"**{receipt['date']}** by {receipt['received_by']}")
                             if receipt.get('notes'):
                                 st.write(f"Notes: {receipt['notes']}")
                             receipt_df = pd.DataFrame(receipt['items'])
                             st.dataframe(receipt_df)
                     
+                    if po['status'] == 'draft':
+                        col1, col2 = st.columns(2)
+                        with col1:
+                            if st.button("Submit Draft", key=f"submit_draft_{po_id}"):
+                                po['status'] = 'pending'
+                                store.save(po)
+                                st.success("Purchase order submitted")
+                                st.rerun()
+                        with col2:
+                            if st.button("Delete Draft", key=f"delete_draft_{po_id}"):
+                                store.delete(po_id)
+                                st.success("Draft deleted")
+                                st.rerun()
+                    
                     if st.button("Print PO"):
                         po_report = generate_po_report(po_id)
                         if print_receipt(po_report):
                             st.success("Purchase order printed successfully")
                         else:
                             st.error("Failed to print purchase order")
+                    
+                    st.download_button(
+                        "Download PO PDF",
+                        data=generate_po_report(po_id, output='pdf'),
+                        file_name=f"purchase_order_{po_id}.pdf",
+                        mime="application/pdf",
+                        key=f"po_pdf_{po_id}"
+                    )
 
     with tab3:
         st.header("Receive Purchase Order")
         
-        purchase_orders = load_data(PURCHASE_ORDERS_FILE)
-        pending_pos = [po for po in purchase_orders.values() if po.get('status') in ['pending', 'partially_received']]
+        store = get_po_store()
+        pending_pos = store.list(statuses=['pending', 'partially_received'])
         
         if not pending_pos:
             st.info("No pending purchase orders to receive")
@@ -3728,11 +6418,8 @@ def purchase_orders_management():
             
             if selected_po:
                 po_id = selected_po.split(" - ")[0]
-                po = purchase_orders[po_id]
-                
-                # Initialize receipts if not exists
-                if 'receipts' not in po:
-                    po['receipts'] = []
+                po = store.get(po_id)
+                receipts = po_receipts(po_id)
                 
                 st.subheader(f"Purchase Order #{po_id}")
                 st.write(f"Supplier: {po['supplier_name']}")
@@ -3740,9 +6427,9 @@ def purchase_orders_management():
                 st.write(f"Total Cost: {format_currency(po['total_cost'])}")
                 st.write(f"Current Status: {po['status'].capitalize().replace('_', ' ')}")
                 
-                if po['receipts']:
+                if receipts:
                     st.subheader("Previous Receipts")
-                    for receipt in po['receipts']:
+                    for receipt in receipts:
                         st.write(f"**{receipt['date']}** by {receipt['received_by']}")
                         if receipt.get('notes'):
                             st.write(f"Notes: {receipt['notes']}")
@@ -3782,149 +6469,9 @@ def purchase_orders_management():
                                 st.rerun()
                             else:
                                 st.error("Failed to process receipt")
-
-def generate_purchase_order(supplier_id, items):
-    suppliers = load_data(SUPPLIERS_FILE)
-    products = load_data(PRODUCTS_FILE)
-    purchase_orders = load_data(PURCHASE_ORDERS_FILE)
-    
-    if supplier_id not in suppliers:
-        return None
-    
-    supplier = suppliers[supplier_id]
-    po_id = generate_short_id()
-    
-    # Calculate totals
-    total_cost = 0
-    for item in items:
-        product = products.get(item['barcode'], {})
-        total_cost += item['quantity'] * product.get('cost', 0)
-    
-    # Create PO
-    purchase_orders[po_id] = {
-        'po_id': po_id,
-        'supplier_id': supplier_id,
-        'supplier_name': supplier['name'],
-        'date_created': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
-        'created_by': st.session_state.user_info['username'],
-        'items': items,
-        'total_cost': total_cost,
-        'status': 'pending',
-        'date_received': None,
-        'received_by': None
-    }
-    
-    save_data(purchase_orders, PURCHASE_ORDERS_FILE)
-    return po_id
-
-def generate_po_report(po_id):
-    purchase_orders = load_data(PURCHASE_ORDERS_FILE)
-    products = load_data(PRODUCTS_FILE)
-    settings = load_data(SETTINGS_FILE)
-    
-    if po_id not in purchase_orders:
-        return None
-    
-    po = purchase_orders[po_id]
-    
-    report = f"PURCHASE ORDER #{po_id}\n"
-    report += f"{settings.get('store_name', 'Supermarket POS')}\n"
-    report += f"Date: {po['date_created']}\n"
-    report += "=" * 50 + "\n"
-    report += f"Supplier: {po['supplier_name']}\n"
-    report += f"Created by: {po['created_by']}\n"
-    report += "=" * 50 + "\n"
-    report += "ITEMS:\n"
-    report += "Barcode\tProduct\tQty\tUnit Cost\tTotal\n"
-    
-    for item in po['items']:
-        product = products.get(item['barcode'], {'name': 'Unknown', 'cost': 0})
-        report += f"{item['barcode']}\t{product['name']}\t{item['quantity']}\t"
-        report += f"{format_currency(product.get('cost', 0))}\t"
-        report += f"{format_currency(item['quantity'] * product.get('cost', 0))}\n"
-    
-    report += "=" * 50 + "\n"
-    report += f"TOTAL COST: {format_currency(po['total_cost'])}\n"
-    report += f"STATUS: {po['status'].upper()}\n"
-    
-    if po['status'] == 'received':
-        report += f"Received on: {po['date_received']} by {po['received_by']}\n"
-    
-    return report
-
-def process_received_po(po_id, received_items, notes, mark_as_complete=False):
-    purchase_orders = load_data(PURCHASE_ORDERS_FILE)
-    inventory = load_data(INVENTORY_FILE)
-    products = load_data(PRODUCTS_FILE)
-    
-    if po_id not in purchase_orders:
-        return False
-    
-    po = purchase_orders[po_id]
-    
-    if po['status'] == 'received':
-        return True  # Already fully processed
-    
-    # Initialize receipts if not exists
-    if 'receipts' not in po:
-        po['receipts'] = []
-    
-    # Update inventory only for received items
-    for item in received_items:
-        if item['received_quantity'] > 0:
-            barcode = item['barcode']
-            
-            if barcode in inventory:
-                inventory[barcode]['quantity'] += item['received_quantity']
-            else:
-                # Initialize inventory with default values if product doesn't exist in inventory
-                inventory[barcode] = {
-                    'quantity': item['received_quantity'],
-                    'reorder_point': 10,  # Default reorder point
-                    'cost': products.get(barcode, {}).get('cost', 0)  # Get cost from products if available
-                }
-            
-            inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-            inventory[barcode]['updated_by'] = st.session_state.user_info['username']
-    
-    # Update PO status
-    if all(item['received_quantity'] == item['ordered_quantity'] for item in received_items):
-        po['status'] = 'received'
-    elif mark_as_complete:
-        po['status'] = 'partially_received'
-    else:
-        po['status'] = 'pending'  # Still waiting for more items
-    
-    # Add receipt details to PO
-    po['receipts'].append({
-        'date': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
-        'received_by': st.session_state.user_info['username'],
-        'items': received_items,
-        'notes': notes
-    })
-    
-    # Update the PO items if partially received and marked as complete
-    if mark_as_complete and po['status'] == 'partially_received':
-        # Adjust PO items to only include remaining quantities
-        po['items'] = [
-            {
-                'barcode': item['barcode'],
-                'name': item['name'],
-                'quantity': item['ordered_quantity'] - item['received_quantity'],
-                'cost': item['cost']
-            }
-            for item in received_items
-            if item['received_quantity'] < item['ordered_quantity']
-        ]
-    
-    # Update completion info if fully or partially completed
-    if po['status'] in ['received', 'partially_received']:
-        po['date_received'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-        po['received_by'] = st.session_state.user_info['username']
     
-    save_data(purchase_orders, PURCHASE_ORDERS_FILE)
-    save_data(inventory, INVENTORY_FILE)
-    return True
+    with tab4:
+        auto_replenish_tab()
 
 # product Management 
 def product_management():
@@ -4101,7 +6648,6 @@ def product_management():
                         st.error(error)
                 else:
                     products = load_data(PRODUCTS_FILE)
-                    inventory = load_data(INVENTORY_FILE)
                     
                     # Generate barcode if needed
                     if not barcode or barcode_option == "Generate Automatically":
@@ -4141,26 +6687,19 @@ def product_management():
                             products[barcode]['image'] = image_path
                         
                         # Initialize inventory
-                        inventory[barcode] = {
-                            'quantity': initial_stock,
-                            'reorder_point': reorder_point,
-                            'last_updated': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
-                            'updated_by': st.session_state.user_info['username']
-                        }
-                        
-                        # Update brand mapping if brand is selected
-                        if brand:
-                            brands_data = load_data(BRANDS_FILE)
-                            brand_products = brands_data.get('brand_products', {})
-                            if brand not in brand_products:
-                                brand_products[brand] = []
-                            if barcode not in brand_products[brand]:
-                                brand_products[brand].append(barcode)
-                            brands_data['brand_products'] = brand_products
-                            save_data(brands_data, BRANDS_FILE)
+                        with locked_inventory() as inventory:
+                            inventory[barcode] = {
+                                'quantity': initial_stock,
+                                'reorder_point': reorder_point,
+                                'last_updated': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
+                                'updated_by': st.session_state.user_info['username']
+                            }
                         
                         save_data(products, PRODUCTS_FILE)
-                        save_data(inventory, INVENTORY_FILE)
+                        record_stock_movements([stock_movement(
+                            barcode, initial_stock, initial_stock, 'product', 'initial_stock',
+                            st.session_state.user_info['username']
+                        )])
                         st.success(f"Product '{name}' added successfully with barcode: {barcode}")
 
     with tab2:
@@ -4401,33 +6940,19 @@ def product_management():
                                     products[barcode]['image'] = image_path
                                 
                                 # Update inventory
-                                inventory[barcode]['quantity'] = new_stock
-                                inventory[barcode]['reorder_point'] = reorder_point
-                                inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                                inventory[barcode]['updated_by'] = st.session_state.user_info['username']
-                                
-                                # Update brand mapping if brand changed
-                                old_brand = product.get('brand')
-                                if old_brand != brand:
-                                    brands_data = load_data(BRANDS_FILE)
-                                    brand_products = brands_data.get('brand_products', {})
-                                    
-                                    # Remove from old brand
-                                    if old_brand and old_brand in brand_products and barcode in brand_products[old_brand]:
-                                        brand_products[old_brand].remove(barcode)
-                                    
-                                    # Add to new brand
-                                    if brand:
-                                        if brand not in brand_products:
-                                            brand_products[brand] = []
-                                        if barcode not in brand_products[brand]:
-                                            brand_products[brand].append(barcode)
-                                    
-                                    brands_data['brand_products'] = brand_products
-                                    save_data(brands_data, BRANDS_FILE)
+                                with locked_inventory() as inventory:
+                                    stock = inventory.setdefault(barcode, {})
+                                    previous_stock = stock.get('quantity', 0)
+                                    stock['quantity'] = new_stock
+                                    stock['reorder_point'] = reorder_point
+                                    stock['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                                    stock['updated_by'] = st.session_state.user_info['username']
                                 
                                 save_data(products, PRODUCTS_FILE)
-                                save_data(inventory, INVENTORY_FILE)
+                                record_stock_movements([stock_movement(
+                                    barcode, new_stock - previous_stock, new_stock, 'product', 'edit',
+                                    st.session_state.user_info['username']
+                                )])
                                 st.success("Product updated successfully")
                                 
     with tab3:
@@ -4517,21 +7042,15 @@ def product_management():
                             
                             # Remove from products and inventory
                             del products[barcode]
-                            if barcode in inventory:
-                                del inventory[barcode]
-                            
-                            # Remove from brand mapping
-                            brand = product.get('brand')
-                            if brand:
-                                brands_data = load_data(BRANDS_FILE)
-                                brand_products = brands_data.get('brand_products', {})
-                                if brand in brand_products and barcode in brand_products[brand]:
-                                    brand_products[brand].remove(barcode)
-                                brands_data['brand_products'] = brand_products
-                                save_data(brands_data, BRANDS_FILE)
+                            movements = []
+                            with locked_inventory() as inventory:
+                                if barcode in inventory:
+                                    removed = inventory.pop(barcode).get('quantity', 0)
+                                    movements.append(stock_movement(barcode, -removed, 0, 'delete', None,
+                                                                    st.session_state.user_info['username']))
                             
                             save_data(products, PRODUCTS_FILE)
-                            save_data(inventory, INVENTORY_FILE)
+                            record_stock_movements(movements)
                             st.success("Product permanently deleted")
 
     with tab4:
@@ -4605,7 +7124,6 @@ def product_management():
                 
                 if st.button("Validate Data" if validate_data else "Import Products", key="import_btn"):
                     products = load_data(PRODUCTS_FILE)
-                    inventory = load_data(INVENTORY_FILE)
                     categories_data = load_categories_data()
                     brands_data = load_data(BRANDS_FILE)
                     suppliers = load_data(SUPPLIERS_FILE)
@@ -4617,147 +7135,142 @@ def product_management():
                         'skipped': 0,
                         'errors': []
                     }
+                    movements = []
                     
                     # Get all existing barcodes for quick lookup
                     existing_barcodes = set(products.keys())
                     
-                    for index, row in df.iterrows():
-                        try:
-                            # Skip empty rows
-                            if pd.isna(row.get('name')) or not str(row.get('name')).strip():
-                                results['skipped'] += 1
-                                results['errors'].append(f"Row {index+2}: Missing product name")
-                                continue
-                            
-                            # Handle barcode
-                            barcode = str(row.get('barcode', '')).strip()
-                            if not barcode or barcode == 'AUTO_GENERATE':
-                                if generate_barcodes:
-                                    barcode = generate_barcode()
-                                else:
+                    with locked_inventory() as inventory:
+                        for index, row in df.iterrows():
+                            try:
+                                # Skip empty rows
+                                if pd.isna(row.get('name')) or not str(row.get('name')).strip():
                                     results['skipped'] += 1
-                                    results['errors'].append(f"Row {index+2}: Missing barcode and generation disabled")
+                                    results['errors'].append(f"Row {index+2}: Missing product name")
                                     continue
                             
-                            # Validate barcode format
-                            if barcode and not barcode.isdigit():
-                                results['skipped'] += 1
-                                results['errors'].append(f"Row {index+2}: Invalid barcode format '{barcode}' - must be digits only")
-                                continue
+                                # Handle barcode
+                                barcode = str(row.get('barcode', '')).strip()
+                                if not barcode or barcode == 'AUTO_GENERATE':
+                                    if generate_barcodes:
+                                        barcode = generate_barcode()
+                                    else:
+                                        results['skipped'] += 1
+                                        results['errors'].append(f"Row {index+2}: Missing barcode and generation disabled")
+                                        continue
                             
-                            if barcode and len(barcode) not in [12, 13]:
-                                results['skipped'] += 1
-                                results['errors'].append(f"Row {index+2}: Invalid barcode length '{barcode}' - must be 12 or 13 digits")
-                                continue
+                                # Validate barcode format
+                                if barcode and not barcode.isdigit():
+                                    results['skipped'] += 1
+                                    results['errors'].append(f"Row {index+2}: Invalid barcode format '{barcode}' - must be digits only")
+                                    continue
                             
-                            # Check if product exists
-                            product_exists = barcode in existing_barcodes
+                                if barcode and len(barcode) not in [12, 13]:
+                                    results['skipped'] += 1
+                                    results['errors'].append(f"Row {index+2}: Invalid barcode length '{barcode}' - must be 12 or 13 digits")
+                                    continue
                             
-                            # Determine if we should process based on import mode
-                            if import_mode == "Add new products only" and product_exists:
-                                results['skipped'] += 1
-                                continue
-                            if import_mode == "Update existing products" and not product_exists:
-                                results['skipped'] += 1
-                                continue
+                                # Check if product exists
+                                product_exists = barcode in existing_barcodes
                             
-                            # Prepare product data with proper validation
-                            product_data = {
-                                'barcode': barcode,
-                                'name': str(row.get('name', '')).strip(),
-                                'description': str(row.get('description', '')).strip() if pd.notna(row.get('description')) else '',
-                                'price': float(row.get('price', 0)) if pd.notna(row.get('price')) else 0.0,
-                                'cost': float(row.get('cost', 0)) if pd.notna(row.get('cost')) else 0.0,
-                                'category': str(row.get('category', '')).strip() if pd.notna(row.get('category')) else '',
-                                'subcategory': str(row.get('subcategory', '')).strip() if pd.notna(row.get('subcategory')) else '',
-                                'brand': str(row.get('brand', '')).strip() if pd.notna(row.get('brand')) else '',
-                                'supplier': str(row.get('supplier', '')).strip() if pd.notna(row.get('supplier')) else None,
-                                'active': bool(row.get('active', True)) if pd.notna(row.get('active')) else True,
-                                'last_updated': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                            }
+                                # Determine if we should process based on import mode
+                                if import_mode == "Add new products only" and product_exists:
+                                    results['skipped'] += 1
+                                    continue
+                                if import_mode == "Update existing products" and not product_exists:
+                                    results['skipped'] += 1
+                                    continue
                             
-                            # Validate required fields
-                            if not product_data['name']:
-                                results['skipped'] += 1
-                                results['errors'].append(f"Row {index+2}: Product name is required")
-                                continue
+                                # Prepare product data with proper validation
+                                product_data = {
+                                    'barcode': barcode,
+                                    'name': str(row.get('name', '')).strip(),
+                                    'description': str(row.get('description', '')).strip() if pd.notna(row.get('description')) else '',
+                                    'price': float(row.get('price', 0)) if pd.notna(row.get('price')) else 0.0,
+                                    'cost': float(row.get('cost', 0)) if pd.notna(row.get('cost')) else 0.0,
+                                    'category': str(row.get('category', '')).strip() if pd.notna(row.get('category')) else '',
+                                    'subcategory': str(row.get('subcategory', '')).strip() if pd.notna(row.get('subcategory')) else '',
+                                    'brand': str(row.get('brand', '')).strip() if pd.notna(row.get('brand')) else '',
+                                    'supplier': str(row.get('supplier', '')).strip() if pd.notna(row.get('supplier')) else None,
+                                    'active': bool(row.get('active', True)) if pd.notna(row.get('active')) else True,
+                                    'last_updated': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                                }
                             
-                            if product_data['price'] <= 0:
-                                results['skipped'] += 1
-                                results['errors'].append(f"Row {index+2}: Price must be greater than 0")
-                                continue
+                                # Validate required fields
+                                if not product_data['name']:
+                                    results['skipped'] += 1
+                                    results['errors'].append(f"Row {index+2}: Product name is required")
+                                    continue
                             
-                            if product_data['cost'] <= 0:
-                                results['skipped'] += 1
-                                results['errors'].append(f"Row {index+2}: Cost must be greater than 0")
-                                continue
+                                if product_data['price'] <= 0:
+                                    results['skipped'] += 1
+                                    results['errors'].append(f"Row {index+2}: Price must be greater than 0")
+                                    continue
                             
-                            # Set added_by/updated_by based on whether it's new or existing
-                            if product_exists:
-                                product_data['updated_by'] = st.session_state.user_info['username']
-                                # Preserve original date added
-                                product_data['date_added'] = products[barcode].get('date_added')
-                            else:
-                                product_data['date_added'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                                product_data['added_by'] = st.session_state.user_info['username']
+                                if product_data['cost'] <= 0:
+                                    results['skipped'] += 1
+                                    results['errors'].append(f"Row {index+2}: Cost must be greater than 0")
+                                    continue
                             
-                            # Validate category and subcategory
-                            category = product_data['category']
-                            if category and category not in categories_data.get('categories', []):
-                                # Add new category if it doesn't exist
-                                if category not in categories_data.get('categories', []):
-                                    categories_data['categories'].append(category)
-                                    categories_data['subcategories'][category] = []
+                                # Set added_by/updated_by based on whether it's new or existing
+                                if product_exists:
+                                    product_data['updated_by'] = st.session_state.user_info['username']
+                                    # Preserve original date added
+                                    product_data['date_added'] = products[barcode].get('date_added')
+                                else:
+                                    product_data['date_added'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                                    product_data['added_by'] = st.session_state.user_info['username']
                             
-                            # Validate brand
-                            brand = product_data['brand']
-                            if brand and brand not in brands_data.get('brands', []):
-                                # Add new brand if it doesn't exist
-                                brands_data['brands'].append(brand)
+                                # Validate category and subcategory
+                                category = product_data['category']
+                                if category and category not in categories_data.get('categories', []):
+                                    # Add new category if it doesn't exist
+                                    if category not in categories_data.get('categories', []):
+                                        categories_data['categories'].append(category)
+                                        categories_data['subcategories'][category] = []
                             
-                            # Save product
-                            products[barcode] = product_data
+                                # Validate brand
+                                brand = product_data['brand']
+                                if brand and brand not in brands_data.get('brands', []):
+                                    # Add new brand if it doesn't exist
+                                    brands_data['brands'].append(brand)
                             
-                            # Handle inventory
-                            initial_stock = int(row.get('initial_stock', 0)) if pd.notna(row.get('initial_stock')) else 0
-                            reorder_point = int(row.get('reorder_point', 10)) if pd.notna(row.get('reorder_point')) else 10
+                                # Save product
+                                products[barcode] = product_data
                             
-                            if barcode in inventory:
-                                inventory[barcode]['reorder_point'] = reorder_point
-                                inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                                inventory[barcode]['updated_by'] = st.session_state.user_info['username']
-                            else:
-                                inventory[barcode] = {
-                                    'quantity': initial_stock,
-                                    'reorder_point': reorder_point,
-                                    'last_updated': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
-                                    'updated_by': st.session_state.user_info['username']
-                                }
+                                # Handle inventory
+                                initial_stock = int(row.get('initial_stock', 0)) if pd.notna(row.get('initial_stock')) else 0
+                                reorder_point = int(row.get('reorder_point', 10)) if pd.notna(row.get('reorder_point')) else 10
                             
-                            # Update brand mapping
-                            if brand:
-                                brand_products = brands_data.get('brand_products', {})
-                                if brand not in brand_products:
-                                    brand_products[brand] = []
-                                if barcode not in brand_products[brand]:
-                                    brand_products[brand].append(barcode)
-                                brands_data['brand_products'] = brand_products
+                                if barcode in inventory:
+                                    inventory[barcode]['reorder_point'] = reorder_point
+                                    inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                                    inventory[barcode]['updated_by'] = st.session_state.user_info['username']
+                                else:
+                                    inventory[barcode] = {
+                                        'quantity': initial_stock,
+                                        'reorder_point': reorder_point,
+                                        'last_updated': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
+                                        'updated_by': st.session_state.user_info['username']
+                                    }
+                                    movements.append(stock_movement(barcode, initial_stock, initial_stock, 'import',
+                                                                    uploaded_file.name, st.session_state.user_info['username']))
                             
-                            results['processed'] += 1
-                            if product_exists:
-                                results['updated'] += 1
-                            else:
-                                results['added'] += 1
+                                results['processed'] += 1
+                                if product_exists:
+                                    results['updated'] += 1
+                                else:
+                                    results['added'] += 1
                             
-                        except Exception as e:
-                            results['skipped'] += 1
-                            results['errors'].append(f"Row {index+2}: Error - {str(e)}")
-                            if on_error == "Stop import":
-                                break
+                            except Exception as e:
+                                results['skipped'] += 1
+                                results['errors'].append(f"Row {index+2}: Error - {str(e)}")
+                                if on_error == "Stop import":
+                                    break
                     
                     # Save all data
                     save_data(products, PRODUCTS_FILE)
-                    save_data(inventory, INVENTORY_FILE)
+                    record_stock_movements(movements)
                     save_data(categories_data, CATEGORIES_FILE)
                     save_data(brands_data, BRANDS_FILE)
                     
@@ -4977,6 +7490,55 @@ def product_management():
                 
                 
 # Inventory Management
+def reorder_forecast_tab():
+    st.header("Reorder Forecast")
+    st.info("Suggests reorder points from recent daily sales and each supplier's lead time. "
+            "Safety stock covers demand swings at the chosen service level.")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        service_level = st.selectbox("Service Level %", list(FORECAST_SERVICE_LEVELS), index=1,
+                                     key="forecast_service_level")
+    with col2:
+        history_days = st.slider("Sales History (days)", 28, 365, FORECAST_HISTORY_DAYS, key="forecast_history")
+    
+    if st.button("Forecast in Background", key="reorder_forecast_job"):
+        submit_report_job('reorder_forecast', "Reorder Forecast", {
+            'service_level': service_level,
+            'history_days': history_days
+        })
+    
+    job, suggestions = latest_job_result('reorder_forecast')
+    if job is None:
+        st.caption("No forecast results yet")
+        return
+    st.caption(f"Latest forecast: {job['params']['history_days']} days of sales, "
+               f"{job['params']['service_level']}% service level, finished {job['finished']}")
+    suggestions = suggestions.astype({
+        'lead_time_days': int, 'units_sold': int, 'daily_forecast': float, 'safety_stock': int,
+        'quantity': int, 'reorder_point': int, 'suggested_reorder_point': int
+    })
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        suppliers = st.multiselect("Suppliers", sorted(suggestions['supplier'].unique()), key="forecast_suppliers")
+    with col2:
+        only_changed = st.checkbox("Only Changed Reorder Points", value=True, key="forecast_only_changed")
+    if suppliers:
+        suggestions = suggestions[suggestions['supplier'].isin(suppliers)]
+    if only_changed:
+        suggestions = suggestions[suggestions['suggested_reorder_point'] != suggestions['reorder_point']]
+    
+    st.dataframe(suggestions.rename(columns={
+        'barcode': 'Barcode', 'product': 'Product', 'supplier': 'Supplier', 'lead_time_days': 'Lead Time (days)',
+        'units_sold': 'Units Sold', 'daily_forecast': 'Daily Forecast', 'safety_stock': 'Safety Stock',
+        'quantity': 'Current Stock', 'reorder_point': 'Reorder Point', 'suggested_reorder_point': 'Suggested'
+    }), hide_index=True)
+    
+    if not suggestions.empty and st.button(f"Accept {len(suggestions)} Suggestions", key="accept_forecast"):
+        updated = accept_reorder_suggestions(suggestions, st.session_state.user_info['username'])
+        st.success(f"Reorder points updated for {updated} items")
+
 def inventory_management():
     if not is_manager():
         st.warning("You don't have permission to access this page")
@@ -4984,11 +7546,12 @@ def inventory_management():
     
     st.title("Inventory Management")
     
-    tab1, tab2, tab3, tab4 = st.tabs([
+    tab1, tab2, tab3, tab4, tab5 = st.tabs([
         "Current Inventory", 
         "Stock Adjustment", 
         "Inventory Reports", 
-        "Bulk Update"
+        "Bulk Update",
+        "Reorder Forecast"
     ])
     
     with tab1:
@@ -4997,23 +7560,26 @@ def inventory_management():
         inventory = load_data(INVENTORY_FILE)
         products = load_data(PRODUCTS_FILE)
         
+        sales_conflicts = load_data(SALES_CONFLICTS_FILE)
+        open_conflicts = [c for c in sales_conflicts.values() if not c.get('resolved')]
+        if open_conflicts:
+            with st.expander(f"Lane Sync Conflicts ({len(open_conflicts)})", expanded=True):
+                conflicts_df = pd.DataFrame(open_conflicts)
+                if 'barcode' in conflicts_df.columns:
+                    conflicts_df['product'] = conflicts_df['barcode'].map(
+                        lambda b: products.get(b, {}).get('name', 'Unknown Product') if isinstance(b, str) else '')
+                st.dataframe(conflicts_df, hide_index=True)
+                if st.button("Mark Conflicts Resolved"):
+                    for conflict in open_conflicts:
+                        sales_conflicts[conflict['conflict_id']]['resolved'] = True
+                    save_data(sales_conflicts, SALES_CONFLICTS_FILE)
+                    st.success("Conflicts marked as resolved")
+        
         if not inventory:
             st.info("No inventory items available")
         else:
-            # Merge product info with inventory
-            inventory_list = []
-            for barcode, inv_data in inventory.items():
-                product = products.get(barcode, {'name': 'Unknown Product', 'price': 0})
-                inventory_list.append({
-                    'product': product['name'],
-                    'barcode': barcode,
-                    'quantity': inv_data.get('quantity', 0),
-                    'reorder_point': inv_data.get('reorder_point', 10),
-                    'status': 'Low Stock' if inv_data.get('quantity', 0) < inv_data.get('reorder_point', 10) else 'OK',
-                    'last_updated': inv_data.get('last_updated', 'N/A')
-                })
-            
-            inventory_df = pd.DataFrame(inventory_list)
+            snapshot = get_inventory_snapshot()
+            inventory_df = stock_levels_frame(snapshot).assign(last_updated=snapshot['last_updated'])
             
             # Filter options
             col1, col2 = st.columns(2)
@@ -5038,16 +7604,9 @@ def inventory_management():
             
             st.dataframe(inventory_df)
             
-            # Export option
-            if st.button("Export Inventory to CSV", key="export_inv_csv"):
-                csv = inventory_df.to_csv(index=False)
-                st.download_button(
-                    label="Download CSV",
-                    data=csv,
-                    file_name=f"inventory_report_{datetime.date.today()}.csv",
-                    mime="text/csv",
-                    key="inv_download_csv"
-                )
+            # Export option
+            export_download("Export Inventory", lambda: iter_frame_chunks(inventory_df),
+                            f"inventory_report_{datetime.date.today()}", key="export_inv_csv")
     
     with tab2:
         st.header("Stock Adjustment")
@@ -5113,35 +7672,29 @@ def inventory_management():
                     )
                     
                     if st.form_submit_button("Submit Adjustment"):
-                        if barcode not in inventory:
-                            inventory[barcode] = {'quantity': 0, 'reorder_point': new_reorder}
-                        
-                        if adjustment_type == "Add Stock":
-                            inventory[barcode]['quantity'] += quantity
-                        elif adjustment_type == "Remove Stock":
-                            inventory[barcode]['quantity'] -= quantity
-                        elif adjustment_type == "Set Stock":
-                            inventory[barcode]['quantity'] = quantity
-                        elif adjustment_type == "Transfer Stock":
-                            inventory[barcode]['quantity'] -= quantity
+                        with locked_inventory() as inventory:
+                            previous_qty = inventory.get(barcode, {}).get('quantity', 0)
+                            if barcode not in inventory:
+                                inventory[barcode] = {'quantity': 0, 'reorder_point': new_reorder}
                         
-                        inventory[barcode]['reorder_point'] = new_reorder
-                        inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                        inventory[barcode]['updated_by'] = st.session_state.user_info['username']
+                            if adjustment_type == "Add Stock":
+                                inventory[barcode]['quantity'] += quantity
+                            elif adjustment_type == "Remove Stock":
+                                inventory[barcode]['quantity'] -= quantity
+                            elif adjustment_type == "Set Stock":
+                                inventory[barcode]['quantity'] = quantity
+                            elif adjustment_type == "Transfer Stock":
+                                inventory[barcode]['quantity'] -= quantity
+                                notes = f"To {transfer_to}. {notes}" if transfer_to else notes
                         
-                        adjustments = inventory[barcode].get('adjustments', [])
-                        adjustments.append({
-                            'date': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
-                            'type': adjustment_type,
-                            'quantity': quantity,
-                            'previous_qty': current_qty,
-                            'new_qty': inventory[barcode]['quantity'],
-                            'notes': notes,
-                            'user': st.session_state.user_info['username']
-                        })
-                        inventory[barcode]['adjustments'] = adjustments
+                            inventory[barcode]['reorder_point'] = new_reorder
+                            inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                            inventory[barcode]['updated_by'] = st.session_state.user_info['username']
                         
-                        save_data(inventory, INVENTORY_FILE)
+                        record_stock_movements([stock_movement(
+                            barcode, inventory[barcode]['quantity'] - previous_qty, inventory[barcode]['quantity'],
+                            'adjustment', adjustment_type, st.session_state.user_info['username'], note=notes
+                        )])
                         st.success("Inventory updated successfully")
     
     with tab3:
@@ -5165,83 +7718,22 @@ def inventory_management():
             )
             
             if report_type == "Stock Levels":
-                inventory_list = []
-                for barcode, inv_data in inventory.items():
-                    product = products.get(barcode, {'name': 'Unknown'})
-                    inventory_list.append({
-                        'product': product['name'],
-                        'barcode': barcode,
-                        'quantity': inv_data.get('quantity', 0),
-                        'reorder_point': inv_data.get('reorder_point', 10)
-                    })
-                
-                inv_df = pd.DataFrame(inventory_list)
-                st.dataframe(inv_df)
+                st.dataframe(stock_levels_frame(get_inventory_snapshot()).drop(columns='status'))
             
             elif report_type == "Stock Value":
-                value_list = []
-                for barcode, inv_data in inventory.items():
-                    product = products.get(barcode, {'name': 'Unknown', 'cost': 0})
-                    value_list.append({
-                        'product': product['name'],
-                        'barcode': barcode,
-                        'quantity': inv_data.get('quantity', 0),
-                        'unit_cost': product.get('cost', 0),
-                        'total_value': inv_data.get('quantity', 0) * product.get('cost', 0)
-                    })
-                
-                value_df = pd.DataFrame(value_list)
-                total_value = value_df['total_value'].sum()
-                
-                st.write(f"Total Inventory Value: {format_currency(total_value)}")
-                st.dataframe(value_df.sort_values('total_value', ascending=False))
+                snapshot = get_inventory_snapshot()
+                st.write(f"Total Inventory Value: {format_money(int(snapshot['stock_value'].sum()))}")
+                st.dataframe(stock_value_frame(snapshot))
             
             elif report_type == "Stock Movement":
-                st.info("Select a product to view movement history")
-                
-                product_options = {f"{v['name']} ({k})": k for k, v in products.items()}
-                selected_product = st.selectbox(
-                    "Select Product", 
-                    [""] + list(product_options.keys()),
-                    key="movement_select_product"
-                )
-                
-                if selected_product:
-                    barcode = product_options[selected_product]
-                    inventory = load_data(INVENTORY_FILE)
-                    
-                    if barcode in inventory and 'adjustments' in inventory[barcode]:
-                        adjustments = inventory[barcode]['adjustments']
-                        st.dataframe(pd.DataFrame(adjustments))
-                    else:
-                        st.info("No adjustment history for this product")
+                stock_movement_view(products, key="inv_movement")
             
             elif report_type == "Inventory Audit":
                 st.info("Inventory audit would compare physical counts with system records")
-                if st.button("Generate Audit Sheet", key="gen_audit_sheet"):
-                    audit_data = []
-                    for barcode, inv_data in inventory.items():
-                        product = products.get(barcode, {'name': 'Unknown'})
-                        audit_data.append({
-                            'Product': product['name'],
-                            'Barcode': barcode,
-                            'System Quantity': inv_data.get('quantity', 0),
-                            'Physical Count': "",
-                            'Variance': "",
-                            'Notes': ""
-                        })
-                    
-                    audit_df = pd.DataFrame(audit_data)
-                    st.dataframe(audit_df)
-                    
-                    csv = audit_df.to_csv(index=False)
-                    st.download_button(
-                        label="Download Audit Sheet",
-                        data=csv,
-                        file_name=f"inventory_audit_{datetime.date.today()}.csv",
-                        mime="text/csv",
-                        key="download_audit"
-                    )
+                if st.button("Run in Background", key="audit_sheet_job"):
+                    submit_report_job('inventory_audit', "Inventory Audit Sheet", {})
+                export_download("Generate Audit Sheet", lambda: iter_frame_chunks(build_audit_sheet()),
+                                f"inventory_audit_{datetime.date.today()}", key="gen_audit_sheet")
     
     with tab4:
         st.header("Bulk Inventory Update")
@@ -5276,44 +7768,53 @@ def inventory_management():
                 st.dataframe(df)
                 
                 if st.button("Update Inventory", key="inv_update_btn"):
-                    inventory = load_data(INVENTORY_FILE)
                     products = load_data(PRODUCTS_FILE)
                     updated = 0
                     errors = 0
+                    movements = []
                     
-                    for _, row in df.iterrows():
-                        try:
-                            barcode = str(row['barcode']).strip()
+                    with locked_inventory() as inventory:
+                        for _, row in df.iterrows():
+                            try:
+                                barcode = str(row['barcode']).strip()
                             
-                            if barcode not in products:
-                                errors += 1
-                                continue
+                                if barcode not in products:
+                                    errors += 1
+                                    continue
                             
-                            if barcode not in inventory:
-                                inventory[barcode] = {
-                                    'quantity': 0,
-                                    'reorder_point': 10
-                                }
+                                if barcode not in inventory:
+                                    inventory[barcode] = {
+                                        'quantity': 0,
+                                        'reorder_point': 10
+                                    }
                             
-                            if not pd.isna(row['quantity']):
-                                inventory[barcode]['quantity'] = int(row['quantity'])
+                                if not pd.isna(row['quantity']):
+                                    previous_qty = inventory[barcode].get('quantity', 0)
+                                    inventory[barcode]['quantity'] = int(row['quantity'])
+                                    movements.append(stock_movement(
+                                        barcode, inventory[barcode]['quantity'] - previous_qty, inventory[barcode]['quantity'],
+                                        'bulk_update', uploaded_file.name, st.session_state.user_info['username']
+                                    ))
                             
-                            if not pd.isna(row['reorder_point']):
-                                inventory[barcode]['reorder_point'] = int(row['reorder_point'])
+                                if not pd.isna(row['reorder_point']):
+                                    inventory[barcode]['reorder_point'] = int(row['reorder_point'])
                             
-                            inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                            inventory[barcode]['updated_by'] = st.session_state.user_info['username']
+                                inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                                inventory[barcode]['updated_by'] = st.session_state.user_info['username']
                             
-                            updated += 1
+                                updated += 1
                         
-                        except Exception as e:
-                            errors += 1
-                            continue
+                            except Exception as e:
+                                errors += 1
+                                continue
                     
-                    save_data(inventory, INVENTORY_FILE)
+                    record_stock_movements(movements)
                     st.success(f"Update completed: {updated} items updated, {errors} errors")
             except Exception as e:
                 st.error(f"Error reading CSV file: {str(e)}")
+    
+    with tab5:
+        reorder_forecast_tab()
 
 # User Management
 def user_management():
@@ -5790,6 +8291,116 @@ def discounts_management():
 
 
 # Offers Management
+def bundle_suggestions_tab():
+    st.header("Bundle Suggestions")
+    st.info("Products often bought together, mined from past sales. Lift above 1 means they sell "
+            "together more often than chance.")
+    
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        start_date = st.date_input("Start Date", value=datetime.date.today() - datetime.timedelta(days=90),
+                                   key="bundle_start_date")
+    with col2:
+        end_date = st.date_input("End Date", value=datetime.date.today(), key="bundle_end_date")
+    with col3:
+        min_support = st.number_input("Min Support (% of baskets)", min_value=0.01, max_value=100.0,
+                                      value=1.0, step=0.1, key="bundle_min_support")
+    with col4:
+        min_lift = st.number_input("Min Lift", min_value=0.0, value=1.2, step=0.1, key="bundle_min_lift")
+    
+    if st.button("Find Bundles in Background", key="bundle_mining_job"):
+        submit_report_job('basket_mining', "Bundle Suggestions", {
+            'start_date': start_date.isoformat(),
+            'end_date': end_date.isoformat(),
+            'min_support': min_support / 100,
+            'min_lift': min_lift
+        })
+    
+    job, bundles = latest_job_result('basket_mining')
+    if job is None:
+        st.caption("No bundle mining results yet")
+        return
+    st.caption(f"Latest results: {job['params']['start_date']} to {job['params']['end_date']}, "
+               f"finished {job['finished']}")
+    if bundles.empty:
+        st.info("No product combinations reached the minimum support and lift")
+        return
+    
+    bundles = bundles.astype({'size': int, 'baskets': int, 'support': float, 'lift': float, 'confidence': float})
+    st.dataframe(bundles.assign(support=(bundles['support'] * 100).round(2), lift=bundles['lift'].round(2),
+                                confidence=(bundles['confidence'] * 100).round(1)).rename(columns={
+        'products': 'Products', 'barcodes': 'Barcodes', 'size': 'Items', 'baskets': 'Baskets',
+        'support': 'Support %', 'lift': 'Lift', 'confidence': 'Confidence %'
+    }))
+    
+    products = load_data(PRODUCTS_FILE)
+    candidate = st.selectbox("Create Offer From", [""] + list(bundles['products']), key="bundle_candidate")
+    if candidate:
+        barcodes = bundles.loc[bundles['products'] == candidate, 'barcodes'].iloc[0].split(" + ")
+        regular_price = sum(to_minor(products.get(b, {}).get('price', 0)) for b in barcodes)
+        discount_percent = st.slider("Bundle Discount %", 0, 50, 10, key="bundle_discount")
+        bundle_price = regular_price - scale_minor(regular_price, discount_percent / 100)
+        st.write(f"Regular price {format_money(regular_price)}, bundle price {format_money(bundle_price)}")
+        if st.button("Create Inactive Bundle Offer", key="create_bundle_offer"):
+            offers = load_data(OFFERS_FILE)
+            offer_id = str(uuid.uuid4())
+            offers[offer_id] = {
+                'id': offer_id,
+                'name': f"Bundle: {candidate}",
+                'description': f"Suggested from sales {job['params']['start_date']} to {job['params']['end_date']}",
+                'type': 'bundle',
+                'products': barcodes,
+                'bundle_price': from_minor(bundle_price),
+                'start_date': datetime.date.today().strftime("%Y-%m-%d"),
+                'end_date': (datetime.date.today() + datetime.timedelta(days=7)).strftime("%Y-%m-%d"),
+                'active': False,
+                'created_by': st.session_state.user_info['username'],
+                'created_at': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+            }
+            save_data(offers, OFFERS_FILE)
+            st.success("Bundle offer created as inactive; review and activate it under View/Edit Offers")
+
+def offer_simulator_tab():
+    st.header("Offer What-If")
+    st.info("Replays past sales as if the selected offers had been running, to estimate their cost "
+            "before activating them.")
+    
+    offers = load_data(OFFERS_FILE)
+    if not offers:
+        st.info("No offers to simulate")
+        return
+    
+    offer_options = {f"{o['name']} ({o['type']}{'' if o['active'] else ', inactive'})": k for k, o in offers.items()}
+    selected = st.multiselect("Offers", list(offer_options.keys()), key="whatif_offers")
+    col1, col2 = st.columns(2)
+    with col1:
+        start_date = st.date_input("Start Date", value=datetime.date.today() - datetime.timedelta(days=90),
+                                   key="whatif_start_date")
+    with col2:
+        end_date = st.date_input("End Date", value=datetime.date.today(), key="whatif_end_date")
+    
+    if selected and st.button("Simulate", key="whatif_run"):
+        summary, daily = simulate_offers([offers[offer_options[o]] for o in selected], start_date, end_date)
+        if summary is None:
+            st.info("No sales in selected date range")
+        elif summary.empty:
+            st.info("None of the selected offers would have applied to any sale in this period")
+        else:
+            totals = summary.iloc[-1]
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Projected Discount", format_money(int(totals['discount'])))
+            col2.metric("Affected Baskets", f"{totals['affected_baskets']:,}")
+            col3.metric("Share of Baskets", f"{totals['basket_share']:.1f}%")
+            
+            st.dataframe(money_columns_to_units(summary, ['discount', 'avg_discount', 'affected_revenue']).rename(columns={
+                'offer': 'Offer', 'type': 'Type', 'affected_baskets': 'Affected Baskets',
+                'basket_share': 'Basket Share %', 'units': 'Units', 'discount': 'Discount',
+                'avg_discount': 'Avg Discount', 'affected_revenue': 'Affected Revenue'
+            }).round({'Basket Share %': 1}))
+            
+            st.subheader("Projected Discount per Day")
+            st.bar_chart(money_columns_to_units(daily, list(daily.columns)))
+
 def offers_management():
     if not is_manager():
         st.warning("You don't have permission to access this page")
@@ -5797,7 +8408,8 @@ def offers_management():
     
     st.title("Offers Management")
     
-    tab1, tab2, tab3 = st.tabs(["Add Offer", "View/Edit Offers", "Bulk Import"])
+    tab1, tab2, tab3, tab4, tab5 = st.tabs(["Add Offer", "View/Edit Offers", "Bulk Import", "Bundle Suggestions",
+                                            "What-If"])
     
     with tab1:
         st.header("Add New Offer")
@@ -6104,6 +8716,12 @@ def offers_management():
                     st.success(f"Import completed: {imported} new offers, {errors} errors")
             except Exception as e:
                 st.error(f"Error reading CSV file: {str(e)}")
+    
+    with tab4:
+        bundle_suggestions_tab()
+    
+    with tab5:
+        offer_simulator_tab()
                 
 # Loyalty Program Management
 def loyalty_management():
@@ -6426,6 +9044,8 @@ def suppliers_management():
             address = st.text_area("Address")
             products_supplied = st.text_area("Products Supplied (comma separated)")
             payment_terms = st.text_input("Payment Terms")
+            lead_time_days = st.number_input("Lead Time (days)", min_value=1, value=DEFAULT_LEAD_TIME_DAYS, step=1,
+                                             help="Days from ordering to delivery")
             
             submit_button = st.form_submit_button("Add Supplier")
             
@@ -6445,6 +9065,7 @@ def suppliers_management():
                         'address': address,
                         'products_supplied': [p.strip() for p in products_supplied.split(',')] if products_supplied else [],
                         'payment_terms': payment_terms,
+                        'lead_time_days': lead_time_days,
                         'date_added': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
                         'added_by': st.session_state.user_info['username']
                     }
@@ -6479,6 +9100,8 @@ def suppliers_management():
                         products_supplied = st.text_area("Products Supplied", 
                                                         value=", ".join(supplier.get('products_supplied', [])))
                         payment_terms = st.text_input("Payment Terms", value=supplier.get('payment_terms', ''))
+                        lead_time_days = st.number_input("Lead Time (days)", min_value=1, step=1,
+                                                         value=supplier.get('lead_time_days', DEFAULT_LEAD_TIME_DAYS))
                         
                         if st.form_submit_button("Update Supplier"):
                             suppliers[supplier_id]['name'] = name
@@ -6488,6 +9111,7 @@ def suppliers_management():
                             suppliers[supplier_id]['address'] = address
                             suppliers[supplier_id]['products_supplied'] = [p.strip() for p in products_supplied.split(',')] if products_supplied else []
                             suppliers[supplier_id]['payment_terms'] = payment_terms
+                            suppliers[supplier_id]['lead_time_days'] = lead_time_days
                             suppliers[supplier_id]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
                             suppliers[supplier_id]['updated_by'] = st.session_state.user_info['username']
                             
@@ -6518,6 +9142,110 @@ def suppliers_management():
                     st.success("Supplier deleted successfully")
 
 # Reports & Analytics
+ROLLUP_REPORTS = ["Daily Sales", "Weekly Sales", "Monthly Sales", "Hourly Sales"]
+
+def sales_report_files(report_type):
+    if report_type in ROLLUP_REPORTS:
+        return (SALES_ROLLUPS_FILE,)
+    return (TRANSACTIONS_FILE, PRODUCTS_FILE, CATEGORIES_FILE)
+
+def compute_sales_report(report_type, start_date, end_date):
+    """Tables for the Sales Reports tab, or None when the range has no sales"""
+    if report_type in ROLLUP_REPORTS:
+        grain = 'hourly' if report_type == "Hourly Sales" else 'daily'
+        rollup_df = sales_rollup_frame(load_sales_rollups(), grain, start_date, end_date)
+        if rollup_df.empty:
+            return None
+        
+        rollup_df = rollup_df.rename(columns={'sales': 'total'})
+        summary_columns = ['total', 'transactions', 'tax', 'discount', 'refunds', 'returns', 'net_sales']
+        money_columns = ['total', 'tax', 'discount', 'refunds', 'net_sales']
+        dates = pd.to_datetime(rollup_df.index.str[:10])
+        result = {}
+        
+        if report_type == "Daily Sales":
+            report_df = rollup_df[summary_columns]
+            report_df.index = dates.date
+            report_df.index.name = 'date_group'
+            result['payment_split'] = (pd.DataFrame(rollup_df['payment_methods'].tolist()).sum()
+                                       / 10 ** get_money_places()).rename('total')
+        elif report_type == "Weekly Sales":
+            report_df = rollup_df[summary_columns].groupby(dates.strftime('%Y-%U')).sum()
+            report_df.index.name = 'week'
+        elif report_type == "Monthly Sales":
+            report_df = rollup_df[summary_columns].groupby(dates.strftime('%Y-%m')).sum()
+            report_df.index.name = 'month'
+        else:
+            hours = rollup_df.index.str[11:13].astype(int)
+            report_df = rollup_df[['total', 'transactions']].groupby(hours).sum()
+            report_df.index.name = 'hour'
+        
+        result['report'] = money_columns_to_units(report_df, money_columns)
+        return result
+    
+    sales_frame, line_items_frame = get_sales_frames()
+    trans_df = filter_by_date(sales_frame, start_date, end_date)
+    if trans_df.empty:
+        return None
+    items_df = filter_by_date(line_items_frame, start_date, end_date)
+    
+    if report_type == "Product Sales":
+        report_df = items_df.groupby('barcode', observed=True).agg(
+            name=('name', 'first'),
+            quantity=('quantity', 'sum'),
+            revenue=('revenue', 'sum')
+        ).sort_values('revenue', ascending=False)
+    elif report_type in ["Category Sales", "Brand Sales"]:
+        group = 'category' if report_type == "Category Sales" else 'brand'
+        report_df = items_df.groupby(group, observed=True)[['revenue', 'quantity']].sum()
+        if group == 'category':
+            # Categories without sales are still listed
+            categories = load_data(CATEGORIES_FILE).get('categories', [])
+            report_df = report_df.reindex(report_df.index.union(pd.Index(categories)), fill_value=0)
+        report_df = report_df.sort_values('revenue', ascending=False)
+    else:
+        report_df = trans_df.groupby('cashier', observed=True).agg(
+            transactions=('total', 'size'),
+            total_sales=('total', 'sum')
+        )
+        report_df = money_columns_to_units(report_df, ['total_sales'])
+        report_df['avg_sale'] = report_df['total_sales'] / report_df['transactions']
+        report_df = report_df.sort_values('total_sales', ascending=False)
+    
+    return {'report': money_columns_to_units(report_df, ['revenue'])}
+
+def compute_payment_report(start_date, end_date):
+    trans_df = filter_by_date(get_sales_frames()[0], start_date, end_date)
+    if trans_df.empty:
+        return None
+    payment_df = trans_df.groupby('payment_method', observed=True)['total'].agg(count='size', total='sum')
+    trend_df = trans_df.pivot_table(index=trans_df['date'].dt.strftime("%Y-%m-%d"), columns='payment_method',
+                                    values='total', aggfunc='sum', fill_value=0, observed=True)
+    return {'summary': money_columns_to_units(payment_df, ['total']).sort_values('total', ascending=False),
+            'trends': trend_df / 10 ** get_money_places()}
+
+def compute_return_report(start_date, end_date):
+    returns_data = load_data(RETURNS_FILE)
+    start_key = start_date.strftime("%Y-%m-%d")
+    end_key = end_date.strftime("%Y-%m-%d")
+    filtered_returns = [r for r in returns_data.values() if start_key <= r['return_date'][:10] <= end_key]
+    if not filtered_returns:
+        return None
+    
+    products = load_data(PRODUCTS_FILE)
+    reasons = pd.Series([r['reason'] for r in filtered_returns]).value_counts()
+    product_returns = pd.DataFrame(
+        [(products.get(barcode, {}).get('name', 'Unknown'), item['quantity'])
+         for r in filtered_returns for barcode, item in r['items'].items()],
+        columns=['Product', 'Return Quantity']
+    ).groupby('Product')['Return Quantity'].sum().sort_values(ascending=False).head(10)
+    
+    return {
+        'total_returns': len(filtered_returns),
+        'total_refund_amount': sum(r['total_refund'] for r in filtered_returns),
+        'reasons': reasons.rename_axis('Reason').rename('Count'),
+        'product_returns': product_returns
+    }
 def reports_analytics():
     if not is_manager():
         st.warning("You don't have permission to access this page")
@@ -6525,21 +9253,22 @@ def reports_analytics():
     
     st.title("Reports & Analytics")
     
-    tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs([
+    tab1, tab2, tab3, tab4, tab5, tab6, tab7, tab8 = st.tabs([
         "Sales Reports", 
         "Inventory Reports", 
         "Customer Reports", 
         "Payment Analysis",
         "Brand Reports",
         "Return Analysis",
-        "Custom Reports"
+        "Custom Reports",
+        "Report Jobs"
     ])
     
     with tab1:
         st.header("Sales Reports")
         
-        transactions = load_data(TRANSACTIONS_FILE)
-        if not transactions:
+        rollups = load_sales_rollups()
+        if not rollups['daily']:
             st.info("No sales data available")
         else:
             report_type = st.selectbox("Sales Report Type", [
@@ -6548,6 +9277,7 @@ def reports_analytics():
                 "Monthly Sales",
                 "Product Sales",
                 "Category Sales",
+                "Brand Sales",
                 "Cashier Performance",
                 "Hourly Sales"
             ])
@@ -6559,36 +9289,22 @@ def reports_analytics():
             with col2:
                 end_date = st.date_input("End Date", value=datetime.date.today())
             
-            # Convert transactions to DataFrame with error handling
-            trans_list = []
-            for t in transactions.values():
-                try:
-                    trans_date = datetime.datetime.strptime(t.get('date', ''), "%Y-%m-%d %H:%M:%S").date()
-                    if start_date <= trans_date <= end_date:
-                        trans_list.append({
-                            'date': t['date'],
-                            'transaction_id': t.get('transaction_id', 'N/A'),
-                            'total': t.get('total', 0),
-                            'cashier': t.get('cashier', 'N/A'),
-                            'payment_method': t.get('payment_method', 'N/A'),
-                            'items': t.get('items', {})
-                        })
-                except (ValueError, KeyError, AttributeError):
-                    continue
+            if st.button("Run in Background", key="sales_report_job"):
+                submit_report_job('sales', report_type, {
+                    'report_type': report_type,
+                    'start_date': start_date.isoformat(),
+                    'end_date': end_date.isoformat()
+                })
             
-            if not trans_list:
+            data = cached_report('sales:' + report_type, (start_date, end_date), sales_report_files(report_type),
+                                 lambda: compute_sales_report(report_type, start_date, end_date))
+            
+            if data is None:
                 st.info("No transactions in selected date range")
             else:
-                trans_df = pd.DataFrame(trans_list)
-                trans_df['date'] = pd.to_datetime(trans_df['date'])
+                report_df = data['report']
                 
                 if report_type == "Daily Sales":
-                    trans_df['date_group'] = trans_df['date'].dt.date
-                    report_df = trans_df.groupby('date_group').agg({
-                        'total': 'sum',
-                        'transaction_id': 'count'
-                    }).rename(columns={'transaction_id': 'transactions'})
-                    
                     st.subheader("Daily Sales Summary")
                     st.dataframe(report_df)
                     
@@ -6604,14 +9320,12 @@ def reports_analytics():
                     col1.metric("Total Sales", format_currency(total_sales))
                     col2.metric("Total Transactions", total_transactions)
                     col3.metric("Average Transaction", format_currency(avg_transaction))
+                    
+                    if not data['payment_split'].empty:
+                        st.subheader("Payment Method Split")
+                        st.dataframe(data['payment_split'])
                 
                 elif report_type == "Weekly Sales":
-                    trans_df['week'] = trans_df['date'].dt.strftime('%Y-%U')
-                    report_df = trans_df.groupby('week').agg({
-                        'total': 'sum',
-                        'transaction_id': 'count'
-                    }).rename(columns={'transaction_id': 'transactions'})
-                    
                     st.subheader("Weekly Sales Summary")
                     st.dataframe(report_df)
                     
@@ -6619,130 +9333,66 @@ def reports_analytics():
                     st.bar_chart(report_df['total'])
                 
                 elif report_type == "Monthly Sales":
-                    trans_df['month'] = trans_df['date'].dt.strftime('%Y-%m')
-                    report_df = trans_df.groupby('month').agg({
-                        'total': 'sum',
-                        'transaction_id': 'count'
-                    }).rename(columns={'transaction_id': 'transactions'})
-                    
                     st.subheader("Monthly Sales Summary")
                     st.dataframe(report_df)
                     
                     st.subheader("Monthly Sales Chart")
                     st.area_chart(report_df['total'])
                 
-                elif report_type == "Product Sales":
-                    products = load_data(PRODUCTS_FILE)
-                    product_sales = {}
-                    
-                    for t in trans_list:
-                        for barcode, item in t.get('items', {}).items():
-                            if barcode not in product_sales:
-                                product_sales[barcode] = {
-                                    'name': products.get(barcode, {}).get('name', 'Unknown'),
-                                    'quantity': 0,
-                                    'revenue': 0.0
-                                }
-                            
-                            product_sales[barcode]['quantity'] += item.get('quantity', 0)
-                            product_sales[barcode]['revenue'] += item.get('price', 0) * item.get('quantity', 0)
+                elif report_type == "Hourly Sales":
+                    st.subheader("Hourly Sales Pattern")
+                    st.bar_chart(report_df['total'])
                     
-                    if not product_sales:
+                    st.subheader("Hourly Transaction Count")
+                    st.bar_chart(report_df['transactions'])
+                
+                elif report_type == "Product Sales":
+                    if report_df.empty:
                         st.info("No product sales in selected date range")
                     else:
-                        sales_df = pd.DataFrame.from_dict(product_sales, orient='index')
-                        sales_df = sales_df.sort_values('revenue', ascending=False)
-                        
                         st.subheader("Product Sales Summary")
-                        st.dataframe(sales_df)
+                        st.dataframe(report_df)
                         
                         st.subheader("Top Selling Products")
                         top_n = st.slider("Show Top", 1, 20, 5)
-                        st.bar_chart(sales_df.head(top_n)['revenue'])
+                        st.bar_chart(report_df.head(top_n)['revenue'])
                 
-                elif report_type == "Category Sales":
-                    products = load_data(PRODUCTS_FILE)
-                    categories = load_data(CATEGORIES_FILE).get('categories', [])
-                    category_sales = {}
-                    
-                    for cat in categories:
-                        category_sales[cat] = {'revenue': 0.0, 'quantity': 0}
-                    
-                    for t in trans_list:
-                        for barcode, item in t.get('items', {}).items():
-                            product = products.get(barcode, {})
-                            category = product.get('category', 'Unknown')
-                            
-                            if category not in category_sales:
-                                category_sales[category] = {'revenue': 0.0, 'quantity': 0}
-                            
-                            category_sales[category]['quantity'] += item.get('quantity', 0)
-                            category_sales[category]['revenue'] += item.get('price', 0) * item.get('quantity', 0)
-                    
-                    if not category_sales:
-                        st.info("No category sales in selected date range")
+                elif report_type in ["Category Sales", "Brand Sales"]:
+                    group = 'Category' if report_type == "Category Sales" else 'Brand'
+                    if report_df.empty:
+                        st.info(f"No {group.lower()} sales in selected date range")
                     else:
-                        sales_df = pd.DataFrame.from_dict(category_sales, orient='index')
-                        sales_df = sales_df.sort_values('revenue', ascending=False)
-                        
-                        st.subheader("Category Sales Summary")
-                        st.dataframe(sales_df)
+                        st.subheader(f"{group} Sales Summary")
+                        st.dataframe(report_df)
                         
-                        st.subheader("Sales by Category")
-                        st.bar_chart(sales_df['revenue'])
+                        st.subheader(f"Sales by {group}")
+                        st.bar_chart(report_df['revenue'])
                 
                 elif report_type == "Cashier Performance":
-                    cashier_performance = {}
-                    
-                    for t in trans_list:
-                        cashier = t.get('cashier', 'Unknown')
-                        if cashier not in cashier_performance:
-                            cashier_performance[cashier] = {
-                                'transactions': 0,
-                                'total_sales': 0.0,
-                                'avg_sale': 0.0
-                            }
-                        
-                        cashier_performance[cashier]['transactions'] += 1
-                        cashier_performance[cashier]['total_sales'] += t.get('total', 0)
-                    
-                    for cashier, data in cashier_performance.items():
-                        if data['transactions'] > 0:
-                            data['avg_sale'] = data['total_sales'] / data['transactions']
-                    
-                    if not cashier_performance:
-                        st.info("No cashier data in selected date range")
-                    else:
-                        performance_df = pd.DataFrame.from_dict(cashier_performance, orient='index')
-                        performance_df = performance_df.sort_values('total_sales', ascending=False)
-                        
-                        st.subheader("Cashier Performance Summary")
-                        st.dataframe(performance_df)
-                        
-                        st.subheader("Sales by Cashier")
-                        st.bar_chart(performance_df['total_sales'])
-                
-                elif report_type == "Hourly Sales":
-                    trans_df['hour'] = trans_df['date'].dt.hour
-                    hourly_sales = trans_df.groupby('hour').agg({
-                        'total': 'sum',
-                        'transaction_id': 'count'
-                    }).rename(columns={'transaction_id': 'transactions'})
-                    
-                    st.subheader("Hourly Sales Pattern")
-                    st.bar_chart(hourly_sales['total'])
+                    st.subheader("Cashier Performance Summary")
+                    st.dataframe(report_df)
                     
-                    st.subheader("Hourly Transaction Count")
-                    st.bar_chart(hourly_sales['transactions'])
+                    st.subheader("Sales by Cashier")
+                    st.bar_chart(report_df['total_sales'])
                 
-                # Export option
-                csv = trans_df.to_csv(index=False)
-                st.download_button(
-                    label="Export Sales Data",
-                    data=csv,
-                    file_name=f"sales_report_{start_date}_to_{end_date}.csv",
-                    mime="text/csv"
-                )
+                # Export options
+                col1, col2 = st.columns(2)
+                with col1:
+                    export_download("Export Report Table", lambda: iter_frame_chunks(report_df),
+                                    f"sales_report_{start_date}_to_{end_date}", key="export_sales_report")
+                with col2:
+                    export_download("Export Line Items",
+                                    lambda: iter_line_item_chunks(load_data(TRANSACTIONS_FILE), load_data(PRODUCTS_FILE),
+                                                                  start_date, end_date),
+                                    f"sales_line_items_{start_date}_to_{end_date}", key="export_sales_lines")
+            
+            if report_type in ROLLUP_REPORTS and st.button("Rebuild Sales Rollups"):
+                try:
+                    with data_dir_lock():
+                        rebuild_sales_rollups()
+                    st.success("Sales rollups rebuilt from transaction history")
+                except TimeoutError:
+                    st.error("Lane sales are being merged; try again in a moment")
     
     with tab2:
         st.header("Inventory Reports")
@@ -6763,30 +9413,19 @@ def reports_analytics():
             ])
             
             if report_type == "Stock Levels":
-                inventory_list = []
-                for barcode, inv_data in inventory.items():
-                    product = products.get(barcode, {'name': 'Unknown'})
-                    inventory_list.append({
-                        'product': product['name'],
-                        'barcode': barcode,
-                        'quantity': inv_data.get('quantity', 0),
-                        'reorder_point': inv_data.get('reorder_point', 10),
-                        'status': 'Low Stock' if inv_data.get('quantity', 0) < inv_data.get('reorder_point', 10) else 'OK'
-                    })
-                
-                inv_df = pd.DataFrame(inventory_list)
+                snapshot = get_inventory_snapshot()
                 
                 # Filter options
                 show_low_stock = st.checkbox("Show Only Low Stock Items")
                 if show_low_stock:
-                    inv_df = inv_df[inv_df['status'] == 'Low Stock']
+                    snapshot = snapshot[snapshot['low_stock']]
                 
-                st.dataframe(inv_df)
+                st.dataframe(stock_levels_frame(snapshot))
                 
                 # Summary
-                total_items = len(inv_df)
-                low_stock_items = len(inv_df[inv_df['status'] == 'Low Stock'])
-                out_of_stock_items = len(inv_df[inv_df['quantity'] == 0])
+                total_items = len(snapshot)
+                low_stock_items = int(snapshot['low_stock'].sum())
+                out_of_stock_items = int((snapshot['quantity'] == 0).sum())
                 
                 col1, col2, col3 = st.columns(3)
                 col1.metric("Total Items", total_items)
@@ -6794,106 +9433,74 @@ def reports_analytics():
                 col3.metric("Out of Stock", out_of_stock_items)
             
             elif report_type == "Stock Value":
-                value_list = []
-                for barcode, inv_data in inventory.items():
-                    product = products.get(barcode, {'name': 'Unknown', 'cost': 0})
-                    value_list.append({
-                        'product': product['name'],
-                        'barcode': barcode,
-                        'quantity': inv_data.get('quantity', 0),
-                        'unit_cost': product.get('cost', 0),
-                        'total_value': inv_data.get('quantity', 0) * product.get('cost', 0)
-                    })
-                
-                value_df = pd.DataFrame(value_list)
-                total_value = value_df['total_value'].sum()
-                
-                st.write(f"**Total Inventory Value:** {format_currency(total_value)}")
-                st.dataframe(value_df.sort_values('total_value', ascending=False))
+                snapshot = get_inventory_snapshot()
+                st.write(f"**Total Inventory Value:** {format_money(int(snapshot['stock_value'].sum()))}")
+                st.dataframe(stock_value_frame(snapshot))
                 
                 # Value by category
-                category_value = {}
-                for barcode, inv_data in inventory.items():
-                    product = products.get(barcode, {})
-                    category = product.get('category', 'Unknown')
-                    cost = product.get('cost', 0)
-                    quantity = inv_data.get('quantity', 0)
-                    
-                    category_value[category] = category_value.get(category, 0) + (cost * quantity)
-                
-                if category_value:
-                    cat_df = pd.DataFrame({
-                        'Category': list(category_value.keys()),
-                        'Value': list(category_value.values())
-                    }).sort_values('Value', ascending=False)
+                codes = snapshot['category'].cat.codes.to_numpy()
+                category_value = np.bincount(codes, weights=snapshot['stock_value'].to_numpy(),
+                                             minlength=len(snapshot['category'].cat.categories))
+                if len(snapshot):
+                    cat_df = money_columns_to_units(pd.DataFrame({
+                        'Category': snapshot['category'].cat.categories,
+                        'Value': category_value.astype(np.int64)
+                    }), ['Value']).sort_values('Value', ascending=False)
                     
                     st.subheader("Inventory Value by Category")
                     st.bar_chart(cat_df.set_index('Category'))
             
             elif report_type == "Stock Movement":
-                st.info("Stock movement analysis would show inventory changes over time")
-                # This would require tracking inventory changes history
+                stock_movement_view(products, key="report_movement")
                 
             elif report_type == "Inventory Audit":
                 st.info("Generate audit sheets for physical inventory counting")
-                if st.button("Generate Audit Sheet"):
-                    audit_data = []
-                    for barcode, inv_data in inventory.items():
-                        product = products.get(barcode, {'name': 'Unknown'})
-                        audit_data.append({
-                            'Product': product['name'],
-                            'Barcode': barcode,
-                            'System Quantity': inv_data.get('quantity', 0),
-                            'Physical Count': "",
-                            'Variance': "",
-                            'Notes': ""
-                        })
-                    
-                    audit_df = pd.DataFrame(audit_data)
-                    st.dataframe(audit_df)
-                    
-                    csv = audit_df.to_csv(index=False)
-                    st.download_button(
-                        label="Download Audit Sheet",
-                        data=csv,
-                        file_name=f"inventory_audit_{datetime.date.today()}.csv",
-                        mime="text/csv"
-                    )
+                if st.button("Run in Background", key="report_audit_sheet_job"):
+                    submit_report_job('inventory_audit', "Inventory Audit Sheet", {})
+                export_download("Generate Audit Sheet", lambda: iter_frame_chunks(build_audit_sheet()),
+                                f"inventory_audit_{datetime.date.today()}", key="report_gen_audit_sheet")
             
             elif report_type == "Low Stock Alert":
-                low_stock_items = []
-                for barcode, inv_data in inventory.items():
-                    if inv_data.get('quantity', 0) < inv_data.get('reorder_point', 10):
-                        product = products.get(barcode, {'name': 'Unknown', 'cost': 0})
-                        low_stock_items.append({
-                            'Product': product['name'],
-                            'Barcode': barcode,
-                            'Current Stock': inv_data.get('quantity', 0),
-                            'Reorder Point': inv_data.get('reorder_point', 10),
-                            'Needed': max(0, inv_data.get('reorder_point', 10) - inv_data.get('quantity', 0)),
-                            'Cost': product.get('cost', 0),
-                            'Value Needed': max(0, inv_data.get('reorder_point', 10) - inv_data.get('quantity', 0)) * product.get('cost', 0)
-                        })
+                low_df = low_stock_frame(get_inventory_snapshot())
                 
-                if not low_stock_items:
+                if low_df.empty:
                     st.success("No low stock items! All inventory levels are adequate.")
                 else:
-                    low_df = pd.DataFrame(low_stock_items)
-                    st.dataframe(low_df.sort_values('Needed', ascending=False))
+                    st.dataframe(low_df)
                     
                     total_value_needed = low_df['Value Needed'].sum()
                     st.metric("Total Value Needed to Reorder", format_currency(total_value_needed))
             
             elif report_type == "Slow Moving Items":
-                # This would analyze products with low sales velocity
-                st.info("Slow moving items analysis would identify products with low turnover")
+                cover_days = st.slider("Slow when stock covers more than (days)", 14, 365, 90, key="slow_cover_days")
+                slow_df = slow_moving_frame(cover_days)
+                
+                if slow_df.empty:
+                    st.success("No dead or slow moving stock")
+                else:
+                    dead = slow_df['status'] == 'Dead'
+                    col1, col2, col3 = st.columns(3)
+                    col1.metric("Dead Items", int(dead.sum()))
+                    col2.metric("Slow Items", int((~dead).sum()))
+                    col3.metric("Capital Tied Up", format_money(int(slow_df['capital'].sum())))
+                    
+                    st.dataframe(money_columns_to_units(slow_df, ['capital']).rename(columns={
+                        'product': 'Product', 'barcode': 'Barcode', 'category': 'Category',
+                        'status': 'Status', 'quantity': 'Stock', 'capital': 'Capital',
+                        'days_of_cover': 'Days of Cover', 'days_since_sold': 'Days Since Sold',
+                        'units_7d': 'Units (7d)', 'units_30d': 'Units (30d)', 'units_90d': 'Units (90d)'
+                    })[['Product', 'Barcode', 'Category', 'Status', 'Stock', 'Capital', 'Days of Cover',
+                        'Days Since Sold', 'Units (7d)', 'Units (30d)', 'Units (90d)']])
+                
+                if st.button("Rebuild Sales Velocity"):
+                    rebuild_sales_velocity()
+                    st.success("Sales velocity rebuilt from transaction history")
     
     with tab3:
         st.header("Customer Reports")
         
         loyalty = load_data(LOYALTY_FILE)
         customers = loyalty.get('customers', {})
-        transactions = load_data(TRANSACTIONS_FILE)
         
         if not customers:
             st.info("No customer data available")
@@ -6911,44 +9518,28 @@ def reports_analytics():
             with col2:
                 end_date = st.date_input("End Date", value=datetime.date.today(), key="cust_end_date")
             
+            st.caption(f"Customer figures are kept by month: {start_date.strftime('%Y-%m')} to {end_date.strftime('%Y-%m')}")
+            
             if report_type == "Customer Spending":
-                customer_spending = {}
-                
-                for cust_id, customer in customers.items():
-                    customer_spending[cust_id] = {
-                        'name': customer['name'],
-                        'email': customer['email'],
-                        'phone': customer.get('phone', ''),
-                        'transactions': 0,
-                        'total_spent': 0.0,
-                        'avg_spend': 0.0,
-                        'last_purchase': None
-                    }
-                
-                for t in transactions.values():
-                    try:
-                        trans_date = datetime.datetime.strptime(t.get('date', ''), "%Y-%m-%d %H:%M:%S").date()
-                        if 'customer_id' in t and start_date <= trans_date <= end_date:
-                            cust_id = t['customer_id']
-                            if cust_id in customer_spending:
-                                customer_spending[cust_id]['transactions'] += 1
-                                customer_spending[cust_id]['total_spent'] += t.get('total', 0)
-                                # Update last purchase date
-                                if not customer_spending[cust_id]['last_purchase'] or trans_date > datetime.datetime.strptime(customer_spending[cust_id]['last_purchase'], "%Y-%m-%d").date():
-                                    customer_spending[cust_id]['last_purchase'] = trans_date.strftime("%Y-%m-%d")
-                    except (ValueError, KeyError, AttributeError):
-                        continue
-                
-                for cust_id, data in customer_spending.items():
-                    if data['transactions'] > 0:
-                        data['avg_spend'] = data['total_spent'] / data['transactions']
-                
-                if not customer_spending:
+                spending = customer_spending_frame(start_date, end_date).reindex(list(customers))
+                transactions_count = spending['transactions'].fillna(0).astype(np.int64)
+                total_spent = spending['total_spent'].fillna(0).astype(np.int64)
+                last_purchase = pd.to_datetime(spending['last_ts'], unit='s', utc=True).dt.tz_convert(get_store_timezone())
+                
+                spending_df = money_columns_to_units(pd.DataFrame({
+                    'name': [c['name'] for c in customers.values()],
+                    'email': [c.get('email', '') for c in customers.values()],
+                    'phone': [c.get('phone', '') for c in customers.values()],
+                    'transactions': transactions_count,
+                    'total_spent': total_spent,
+                    'avg_spend': np.where(transactions_count > 0, total_spent // transactions_count.clip(lower=1), 0),
+                    'last_purchase': last_purchase.dt.strftime("%Y-%m-%d")
+                }, index=spending.index), ['total_spent', 'avg_spend'])
+                spending_df = spending_df.sort_values('total_spent', ascending=False)
+                
+                if spending_df['transactions'].sum() == 0:
                     st.info("No customer spending data in selected date range")
                 else:
-                    spending_df = pd.DataFrame.from_dict(customer_spending, orient='index')
-                    spending_df = spending_df.sort_values('total_spent', ascending=False)
-                    
                     st.subheader("Customer Spending Summary")
                     st.dataframe(spending_df)
                     
@@ -6966,17 +9557,54 @@ def reports_analytics():
                 st.bar_chart(tier_distribution)
             
             elif report_type == "Customer Segmentation":
-                st.info("Customer segmentation analysis would group customers by purchasing behavior")
-                # This would involve RFM analysis (Recency, Frequency, Monetary)
+                summary = load_data(CUSTOMER_SEGMENTS_FILE)
+                if st.button("Refresh Segments", key="refresh_segments_job"):
+                    submit_report_job('customer_segments', "Customer Segments", {})
+                
+                if not summary.get('counts'):
+                    st.info("Segments have not been computed yet; they refresh nightly or on request")
+                else:
+                    st.caption(f"RFM segments over all purchases, refreshed {summary['refreshed']}. "
+                               "Not limited to the date range above.")
+                    counts = pd.Series(summary['counts']).reindex(RFM_SEGMENTS, fill_value=0)
+                    st.subheader("Customers per Segment")
+                    st.bar_chart(counts)
+                    
+                    segment_filter = st.multiselect("Segments", RFM_SEGMENTS, key="segment_filter")
+                    labels = load_data(CUSTOMER_RFM_FILE)
+                    unscored = {'segment': '', 'rfm': ''}
+                    segment_df = pd.DataFrame({
+                        'name': [c['name'] for c in customers.values()],
+                        'phone': [c.get('phone', '') for c in customers.values()],
+                        'tier': [c.get('tier', '') for c in customers.values()],
+                        'segment': [labels.get(customer_id, unscored)['segment'] for customer_id in customers],
+                        'rfm': [labels.get(customer_id, unscored)['rfm'] for customer_id in customers]
+                    }, index=list(customers))
+                    if segment_filter:
+                        segment_df = segment_df[segment_df['segment'].isin(segment_filter)]
+                    st.dataframe(segment_df.sort_values('rfm', ascending=False))
                 
             elif report_type == "New vs Returning Customers":
-                st.info("Analysis of new versus returning customers would be implemented here")
+                summary = new_vs_returning_frame(start_date, end_date)
+                
+                if summary.empty:
+                    st.info("No customer purchases in selected date range")
+                else:
+                    summary = money_columns_to_units(summary, ['new_spend', 'returning_spend'])
+                    col1, col2, col3 = st.columns(3)
+                    col1.metric("New Customers", int(summary['new_customers'].sum()))
+                    col2.metric("Returning Visits", int(summary['returning_visits'].sum()))
+                    col3.metric("Returning Share of Spend",
+                                f"{summary['returning_spend'].sum() / max(summary[['new_spend', 'returning_spend']].sum().sum(), 0.01) * 100:.1f}%")
+                    
+                    st.subheader("Customers per Month")
+                    st.bar_chart(summary[['new_customers', 'returning_customers']])
+                    st.dataframe(summary)
     
     with tab4:
         st.header("Payment Analysis")
         
-        transactions = load_data(TRANSACTIONS_FILE)
-        if not transactions:
+        if get_sales_frames()[0].empty:
             st.info("No transaction data available")
         else:
             col1, col2 = st.columns(2)
@@ -6985,53 +9613,28 @@ def reports_analytics():
             with col2:
                 end_date = st.date_input("End Date", value=datetime.date.today(), key="pay_end_date")
             
-            payment_methods = {}
+            if st.button("Run in Background", key="payment_report_job"):
+                submit_report_job('payments', "Payment Analysis", {
+                    'start_date': start_date.isoformat(),
+                    'end_date': end_date.isoformat()
+                })
             
-            for t in transactions.values():
-                try:
-                    trans_date = datetime.datetime.strptime(t.get('date', ''), "%Y-%m-%d %H:%M:%S").date()
-                    if start_date <= trans_date <= end_date:
-                        method = t.get('payment_method', 'Unknown')
-                        if method not in payment_methods:
-                            payment_methods[method] = {'count': 0, 'total': 0.0}
-                        
-                        payment_methods[method]['count'] += 1
-                        payment_methods[method]['total'] += t.get('total', 0)
-                except (ValueError, KeyError, AttributeError):
-                    continue
+            data = cached_report('payments', (start_date, end_date), (TRANSACTIONS_FILE, PRODUCTS_FILE),
+                                 lambda: compute_payment_report(start_date, end_date))
             
-            if not payment_methods:
+            if data is None:
                 st.info("No payment data in selected date range")
             else:
-                payment_df = pd.DataFrame.from_dict(payment_methods, orient='index')
-                payment_df = payment_df.sort_values('total', ascending=False)
-                
                 st.subheader("Payment Method Summary")
-                st.dataframe(payment_df)
+                st.dataframe(data['summary'])
                 
                 st.subheader("Payment Method Distribution")
-                st.bar_chart(payment_df['total'])
+                st.bar_chart(data['summary']['total'])
                 
                 # Payment method trends over time
-                payment_trends = {}
-                for t in transactions.values():
-                    try:
-                        trans_date = datetime.datetime.strptime(t.get('date', ''), "%Y-%m-%d %H:%M:%S").date()
-                        if start_date <= trans_date <= end_date:
-                            method = t.get('payment_method', 'Unknown')
-                            date_key = trans_date.strftime("%Y-%m-%d")
-                            
-                            if date_key not in payment_trends:
-                                payment_trends[date_key] = {}
-                            
-                            payment_trends[date_key][method] = payment_trends[date_key].get(method, 0) + t.get('total', 0)
-                    except (ValueError, KeyError, AttributeError):
-                        continue
-                
-                if payment_trends:
-                    trend_df = pd.DataFrame.from_dict(payment_trends, orient='index').fillna(0)
+                if not data['trends'].empty:
                     st.subheader("Payment Method Trends")
-                    st.line_chart(trend_df)
+                    st.line_chart(data['trends'])
     
     with tab5:
         st.header("Brand Reports")
@@ -7039,9 +9642,8 @@ def reports_analytics():
         brands_data = load_data(BRANDS_FILE)
         products = load_data(PRODUCTS_FILE)
         inventory = load_data(INVENTORY_FILE)
-        transactions = load_data(TRANSACTIONS_FILE)
         brands_list = brands_data.get('brands', [])
-        brand_products = brands_data.get('brand_products', {})
+        brand_products = get_brand_products()
         
         if not brands_list:
             st.info("No brands available for reporting")
@@ -7062,29 +9664,7 @@ def reports_analytics():
                     end_date = st.date_input("End Date", value=datetime.date.today(), key="brand_end_date")
             
             if report_type == "Sales by Brand":
-                brand_sales = {}
-                for brand in brands_list:
-                    brand_sales[brand] = {'revenue': 0, 'units': 0, 'transactions': 0}
-                
-                for transaction in transactions.values():
-                    try:
-                        trans_date = datetime.datetime.strptime(transaction.get('date', ''), "%Y-%m-%d %H:%M:%S").date()
-                        if start_date <= trans_date <= end_date:
-                            has_brand_items = False
-                            for barcode, item in transaction.get('items', {}).items():
-                                product = products.get(barcode, {})
-                                brand = product.get('brand')
-                                if brand and brand in brand_sales:
-                                    brand_sales[brand]['revenue'] += item['price'] * item['quantity']
-                                    brand_sales[brand]['units'] += item['quantity']
-                                    has_brand_items = True
-                            
-                            if has_brand_items:
-                                brand_sales[brand]['transactions'] += 1
-                    except (ValueError, KeyError):
-                        continue
-                
-                sales_df = pd.DataFrame.from_dict(brand_sales, orient='index')
+                sales_df = brand_sales_frame(start_date, end_date, brands_list)
                 sales_df = sales_df.sort_values('revenue', ascending=False)
                 
                 st.subheader("Sales by Brand")
@@ -7131,26 +9711,15 @@ def reports_analytics():
                 selected_brand = st.selectbox("Select Brand", [""] + brands_list)
                 
                 if selected_brand:
-                    product_sales = {}
-                    for barcode in brand_products.get(selected_brand, []):
-                        product_sales[barcode] = {
-                            'name': products.get(barcode, {}).get('name', 'Unknown'),
-                            'revenue': 0,
-                            'units': 0
-                        }
-                    
-                    for transaction in transactions.values():
-                        try:
-                            trans_date = datetime.datetime.strptime(transaction.get('date', ''), "%Y-%m-%d %H:%M:%S").date()
-                            if start_date <= trans_date <= end_date:
-                                for barcode, item in transaction.get('items', {}).items():
-                                    if barcode in product_sales:
-                                        product_sales[barcode]['revenue'] += item['price'] * item['quantity']
-                                        product_sales[barcode]['units'] += item['quantity']
-                        except (ValueError, KeyError):
-                            continue
-                    
-                    performance_df = pd.DataFrame.from_dict(product_sales, orient='index')
+                    barcodes = brand_products.get(selected_brand, [])
+                    items_df = filter_by_date(get_sales_frames()[1], start_date, end_date)
+                    items_df = items_df[items_df['barcode'].isin(barcodes)]
+                    performance_df = items_df.groupby('barcode', observed=True).agg(
+                        revenue=('revenue', 'sum'),
+                        units=('quantity', 'sum')
+                    ).reindex(barcodes, fill_value=0)
+                    performance_df = money_columns_to_units(performance_df, ['revenue'])
+                    performance_df.insert(0, 'name', [products.get(b, {}).get('name', 'Unknown') for b in barcodes])
                     performance_df = performance_df.sort_values('revenue', ascending=False)
                     
                     st.subheader(f"Product Performance for {selected_brand}")
@@ -7167,24 +9736,13 @@ def reports_analytics():
                 comparison_metric = st.selectbox("Comparison Metric", ["Revenue", "Inventory Value", "Product Count"])
                 
                 comparison_data = {}
+                if comparison_metric == "Revenue":
+                    # Revenue for the last 30 days
+                    today = get_current_datetime().date()
+                    comparison_data = brand_sales_frame(today - datetime.timedelta(days=30), today,
+                                                        brands_list)['revenue'].to_dict()
                 for brand in brands_list:
-                    if comparison_metric == "Revenue":
-                        # Calculate revenue for last 30 days
-                        thirty_days_ago = (datetime.datetime.now() - datetime.timedelta(days=30)).date()
-                        revenue = 0
-                        for transaction in transactions.values():
-                            try:
-                                trans_date = datetime.datetime.strptime(transaction.get('date', ''), "%Y-%m-%d %H:%M:%S").date()
-                                if trans_date >= thirty_days_ago:
-                                    for barcode, item in transaction.get('items', {}).items():
-                                        product = products.get(barcode, {})
-                                        if product.get('brand') == brand:
-                                            revenue += item['price'] * item['quantity']
-                            except (ValueError, KeyError):
-                                continue
-                        comparison_data[brand] = revenue
-                    
-                    elif comparison_metric == "Inventory Value":
+                    if comparison_metric == "Inventory Value":
                         value = 0
                         for barcode in brand_products.get(brand, []):
                             inv_data = inventory.get(barcode, {})
@@ -7220,19 +9778,15 @@ def reports_analytics():
             with col2:
                 end_date = st.date_input("End Date", value=datetime.date.today(), key="return_end")
             
-            # Filter returns by date
-            filtered_returns = []
-            for return_data in returns_data.values():
-                return_date = datetime.datetime.strptime(return_data['return_date'], "%Y-%m-%d %H:%M:%S").date()
-                if start_date <= return_date <= end_date:
-                    filtered_returns.append(return_data)
+            data = cached_report('returns', (start_date, end_date), (RETURNS_FILE, PRODUCTS_FILE),
+                                 lambda: compute_return_report(start_date, end_date))
             
-            if not filtered_returns:
+            if data is None:
                 st.info("No returns in selected date range")
             else:
                 # Calculate analytics
-                total_returns = len(filtered_returns)
-                total_refund_amount = sum(r['total_refund'] for r in filtered_returns)
+                total_returns = data['total_returns']
+                total_refund_amount = data['total_refund_amount']
                 avg_refund = total_refund_amount / total_returns if total_returns > 0 else 0
                 
                 # Return rate calculation (would need total sales data)
@@ -7242,70 +9796,141 @@ def reports_analytics():
                 col2.metric("Total Refund Amount", format_currency(total_refund_amount))
                 col3.metric("Average Refund", format_currency(avg_refund))
                 
-                # Return reasons analysis
-                return_reasons = {}
-                for return_data in filtered_returns:
-                    reason = return_data['reason']
-                    return_reasons[reason] = return_reasons.get(reason, 0) + 1
-                
-                if return_reasons:
-                    reasons_df = pd.DataFrame({
-                        'Reason': list(return_reasons.keys()),
-                        'Count': list(return_reasons.values())
-                    }).sort_values('Count', ascending=False)
-                    
+                if not data['reasons'].empty:
                     st.subheader("Returns by Reason")
-                    st.bar_chart(reasons_df.set_index('Reason'))
-                
-                # Return by product type
-                products = load_data(PRODUCTS_FILE)
-                product_returns = {}
-                for return_data in filtered_returns:
-                    for barcode, item in return_data['items'].items():
-                        product_name = products.get(barcode, {}).get('name', 'Unknown')
-                        product_returns[product_name] = product_returns.get(product_name, 0) + item['quantity']
+                    st.bar_chart(data['reasons'])
                 
-                if product_returns:
-                    product_df = pd.DataFrame({
-                        'Product': list(product_returns.keys()),
-                        'Return Quantity': list(product_returns.values())
-                    }).sort_values('Return Quantity', ascending=False).head(10)
-                    
+                if not data['product_returns'].empty:
                     st.subheader("Most Returned Products")
-                    st.bar_chart(product_df.set_index('Product'))
+                    st.bar_chart(data['product_returns'])
     
     with tab7:
         st.header("Custom Reports")
         
-        st.info("Create custom reports with specific filters and criteria")
+        saved_reports = load_data(CUSTOM_REPORTS_FILE)
+        saved_options = ["New Report"] + list(saved_reports.keys())
+        selected = st.selectbox("Saved Reports", saved_options,
+                                format_func=lambda x: x if x == "New Report" else saved_reports[x]['name'],
+                                key="custom_saved")
+        base = saved_reports.get(selected, {})
+        suffix = selected  # widget keys follow the loaded definition
         
-        with st.form("custom_report_form"):
-            report_name = st.text_input("Report Name", "Custom_Report")
-            
+        col1, col2 = st.columns(2)
+        with col1:
+            report_name = st.text_input("Report Name", base.get('name', "Custom_Report"), key=f"custom_name_{suffix}")
+        with col2:
+            source_names = list(QUERY_SOURCES.keys())
+            source_name = st.selectbox("Data Source", source_names,
+                                       index=source_names.index(base.get('source', 'line_items')),
+                                       format_func=lambda x: QUERY_SOURCES[x]['label'], key=f"custom_source_{suffix}")
+        source = QUERY_SOURCES[source_name]
+        dated = 'date' in source['dimensions']
+        
+        start_date = end_date = None
+        if dated:
             col1, col2 = st.columns(2)
             with col1:
-                start_date = st.date_input("Start Date", value=datetime.date.today() - datetime.timedelta(days=30), key="custom_start")
+                start_date = st.date_input("Start Date", value=datetime.date.fromisoformat(base['start_date'])
+                                           if base.get('start_date') else datetime.date.today() - datetime.timedelta(days=30),
+                                           key=f"custom_start_{suffix}")
             with col2:
-                end_date = st.date_input("End Date", value=datetime.date.today(), key="custom_end")
-            
-            report_type = st.selectbox("Report Type", [
-                "Sales Summary",
-                "Product Performance",
-                "Customer Analysis",
-                "Inventory Status"
-            ])
-            
-            if report_type == "Sales Summary":
-                st.info("Sales summary report would show overall sales performance")
-            elif report_type == "Product Performance":
-                st.info("Product performance report would analyze product sales and profitability")
-            elif report_type == "Customer Analysis":
-                st.info("Customer analysis report would examine customer behavior and value")
-            elif report_type == "Inventory Status":
-                st.info("Inventory status report would show current stock levels and values")
-            
-            if st.form_submit_button("Generate Custom Report"):
-                st.success(f"Custom report '{report_name}' would be generated for {start_date} to {end_date}")
+                end_date = st.date_input("End Date", value=datetime.date.fromisoformat(base['end_date'])
+                                         if base.get('end_date') else datetime.date.today(),
+                                         key=f"custom_end_{suffix}")
+        
+        dimensions = list(source['dimensions'].keys())
+        group_by = st.multiselect("Group By", dimensions,
+                                  default=[d for d in base.get('group_by', []) if d in dimensions],
+                                  key=f"custom_group_{suffix}_{source_name}")
+        date_grain = None
+        if 'date' in group_by:
+            grains = list(QUERY_DATE_GRAINS.keys())
+            date_grain = st.selectbox("Date Grain", grains, index=grains.index(base.get('date_grain') or 'day'),
+                                      key=f"custom_grain_{suffix}")
+        
+        measure_options = [f"{agg} of {field}" for field in source['fields'] for agg in QUERY_AGGREGATES]
+        default_measures = [f"{m['agg']} of {m['field']}" for m in base.get('measures', [])]
+        measure_labels = st.multiselect("Measures", measure_options,
+                                        default=[m for m in default_measures if m in measure_options] or measure_options[:1],
+                                        key=f"custom_measures_{suffix}_{source_name}")
+        
+        st.subheader("Filters")
+        filter_fields = [""] + sorted(set(source['dimensions'].values()) | set(source['fields']))
+        base_filters = base.get('filters', [])
+        filters = []
+        for i in range(3):
+            current = base_filters[i] if i < len(base_filters) else {}
+            col1, col2, col3 = st.columns([2, 1, 2])
+            with col1:
+                field = st.selectbox("Field", filter_fields,
+                                     index=filter_fields.index(current['field']) if current.get('field') in filter_fields else 0,
+                                     key=f"custom_filter_field_{suffix}_{source_name}_{i}")
+            with col2:
+                op = st.selectbox("Operator", QUERY_OPERATORS,
+                                  index=QUERY_OPERATORS.index(current.get('op', '=')),
+                                  key=f"custom_filter_op_{suffix}_{source_name}_{i}")
+            with col3:
+                value = st.text_input("Value", str(current.get('value', '')),
+                                      help="Comma separated for 'in'",
+                                      key=f"custom_filter_value_{suffix}_{source_name}_{i}")
+            if field and value:
+                filters.append({'field': field, 'op': op, 'value': value})
+        
+        query = {
+            'name': report_name,
+            'source': source_name,
+            'start_date': start_date.isoformat() if start_date else None,
+            'end_date': end_date.isoformat() if end_date else None,
+            'date_grain': date_grain,
+            'filters': filters,
+            'group_by': group_by,
+            'measures': [{'agg': label.split(' of ')[0], 'field': label.split(' of ', 1)[1]} for label in measure_labels]
+        }
+        if base.get('report_id'):
+            query['report_id'] = base['report_id']
+        
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            run_clicked = st.button("Run Report", key="custom_run")
+        with col2:
+            if st.button("Save Report", key="custom_save"):
+                save_custom_report(query)
+                st.success(f"Report '{report_name}' saved")
+                st.rerun()
+        with col3:
+            if st.button("Run in Background", key="custom_report_job"):
+                submit_report_job('custom', report_name, query)
+        with col4:
+            if base and st.button("Delete Saved Report", key="custom_delete"):
+                delete_custom_report(selected)
+                st.success("Saved report deleted")
+                st.rerun()
+        
+        if run_clicked:
+            st.session_state.custom_report_query = query
+        
+        # Results stay up across reruns (e.g. export clicks) until the definition changes
+        if st.session_state.get('custom_report_query') == query:
+            try:
+                result = cached_report('custom', json.dumps(query, sort_keys=True), source['files'],
+                                       lambda: run_query(query))
+            except (KeyError, ValueError, TypeError) as e:
+                st.error(f"Could not run report: {e}")
+                result = None
+            
+            if result is not None:
+                if result.empty:
+                    st.info("No data matches this report")
+                else:
+                    result = result.reset_index() if group_by else result
+                    st.dataframe(result)
+                    if len(group_by) == 1 and len(query['measures']) >= 1:
+                        st.bar_chart(result.set_index(result.columns[0])[result.columns[1]])
+                    export_download("Export Report", lambda: iter_frame_chunks(result),
+                                    f"{report_name}_{datetime.date.today()}", key="custom_export")
+    
+    with tab8:
+        report_jobs_tab()
 
 # Shifts Management
 def shifts_management():
@@ -7555,6 +10180,40 @@ def system_settings():
             "Printer Name (for reference only)",
             value=settings.get('printer_name', 'Browser Printer')
          )
+         
+         backends = {"Browser": "browser", "ESC/POS": "escpos"}
+         printer_backend = st.selectbox(
+            "Printer Backend",
+            list(backends.keys()),
+            index=list(backends.values()).index(settings.get('printer_backend', 'browser'))
+         )
+         
+         targets = {"Serial": "serial", "Device / File": "device", "Network (TCP)": "tcp"}
+         escpos_target = st.selectbox(
+            "ESC/POS Connection",
+            list(targets.keys()),
+            index=list(targets.values()).index(settings.get('escpos_target', 'serial'))
+         )
+         escpos_address = st.text_input(
+            "ESC/POS Address",
+            value=settings.get('escpos_address', ''),
+            help="Serial port (COM3, /dev/ttyUSB0), device file (/dev/usb/lp0) or host:port for network printers"
+         )
+         col1, col2, col3 = st.columns(3)
+         with col1:
+            escpos_baudrate = st.selectbox(
+                "Baud Rate",
+                [9600, 19200, 38400, 115200],
+                index=[9600, 19200, 38400, 115200].index(int(settings.get('escpos_baudrate', 9600)))
+            )
+         with col2:
+            escpos_drawer_pin = st.selectbox(
+                "Cash Drawer Pin",
+                [0, 1],
+                index=int(settings.get('escpos_drawer_pin', 0))
+            )
+         with col3:
+            escpos_cut = st.checkbox("Cut Paper", value=settings.get('escpos_cut', True))
         
          test_print = st.text_area("Test Receipt Text", 
                                 value="POS System Test Receipt\n====================\nTest Line 1\nTest Line 2\n====================")
@@ -7563,6 +10222,12 @@ def system_settings():
          with col1:
             if st.form_submit_button("Save Printer Settings"):
                 settings['printer_name'] = printer_name
+                settings['printer_backend'] = backends[printer_backend]
+                settings['escpos_target'] = targets[escpos_target]
+                settings['escpos_address'] = escpos_address
+                settings['escpos_baudrate'] = escpos_baudrate
+                settings['escpos_drawer_pin'] = escpos_drawer_pin
+                settings['escpos_cut'] = escpos_cut
                 save_data(settings, SETTINGS_FILE)
                 st.success("Printer settings saved successfully")
          with col2:
@@ -7951,7 +10616,7 @@ def create_complete_backup(backup_name, compress=True):
                 data_files = []
                 for root, _, files in os.walk(DATA_DIR):
                     for file in files:
-                        if file.endswith('.json'):
+                        if file.endswith(('.json', '.jsonl')):
                             file_path = os.path.join(root, file)
                             arcname = os.path.relpath(file_path, DATA_DIR)
                             zipf.write(file_path, arcname)
@@ -7969,7 +10634,7 @@ def create_complete_backup(backup_name, compress=True):
             # Copy all data files
             for root, _, files in os.walk(DATA_DIR):
                 for file in files:
-                    if file.endswith('.json'):
+                    if file.endswith(('.json', '.jsonl')):
                         src_path = os.path.join(root, file)
                         rel_path = os.path.relpath(src_path, DATA_DIR)
                         dst_path = os.path.join(backup_dir, rel_path)
@@ -8073,6 +10738,10 @@ def get_backup_info(backup_path, is_zip):
     except:
         return None
 
+RESTORE_REPLACED_FILES = (PO_INDEX_FILE, PO_RECEIPTS_FILE, STOCK_LEDGER_FILE, SALES_ROLLUPS_FILE,
+                          SALES_VELOCITY_FILE, CUSTOMER_STATS_FILE, DASHBOARD_COUNTERS_FILE, CUSTOMER_RFM_FILE,
+                          CUSTOMER_SEGMENTS_FILE)
+
 def restore_backup(backup_path, is_zip):
     """Restore system from backup"""
     try:
@@ -8103,32 +10772,53 @@ def restore_backup(backup_path, is_zip):
         with open(manifest_path, 'r') as f:
             manifest = json.load(f)
         
-        # Backup original data (safety measure)
-        backup_original_data()
-        
-        # Restore all JSON files
-        json_files = []
-        for root, _, files in os.walk(restore_dir):
-            for file in files:
-                if file.endswith('.json'):
-                    json_files.append(os.path.join(root, file))
-        
-        for json_file in json_files:
-            # Get relative path
-            rel_path = os.path.relpath(json_file, restore_dir)
-            
-            # Skip manifest for now (we'll handle it separately)
-            if os.path.basename(json_file) == 'manifest.json':
-                continue
-            
-            # Destination path
-            dst_path = os.path.join(DATA_DIR, rel_path)
+        # Lanes merge sales into these files; hold them off until the restore is done
+        with data_dir_lock(INVENTORY_LOCK_TIMEOUT):
+            # Backup original data (safety measure)
+            backup_original_data()
+            
+            # Purchase orders, receipts, the stock ledger and the running aggregates are
+            # replaced as a whole. Nothing written after the backup was taken may survive
+            # it: a backup without a ledger gets opening balances again from migration,
+            # and missing aggregates are rebuilt from the restored history.
+            shutil.rmtree(PURCHASE_ORDERS_DIR, ignore_errors=True)
+            os.makedirs(PURCHASE_ORDERS_DIR, exist_ok=True)
+            for file in RESTORE_REPLACED_FILES:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(file)
+            
+            # Restore all JSON files
+            json_files = []
+            for root, _, files in os.walk(restore_dir):
+                for file in files:
+                    if file.endswith(('.json', '.jsonl')):
+                        json_files.append(os.path.join(root, file))
             
-            # Ensure directory exists
-            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            for json_file in json_files:
+                # Get relative path
+                rel_path = os.path.relpath(json_file, restore_dir)
+                
+                # Skip manifest for now (we'll handle it separately)
+                if os.path.basename(json_file) == 'manifest.json':
+                    continue
+                
+                # Destination path
+                dst_path = os.path.join(DATA_DIR, rel_path)
+                
+                # Ensure directory exists
+                os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                
+                # Copy beside the destination and swap it in, so the restored file is a
+                # new inode and incremental readers start it over
+                temp_path = f"{dst_path}.restoring"
+                shutil.copy2(json_file, temp_path)
+                os.replace(temp_path, dst_path)
             
-            # Copy file
-            shutil.copy2(json_file, dst_path)
+            # The PO index and the ledger columns are cached per server process
+            get_po_store().reset()
+            stock_ledger = get_stock_ledger()
+            with stock_ledger.lock:
+                stock_ledger.reset()
         
         # Clean up
         shutil.rmtree(restore_dir)
@@ -8184,7 +10874,7 @@ def backup_original_data():
         
         for root, _, files in os.walk(DATA_DIR):
             for file in files:
-                if file.endswith('.json'):
+                if file.endswith(('.json', '.jsonl')):
                     src_path = os.path.join(root, file)
                     rel_path = os.path.relpath(src_path, DATA_DIR)
                     dst_path = os.path.join(backup_dir, f"{timestamp}_{rel_path}")
@@ -8270,7 +10960,10 @@ def main():
     
     # Initialize data directories and files FIRST
     initialize_empty_data()
+    migrate_data()
     ensure_default_user()
+    # Merging starts only after migration, which rewrites the same files
+    get_spool_reconciler()
 
     
     # Apply theme from settings
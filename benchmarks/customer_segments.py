@@ -0,0 +1,52 @@
+"""RFM segmentation at scale: scoring, storing the labels, and the loyalty.json
+rewrite the labels no longer need.
+
+    python benchmarks/customer_segments.py --customers 1000000
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from support import load_app, timed
+
+
+def month_frame(customers, buyer_share, rng):
+    """A customer x month frame shaped like get_customer_month_frame()"""
+    buyers = customers[:int(len(customers) * buyer_share)]
+    months_each = rng.integers(1, 7, len(buyers))
+    ids = np.repeat(np.asarray(buyers, dtype=object), months_each)
+    months = pd.period_range("2025-01", periods=12, freq='M').astype(str).to_numpy()[rng.integers(0, 12, len(ids))]
+    visits = rng.integers(1, 5, len(ids))
+    return pd.DataFrame({
+        'customer_id': pd.Categorical(ids, categories=customers),
+        'month': months,
+        'spend': visits * rng.integers(500, 20000, len(ids)),
+        'visits': visits,
+        'last_ts': rng.integers(1_735_689_600, 1_767_225_600, len(ids)),
+        'first_month': months
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--customers', type=int, default=1_000_000)
+    parser.add_argument('--buyers', type=float, default=0.8, help="share of customers with purchases")
+    args = parser.parse_args()
+    
+    app = load_app()
+    rng = np.random.default_rng(0)
+    customers = [f"c{i:07d}" for i in range(args.customers)]
+    frame = month_frame(customers, args.buyers, rng)
+    loyalty = {'customers': {c: {'name': c, 'phone': '', 'points': 0, 'tier': 'Bronze'} for c in customers}}
+    app.save_data(loyalty, app.LOYALTY_FILE)
+    app.get_customer_month_frame = lambda: frame
+    print(f"{args.customers} customers, {len(frame)} customer-month rows")
+    
+    timed("compute_rfm_segments", app.compute_rfm_segments, customers, frame, 1_767_225_600)
+    timed("refresh_customer_segments", app.refresh_customer_segments)
+    timed("saving loyalty.json (no longer done)", app.save_data, loyalty, app.LOYALTY_FILE)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Large line-item export to CSV: the chunked write_export path against building
+one DataFrame and calling to_csv() in memory. Each mode runs in its own process
+so peak RSS is not shared.
+
+    python benchmarks/streaming_export.py --rows 5000000
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+
+from support import load_app, peak_rss_mb, timed
+
+
+def line_item_chunks(rows, chunk_rows):
+    """Chunks shaped like iter_line_item_chunks() output"""
+    rng = np.random.default_rng(0)
+    for start in range(0, rows, chunk_rows):
+        n = min(chunk_rows, rows - start)
+        quantity = rng.integers(1, 6, n)
+        price = rng.integers(50, 5000, n) / 100
+        yield pd.DataFrame({
+            'transaction_id': [f"t{i:08d}" for i in range(start // 4, start // 4 + n)],
+            'date': "2026-10-01 12:00:00",
+            'cashier': "cashier1",
+            'payment_method': "Cash",
+            'barcode': [f"{b:012d}" for b in rng.integers(0, 5000, n)],
+            'name': "Product",
+            'category': "Grocery",
+            'brand': "Brand",
+            'quantity': quantity,
+            'price': price,
+            'revenue': quantity * price
+        })
+
+
+def run(mode, rows):
+    app = load_app()
+    print(f"{mode}: baseline peak RSS {peak_rss_mb():.0f} MB")
+    chunks = line_item_chunks(rows, app.EXPORT_CHUNK_ROWS)
+    if mode == 'streamed':
+        path = timed("write_export (CSV)", app.write_export, chunks, 'CSV', prefix="bench")
+        print(f"  {os.path.getsize(path) / 2 ** 20:.0f} MB file")
+        os.remove(path)
+    else:
+        timed("single to_csv", lambda: pd.concat(chunks, ignore_index=True).to_csv(index=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=5_000_000)
+    parser.add_argument('--mode', choices=['streamed', 'to_csv'])
+    args = parser.parse_args()
+    if args.mode:
+        run(args.mode, args.rows)
+        return
+    for mode in ('streamed', 'to_csv'):
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--rows', str(args.rows), '--mode', mode], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""Load app.py outside a Streamlit run, against a scratch store, for the benchmarks"""
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import streamlit as st
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class SessionState(dict):
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+
+def load_app():
+    # Every data path in app.py is relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix="pos_bench_"))
+    st.session_state = SessionState()
+    sys.path.insert(0, ROOT)
+    import app
+    app.initialize_empty_data()
+    return app
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+
+
+def timed(label, fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    print(f"  {label:<36} {time.perf_counter() - start:7.2f} s   peak RSS {peak_rss_mb():7.0f} MB")
+    return result
@@ -0,0 +1,63 @@
+import os
+import sys
+
+import pytest
+import streamlit as st
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class SessionState(dict):
+    """Stand-in for st.session_state outside a Streamlit run; app.py reads it at import"""
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+
+@pytest.fixture
+def pos(tmp_path, monkeypatch):
+    """The app module over an empty store in tmp_path. All data paths are relative
+    to the working directory, so each test gets its own store."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(st, 'session_state', SessionState())
+    import app
+    for directory in (app.DATA_DIR, app.PURCHASE_ORDERS_DIR, app.BACKUP_DIR, app.TEMPLATE_DIR,
+                      app.SPOOL_DIR, app.REPORTS_DIR):
+        os.makedirs(directory, exist_ok=True)
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    app.initialize_empty_data()
+    app.migrate_data()
+    st.session_state.user_info = {'username': 'admin', 'role': 'admin'}
+    return app
+
+
+@pytest.fixture
+def sell(pos):
+    """Spool a sale on this lane: sell({barcode: (quantity, unit price)}, customer_id=None)"""
+    def spool(items, customer_id=None):
+        lines = {barcode: {'quantity': quantity, 'price': price} for barcode, (quantity, price) in items.items()}
+        total = sum(quantity * price for quantity, price in items.values())
+        transaction = {
+            'transaction_id': pos.generate_short_id(),
+            'lane_id': pos.get_lane_id(),
+            **pos.timestamp_fields('date'),
+            'line_format': pos.TRANSACTION_LINE_FORMAT,
+            'items': lines,
+            'subtotal': total,
+            'tax': 0,
+            'discount': 0,
+            'total': total,
+            'payment_method': 'Cash',
+            'cashier': 'admin'
+        }
+        if customer_id:
+            transaction['customer_id'] = customer_id
+        pos.spool_sale(transaction)
+        return transaction
+    return spool
@@ -0,0 +1,33 @@
+import os
+
+BARCODE = '000000000001'
+
+
+def test_restoring_a_backup_from_before_the_ledger(pos, sell, monkeypatch):
+    pos.save_data({BARCODE: {'quantity': 10, 'reorder_point': 2}}, pos.INVENTORY_FILE)
+    settings = pos.load_data(pos.SETTINGS_FILE)
+    pos.save_data({**settings, 'schema_version': 2}, pos.SETTINGS_FILE)
+    backup = pos.create_complete_backup('before_ledger', compress=False)
+    pos.save_data(settings, pos.SETTINGS_FILE)
+    
+    sell({BARCODE: (3, 2.5)})
+    pos.reconcile_lane_spool()
+    assert pos.get_stock_ledger().movements(BARCODE)['delta'].sum() == -3
+    
+    locked = []
+    backup_original_data = pos.backup_original_data
+    
+    def record_lock():
+        locked.append(os.path.exists(pos.DATA_LOCK_FILE))
+        backup_original_data()
+    monkeypatch.setattr(pos, 'backup_original_data', record_lock)
+    assert pos.restore_backup(backup, False)
+    assert locked == [True]
+    assert not os.path.exists(pos.DATA_LOCK_FILE)
+    assert not os.path.exists(pos.STOCK_LEDGER_FILE)
+    assert not os.path.exists(pos.SALES_ROLLUPS_FILE)
+    
+    pos.migrate_data()
+    ledger = pos.get_stock_ledger().movements(BARCODE)
+    assert ledger['source'].tolist() == ['opening']
+    assert ledger['level'].iloc[-1] == pos.load_data(pos.INVENTORY_FILE)[BARCODE]['quantity'] == 10
@@ -0,0 +1,25 @@
+def test_customer_saved_during_a_refresh_is_kept(pos, sell, monkeypatch):
+    pos.save_data({'customers': {
+        'c1': {'name': 'Ann', 'points': 10},
+        'c2': {'name': 'Bob', 'points': 0}
+    }}, pos.LOYALTY_FILE)
+    sell({'000000000001': (2, 2.5)}, customer_id='c1')
+    pos.reconcile_lane_spool()
+    
+    compute = pos.compute_rfm_segments
+    
+    def checkout_saves_meanwhile(*args):
+        loyalty = pos.load_data(pos.LOYALTY_FILE)
+        loyalty['customers']['c1']['points'] = 15
+        loyalty['customers']['c3'] = {'name': 'Cy', 'points': 0}
+        pos.save_data(loyalty, pos.LOYALTY_FILE)
+        return compute(*args)
+    monkeypatch.setattr(pos, 'compute_rfm_segments', checkout_saves_meanwhile)
+    pos.refresh_customer_segments()
+    
+    customers = pos.load_data(pos.LOYALTY_FILE)['customers']
+    assert customers['c1']['points'] == 15
+    assert 'c3' in customers
+    labels = pos.load_data(pos.CUSTOMER_RFM_FILE)
+    assert labels['c1']['segment'] != "No Purchases"
+    assert labels['c2'] == {'segment': "No Purchases", 'rfm': "000"}
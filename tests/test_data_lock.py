@@ -0,0 +1,47 @@
+import os
+import threading
+import time
+
+import pytest
+
+
+def test_lock_held_past_stale_age_is_not_broken(pos, monkeypatch):
+    monkeypatch.setattr(pos, 'DATA_LOCK_STALE_SECONDS', 0.4)
+    errors = []
+    
+    def contend():
+        try:
+            with pos.data_dir_lock(timeout=1.0):
+                pass
+        except TimeoutError as e:
+            errors.append(e)
+    
+    with pos.data_dir_lock():
+        other = threading.Thread(target=contend)
+        other.start()
+        time.sleep(1.2)
+        assert os.path.exists(pos.DATA_LOCK_FILE)
+    other.join()
+    assert len(errors) == 1
+    assert not os.path.exists(pos.DATA_LOCK_FILE)
+
+
+def test_lock_left_by_a_dead_lane_is_broken(pos, monkeypatch):
+    monkeypatch.setattr(pos, 'DATA_LOCK_STALE_SECONDS', 0.4)
+    with open(pos.DATA_LOCK_FILE, 'w') as f:
+        f.write("lane-gone 1 token")
+    stale = time.time() - 1
+    os.utime(pos.DATA_LOCK_FILE, (stale, stale))
+    
+    with pos.data_dir_lock(timeout=0.5):
+        assert not pos.owns_lock_file("lane-gone 1 token")
+    assert not os.path.exists(pos.DATA_LOCK_FILE)
+
+
+def test_release_leaves_a_lock_taken_over_by_another_lane(pos):
+    with pytest.raises(RuntimeError):
+        with pos.data_dir_lock():
+            with open(pos.DATA_LOCK_FILE, 'w') as f:
+                f.write("other-lane 2 token")
+            raise RuntimeError
+    assert pos.owns_lock_file("other-lane 2 token")
@@ -0,0 +1,99 @@
+import pytest
+
+BARCODE = '000000000001'
+
+
+class Crash(Exception):
+    pass
+
+
+def crash_after(monkeypatch, module, name):
+    """Make module.name do its work and then fail, once"""
+    original = getattr(module, name)
+    
+    def crashing(*args, **kwargs):
+        monkeypatch.setattr(module, name, original)
+        original(*args, **kwargs)
+        raise Crash(name)
+    monkeypatch.setattr(module, name, crashing)
+
+
+def crash_after_saving(monkeypatch, pos, file):
+    original = pos.save_data
+    
+    def crashing(data, target):
+        original(data, target)
+        if target == file:
+            monkeypatch.setattr(pos, 'save_data', original)
+            raise Crash(file)
+    monkeypatch.setattr(pos, 'save_data', crashing)
+
+
+def store_totals(pos):
+    day = pos.get_current_datetime().strftime("%Y-%m-%d")
+    rollup = pos.load_data(pos.SALES_ROLLUPS_FILE)['daily'][day]
+    customer = pos.load_data(pos.CUSTOMER_STATS_FILE)['customers']['c1']
+    counters = pos.load_data(pos.DASHBOARD_COUNTERS_FILE)
+    ledger = pos.get_stock_ledger().movements(BARCODE)
+    return {
+        'transactions': len(pos.load_data(pos.TRANSACTIONS_FILE)),
+        'stock': pos.load_data(pos.INVENTORY_FILE)[BARCODE]['quantity'],
+        'ledger': int(ledger.loc[ledger['source'] == 'sale', 'delta'].sum()),
+        'rollup': (rollup['sales'], rollup['transactions']),
+        'velocity': int(pos.sales_velocity_frame([BARCODE]).loc[BARCODE, 'units_7d']),
+        'customer': (customer['spend'], customer['visits']),
+        'counters': (counters['today_sales'], counters['today_transactions'])
+    }
+
+
+EXPECTED = {
+    'transactions': 4,
+    'stock': 92,
+    'ledger': -8,
+    'rollup': (2000, 4),
+    'velocity': 8,
+    'customer': (2000, 4),
+    'counters': (2000, 4)
+}
+
+
+@pytest.mark.parametrize('step', [
+    'transactions', 'staged_inventory', 'journal', 'record_sales_conflicts', 'record_stock_movements',
+    'update_sales_rollups', 'update_sales_velocity', 'update_customer_stats', 'update_dashboard_counters',
+    'offsets'
+])
+def test_pass_that_dies_after_any_step_is_finished_once(pos, sell, monkeypatch, step):
+    pos.save_data({BARCODE: {'quantity': 100, 'reorder_point': 10}}, pos.INVENTORY_FILE)
+    sell({BARCODE: (2, 2.5)}, customer_id='c1')
+    assert pos.reconcile_lane_spool() == 1
+    for _ in range(3):
+        sell({BARCODE: (2, 2.5)}, customer_id='c1')
+    
+    files = {
+        'transactions': pos.TRANSACTIONS_FILE,
+        'staged_inventory': f"{pos.INVENTORY_FILE}.{pos.get_lane_id()}.merging",
+        'journal': pos.MERGE_JOURNAL_FILE,
+        'offsets': pos.SPOOL_OFFSETS_FILE
+    }
+    if step in files:
+        crash_after_saving(monkeypatch, pos, files[step])
+    else:
+        crash_after(monkeypatch, pos, step)
+    with pytest.raises(Crash):
+        pos.reconcile_lane_spool()
+    
+    pos.reconcile_lane_spool()
+    assert store_totals(pos) == EXPECTED
+    assert pos.reconcile_lane_spool() == 0
+    assert store_totals(pos) == EXPECTED
+
+
+def test_replayed_sale_is_not_merged_again(pos, sell):
+    pos.save_data({BARCODE: {'quantity': 5, 'reorder_point': 10}}, pos.INVENTORY_FILE)
+    sale = sell({BARCODE: (1, 2.5)})
+    pos.reconcile_lane_spool()
+    pos.spool_sale(sale)
+    
+    assert pos.reconcile_lane_spool() == 0
+    assert pos.load_data(pos.INVENTORY_FILE)[BARCODE]['quantity'] == 4
+    assert pos.load_data(pos.SALES_CONFLICTS_FILE) == {}
@@ -0,0 +1,61 @@
+import pandas as pd
+
+
+def test_rollups_on_fresh_store_count_each_sale_once(pos, sell):
+    for _ in range(3):
+        sell({'000000000001': (2, 2.5)})
+    assert pos.reconcile_lane_spool() == 3
+    
+    day = pos.get_current_datetime().strftime("%Y-%m-%d")
+    bucket = pos.load_data(pos.SALES_ROLLUPS_FILE)['daily'][day]
+    assert (bucket['sales'], bucket['transactions']) == (1500, 3)
+
+
+def test_rollups_count_a_return_once_after_rebuild(pos):
+    return_record = {'return_id': 'r1', 'total_refund': 4.0, **pos.timestamp_fields('return_date')}
+    pos.save_data({'r1': return_record}, pos.RETURNS_FILE)
+    pos.update_sales_rollups(returns=[return_record])
+    
+    day = pos.get_current_datetime().strftime("%Y-%m-%d")
+    bucket = pos.load_data(pos.SALES_ROLLUPS_FILE)['daily'][day]
+    assert (bucket['refunds'], bucket['returns']) == (400, 1)
+
+
+def test_brand_rollups_equal_the_sum_of_line_items(pos, sell):
+    pos.save_data({
+        '000000000001': {'name': 'Tea', 'brand': 'Acme'},
+        '000000000002': {'name': 'Milk', 'brand': 'Dairyland'},
+        '000000000003': {'name': 'Sugar', 'brand': 'Acme'}
+    }, pos.PRODUCTS_FILE)
+    sell({'000000000001': (2, 2.5)})
+    sell({'000000000001': (1, 2.5), '000000000003': (4, 1.25)})
+    sell({'000000000002': (3, 0.99), '000000000003': (1, 1.25)})
+    pos.reconcile_lane_spool()
+    
+    lines = pd.concat(pos.iter_line_item_chunks(pos.load_data(pos.TRANSACTIONS_FILE), pos.load_data(pos.PRODUCTS_FILE)))
+    lines['revenue'] = pos.to_minor_array(lines['price']) * lines['quantity']
+    expected = lines.groupby('brand').agg(revenue=('revenue', 'sum'), units=('quantity', 'sum'),
+                                          transactions=('transaction_id', 'nunique'))
+    day = pos.get_current_datetime().strftime("%Y-%m-%d")
+    brand_daily = pos.load_data(pos.SALES_ROLLUPS_FILE)['brand_daily'][day]
+    rolled_up = pd.DataFrame.from_dict(brand_daily, orient='index')[expected.columns]
+    pd.testing.assert_frame_equal(rolled_up.sort_index(), expected.rename_axis(None), check_dtype=False)
+
+
+def test_velocity_on_fresh_store_counts_each_sale_once(pos, sell):
+    for _ in range(3):
+        sell({'000000000001': (2, 2.5)})
+    pos.reconcile_lane_spool()
+    
+    frame = pos.sales_velocity_frame(['000000000001'])
+    assert frame.loc['000000000001', 'units_7d'] == 6
+
+
+def test_customer_stats_on_fresh_store_count_each_sale_once(pos, sell):
+    for _ in range(3):
+        sell({'000000000001': (2, 2.5)}, customer_id='c1')
+    sell({'000000000001': (1, 2.5)})
+    pos.reconcile_lane_spool()
+    
+    customer = pos.load_data(pos.CUSTOMER_STATS_FILE)['customers']['c1']
+    assert (customer['spend'], customer['visits']) == (1500, 3)